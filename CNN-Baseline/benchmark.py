@@ -0,0 +1,280 @@
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import itertools
+import platform
+import resource
+import subprocess
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+def _abstract_unet(cls_name):
+    def build(f_maps, num_levels):
+        import model
+        kwargs = dict(in_channels=1, out_channels=1, final_sigmoid=False, f_maps=f_maps, num_levels=num_levels,
+                      is_segmentation=True)
+        if cls_name == "UNetWithClassifier":
+            kwargs["num_classes"] = 2
+        return getattr(model, cls_name)(**kwargs)
+    return build
+
+
+def _cmb_unet3d(f_maps, num_levels):
+    import models_cmb
+    return models_cmb.UNet3D(in_channels=1, out_channels=1)
+
+
+def _unet3d_v2(f_maps, num_levels):
+    from models.unet3d import UNet3D
+    return UNet3D(in_channels=1, num_classes=1)
+
+
+# name -> (builder(f_maps, num_levels), spatial dims, whether f_maps / num_levels are used);
+# the fixed architectures are built with their own widths
+ARCHITECTURES = {
+    "unet3d": (_abstract_unet("UNet3D"), 3, True),
+    "residual_unet3d": (_abstract_unet("ResidualUNet3D"), 3, True),
+    "residual_unet_se3d": (_abstract_unet("ResidualUNetSE3D"), 3, True),
+    "unet2d": (_abstract_unet("UNet2D"), 2, True),
+    "residual_unet2d": (_abstract_unet("ResidualUNet2D"), 2, True),
+    "unet_classifier": (_abstract_unet("UNetWithClassifier"), 3, True),
+    "cmb_unet3d": (_cmb_unet3d, 3, False),
+    "unet3d_v2": (_unet3d_v2, 3, False),
+}
+
+TIMED_METRICS = ["infer_ms", "forward_ms", "backward_ms", "peak_rss_mb"]
+
+
+def count_flops(model, sample):
+    """
+    Multiply-adds x 2 of the convolutions, transposed convolutions and linear layers
+    of one forward pass of `sample`, counted with forward hooks. Normalizations,
+    activations and pooling are not counted; a backward pass costs about twice this.
+    """
+    total = [0]
+
+    def hook(module, inputs, output):
+        if isinstance(module, (nn.Conv2d, nn.Conv3d)):
+            kernel = int(np.prod(module.kernel_size))
+            total[0] += 2 * output.numel() * (module.in_channels // module.groups) * kernel
+        elif isinstance(module, (nn.ConvTranspose2d, nn.ConvTranspose3d)):
+            kernel = int(np.prod(module.kernel_size))
+            total[0] += 2 * inputs[0].numel() * (module.out_channels // module.groups) * kernel
+        elif isinstance(module, nn.Linear):
+            total[0] += 2 * output.numel() * module.in_features
+
+    handles = [m.register_forward_hook(hook) for m in model.modules()
+               if isinstance(m, (nn.Conv2d, nn.Conv3d, nn.ConvTranspose2d, nn.ConvTranspose3d, nn.Linear))]
+    try:
+        with torch.no_grad():
+            model(sample)
+    finally:
+        for h in handles:
+            h.remove()
+    return total[0]
+
+
+def _reduce(output):
+    # scalar over every floating point output, for the backward pass
+    outputs = output if isinstance(output, (tuple, list)) else [output]
+    return sum(o.float().mean() for o in outputs if torch.is_tensor(o) and o.is_floating_point())
+
+
+def _timings(fn, warmup, repeats):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def run_config(config, warmup=2, repeats=5):
+    """
+    Benchmark one configuration in the current process. Meant to run in a fresh
+    worker process (see `run_in_subprocess`) so that the peak RSS is the one of this
+    configuration and the thread count is applied before any parallel work.
+
+    Returns:
+        dict with params, flops, infer/forward/backward medians and p95 in ms,
+        gflops_per_s of the inference forward and peak_rss_mb
+    """
+    from util import autocast_context
+
+    torch.manual_seed(0)
+    torch.set_num_threads(config["threads"])
+    builder, dims, _ = ARCHITECTURES[config["arch"]]
+    f_maps = None
+    if config["f_maps"] is not None:
+        f_maps = [config["f_maps"] * 2 ** k for k in range(config["num_levels"])]
+    model = builder(f_maps, config["num_levels"])
+    size = tuple(config["input_size"][:dims])
+    sample = torch.randn((config["batch_size"], 1) + size)
+
+    result = {"params": sum(p.numel() for p in model.parameters())}
+    model.eval()
+    result["flops"] = count_flops(model, sample)
+
+    def infer():
+        with torch.no_grad(), autocast_context("cpu", config["precision"]):
+            model(sample)
+
+    state = {}
+
+    def forward():
+        with autocast_context("cpu", config["precision"]):
+            state["loss"] = _reduce(model(sample))
+
+    def backward():
+        forward()
+        start = time.perf_counter()
+        state["loss"].backward()
+        state["backward"] = time.perf_counter() - start
+        model.zero_grad(set_to_none=True)
+
+    infer_times = _timings(infer, warmup, repeats)
+    model.train()
+    forward_times = _timings(forward, warmup, repeats)
+    backward_times = []
+    for _ in range(warmup + repeats):
+        backward()
+        backward_times.append(state["backward"])
+    backward_times = backward_times[warmup:]
+
+    for name, times in [("infer", infer_times), ("forward", forward_times), ("backward", backward_times)]:
+        times = np.asarray(times) * 1e3
+        result[f"{name}_ms"] = float(np.median(times))
+        result[f"{name}_p95_ms"] = float(np.percentile(times, 95))
+    result["gflops_per_s"] = result["flops"] / 1e9 / (result["infer_ms"] / 1e3)
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result["peak_rss_mb"] = maxrss / 2 ** 20 if sys.platform == "darwin" else maxrss / 2 ** 10
+    return result
+
+
+def run_in_subprocess(config, warmup, repeats, timeout=None):
+    env = dict(os.environ, OMP_NUM_THREADS=str(config["threads"]), MKL_NUM_THREADS=str(config["threads"]))
+    cmd = [sys.executable, os.path.abspath(__file__), "--worker", json.dumps(config),
+           "--warmup", str(warmup), "--repeats", str(repeats)]
+    try:
+        proc = subprocess.run(cmd, capture_output=True, text=True, env=env, timeout=timeout,
+                              cwd=os.path.dirname(os.path.abspath(__file__)))
+    except subprocess.TimeoutExpired:
+        return {"error": f"timeout after {timeout} s"}
+    for line in reversed(proc.stdout.splitlines()):
+        if line.startswith("RESULT "):
+            return json.loads(line[len("RESULT "):])
+    lines = (proc.stderr or proc.stdout).strip().splitlines()
+    return {"error": lines[-1] if lines else f"worker exited with {proc.returncode}"}
+
+
+def config_key(config):
+    return json.dumps({k: config[k] for k in ["arch", "f_maps", "num_levels", "input_size", "batch_size", "threads",
+                                               "precision"]}, sort_keys=True)
+
+
+def sweep_configs(args):
+    configs, seen = [], set()
+    for arch, f_maps, num_levels, size, batch_size, threads, precision in itertools.product(
+            args.archs, args.f_maps, args.num_levels, args.input_sizes, args.batch_sizes, args.threads, args.precisions):
+        _, _, configurable = ARCHITECTURES[arch]
+        config = {"arch": arch, "f_maps": f_maps if configurable else None,
+                  "num_levels": num_levels if configurable else None,
+                  "input_size": [int(s) for s in size.split(",")], "batch_size": batch_size,
+                  "threads": threads, "precision": precision}
+        if config_key(config) not in seen:
+            seen.add(config_key(config))
+            configs.append(config)
+    return configs
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {"commit": commit, "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "torch": torch.__version__, "python": platform.python_version(), "machine": platform.machine(),
+            "processor": platform.processor(), "cpu_count": os.cpu_count()}
+
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Print the ratio current / baseline of `TIMED_METRICS` for every configuration
+    present in both runs and return the (config, metric, ratio) above 1 + tolerance.
+    """
+    old = {config_key(r["config"]): r for r in baseline["results"] if "error" not in r}
+    regressions = []
+    print(f"Comparison with {baseline['environment'].get('commit', '?')} (ratio current / baseline):")
+    for r in results:
+        key = config_key(r["config"])
+        if "error" in r or key not in old:
+            continue
+        ratios = {m: r[m] / old[key][m] for m in TIMED_METRICS if old[key].get(m)}
+        flagged = [m for m, ratio in ratios.items() if ratio > 1 + tolerance]
+        regressions += [(r["config"], m, ratios[m]) for m in flagged]
+        print(f"  {describe(r['config'])}: " + "  ".join(f"{m} {ratio:.2f}{'!' if m in flagged else ''}"
+                                                      for m, ratio in ratios.items()))
+    return regressions
+
+
+def describe(config):
+    size = "x".join(str(s) for s in config["input_size"])
+    model = config["arch"] if config["f_maps"] is None else f"{config['arch']}/f{config['f_maps']}/l{config['num_levels']}"
+    return f"{model} {size} b{config['batch_size']} t{config['threads']} {config['precision']}"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='CPU benchmark of the UNet variants')
+
+    parser.add_argument('--archs', type=str, nargs='+', default=['unet3d', 'residual_unet3d'], choices=list(ARCHITECTURES))
+    parser.add_argument('--f_maps', type=int, nargs='+', default=[16], help='feature maps of the first level, doubled per level')
+    parser.add_argument('--num_levels', type=int, nargs='+', default=[4])
+    parser.add_argument('--input_sizes', type=str, nargs='+', default=['64,64,48'], help='D,H,W (2D models use D,H)')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1])
+    parser.add_argument('--threads', type=int, nargs='+', default=[torch.get_num_threads()])
+    parser.add_argument('--precisions', type=str, nargs='+', default=['fp32'], choices=['fp32', 'bf16', 'fp16'])
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=None, help='seconds per configuration')
+    parser.add_argument('--out', type=str, default='benchmark.json')
+    parser.add_argument('--baseline', type=str, default=None, help='results file of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative slowdown reported as a regression')
+    parser.add_argument('--worker', type=str, default=None, help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+    if args.worker is not None:
+        print("RESULT " + json.dumps(run_config(json.loads(args.worker), args.warmup, args.repeats)))
+        sys.exit(0)
+
+    configs = sweep_configs(args)
+    results = []
+    for n, config in enumerate(configs):
+        result = run_in_subprocess(config, args.warmup, args.repeats, args.timeout)
+        result["config"] = config
+        results.append(result)
+        if "error" in result:
+            print(f"[{n+1}/{len(configs)}] {describe(config)}: failed, {result['error']}")
+        else:
+            print(f"[{n+1}/{len(configs)}] {describe(config)}: params {result['params']/1e6:.2f}M  "
+                  f"{result['flops']/1e9:.1f} GFLOP  infer {result['infer_ms']:.1f} ms  forward {result['forward_ms']:.1f} ms  "
+                  f"backward {result['backward_ms']:.1f} ms  {result['gflops_per_s']:.1f} GFLOP/s  rss {result['peak_rss_mb']:.0f} MB")
+
+    with open(args.out, 'w') as f:
+        json.dump({"environment": environment(), "results": results}, f, indent=1)
+    print(f"Results written to {args.out}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regression(s) above {100 * args.tolerance:.0f}%")
+            sys.exit(1)
@@ -0,0 +1,276 @@
+import os
+import argparse
+import numpy as np
+import torch
+import torch.nn.functional as F
+from volume_cache import source_key
+
+
+def gaussian_kernel1d(sigma, radius):
+    x = torch.arange(-radius, radius + 1, dtype=torch.float64)
+    k = torch.exp(-0.5 * (x / sigma) ** 2)
+    return k / k.sum()
+
+
+def gaussian_blur3d(volume, sigmas, truncate=3.0):
+    """
+    Blur a volume with several isotropic Gaussians at once.
+
+    The scales are stacked as channels and filtered with three grouped 1D
+    convolutions (D, H and W), every kernel being zero-padded to the radius of the
+    largest sigma so one conv per axis serves all scales. Borders are replicated.
+
+    Args:
+        volume (torch.Tensor): (D, H, W)
+        sigmas (sequence): S standard deviations in voxels
+        truncate (float): kernel radius in sigmas
+
+    Returns:
+        Tensor (S, D, H, W)
+    """
+    radius = max(int(truncate * max(sigmas) + 0.5), 1)
+    kernels = torch.stack([gaussian_kernel1d(s, radius) for s in sigmas]).to(volume.device, volume.dtype)  # [S,K]
+    S, K = kernels.shape
+    x = volume[None, None].expand(1, S, *volume.shape).contiguous()
+    for axis in range(3):
+        shape = [S, 1, 1, 1, 1]
+        shape[2 + axis] = K
+        pad = [0, 0, 0, 0, 0, 0]
+        pad[2 * (2 - axis)] = pad[2 * (2 - axis) + 1] = radius
+        x = F.conv3d(F.pad(x, pad, mode="replicate"), kernels.view(shape), groups=S)
+    return x[0]
+
+
+def neighbourhoods(volume, coords):
+    """3x3x3 neighbourhoods of `volume` (D, H, W) around `coords` (N, 3), replicate-padded -> (N, 3, 3, 3)."""
+    padded = F.pad(volume[None, None], (1, 1, 1, 1, 1, 1), mode="replicate")[0, 0]
+    offsets = torch.stack(torch.meshgrid(*[torch.arange(3, device=coords.device)] * 3, indexing="ij"), dim=-1)
+    idx = coords[:, None, None, None, :] + offsets  # shifted by the padding
+    return padded[idx[..., 0], idx[..., 1], idx[..., 2]]
+
+
+def hessian_eigenvalues(volume, coords):
+    """Eigenvalues (ascending) of the finite-difference Hessian of `volume` at `coords` -> (N, 3)."""
+    n = neighbourhoods(volume, coords)
+    c = n[:, 1, 1, 1]
+    hess = torch.empty((len(coords), 3, 3), dtype=volume.dtype, device=volume.device)
+    hess[:, 0, 0] = n[:, 2, 1, 1] - 2 * c + n[:, 0, 1, 1]
+    hess[:, 1, 1] = n[:, 1, 2, 1] - 2 * c + n[:, 1, 0, 1]
+    hess[:, 2, 2] = n[:, 1, 1, 2] - 2 * c + n[:, 1, 1, 0]
+    hess[:, 0, 1] = hess[:, 1, 0] = (n[:, 2, 2, 1] - n[:, 2, 0, 1] - n[:, 0, 2, 1] + n[:, 0, 0, 1]) / 4
+    hess[:, 0, 2] = hess[:, 2, 0] = (n[:, 2, 1, 2] - n[:, 2, 1, 0] - n[:, 0, 1, 2] + n[:, 0, 1, 0]) / 4
+    hess[:, 1, 2] = hess[:, 2, 1] = (n[:, 1, 2, 2] - n[:, 1, 2, 0] - n[:, 1, 0, 2] + n[:, 1, 0, 0]) / 4
+    return torch.linalg.eigvalsh(hess)
+
+
+def detect_blobs(image, sigmas=(0.75, 1.0, 1.4, 2.0, 2.8), threshold=0.02, polarity="dark", brain_threshold=0.05,
+                 hessian=True, max_candidates=2000):
+    """
+    Multi-scale difference-of-Gaussians blob detection with a Hessian check.
+
+    The volume is blurred at all `sigmas` at once, consecutive levels are subtracted
+    into S-1 DoG responses (signed so that blobs of the requested polarity are
+    positive; microbleeds are dark on SWI / T2*), and candidates are the local
+    maxima over space and scale above `threshold`. With `hessian` a candidate is
+    kept only if the Hessian of the smoothed image at its scale is definite with
+    the right sign (all eigenvalues > 0 for dark blobs), which removes vessels and
+    edges. Candidates outside the brain (`image < brain_threshold`) are dropped.
+
+    Args:
+        image (torch.Tensor or np.ndarray): (D, H, W) volume normalized to [0, 1]
+        sigmas (sequence): increasing blur scales in voxels
+        threshold (float): minimum DoG response
+        polarity (str): 'dark' or 'bright'
+        brain_threshold (float): minimum intensity at the candidate voxel, 0 to disable
+        hessian (bool): apply the Hessian definiteness filter
+        max_candidates (int): keep the strongest candidates only, 0 for all
+
+    Returns:
+        dict with coords (N, 3) int64, sigmas (N,) float32 and responses (N,) float32,
+        sorted by decreasing response
+    """
+    image = torch.as_tensor(np.asarray(image) if not torch.is_tensor(image) else image).float()
+    blurred = gaussian_blur3d(image, sigmas)  # [S,D,H,W]
+    sign = 1.0 if polarity == "dark" else -1.0
+    dog = sign * (blurred[1:] - blurred[:-1])  # [S-1,D,H,W], positive at blob centres
+
+    # local maxima over the 3x3x3 spatial and the 3 scale neighbourhood
+    spatial_max = F.max_pool3d(dog[None], kernel_size=3, stride=1, padding=1)[0]
+    scale_max = F.pad(spatial_max[None, None], (0, 0, 0, 0, 0, 0, 1, 1), value=float("-inf"))[0, 0]
+    scale_max = torch.max(torch.max(scale_max[:-2], scale_max[1:-1]), scale_max[2:])
+    peaks = (dog == scale_max) & (dog > threshold)
+    if brain_threshold > 0:
+        peaks &= (image >= brain_threshold)[None]
+
+    level, d, h, w = torch.nonzero(peaks, as_tuple=True)
+    coords = torch.stack([d, h, w], dim=1)
+    responses = dog[level, d, h, w]
+
+    if hessian and len(coords) > 0:
+        keep = torch.zeros(len(coords), dtype=torch.bool, device=image.device)
+        for k in torch.unique(level).tolist():
+            sel = level == k
+            eig = hessian_eigenvalues(blurred[k], coords[sel])
+            keep[sel] = (eig[:, 0] > 0) if polarity == "dark" else (eig[:, 2] < 0)
+        level, coords, responses = level[keep], coords[keep], responses[keep]
+
+    order = torch.argsort(responses, descending=True)
+    if max_candidates > 0:
+        order = order[:max_candidates]
+    scales = torch.as_tensor(list(sigmas), dtype=torch.float32, device=image.device)
+    return {"coords": coords[order].cpu(),
+            "sigmas": scales[level[order]].cpu(),
+            "responses": responses[order].float().cpu()}
+
+
+class CandidateCache(object):
+    """
+    Per-subject cache of `detect_blobs` results, one npz per image and detector
+    setting. Entries are keyed on the image path/mtime/size plus the detector
+    parameters, so changing either recomputes them.
+
+    Args:
+        cache_dir (str): directory holding the npz files (created if missing)
+        **params: keyword arguments forwarded to `detect_blobs`
+    """
+
+    def __init__(self, cache_dir, **params):
+        self.cache_dir = cache_dir
+        self.params = params
+        self.param_token = repr(sorted(params.items()))
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def entry_path(self, img_path):
+        return os.path.join(self.cache_dir, f"cand_{source_key(img_path, self.param_token)}.npz")
+
+    def load(self, img_path, image_fn):
+        """
+        Candidates of `img_path`; `image_fn()` must return its normalized volume and
+        is only called on a cache miss.
+        """
+        entry = self.entry_path(img_path)
+        if not os.path.exists(entry):
+            result = detect_blobs(image_fn(), **self.params)
+            tmp_path = entry + ".tmp.npz"
+            np.savez(tmp_path, **{k: v.numpy() for k, v in result.items()})
+            os.replace(tmp_path, entry)
+        with np.load(entry) as data:
+            return {k: torch.from_numpy(data[k]) for k in data.files}
+
+
+def candidate_patch_inference(model, image, coords, patch_size=(32, 32, 24), batch_size=32):
+    """
+    Evaluate the segmentation network on candidate-centred patches only.
+
+    Patches are cut around every candidate (zero padded at the borders), run
+    `batch_size` at a time, and their probabilities are written back into an empty
+    volume with a voxel-wise max where patches overlap. Voxels not covered by any
+    patch have probability 0.
+
+    Args:
+        model: network returning segmentation logits, or a tuple with them first
+        image (torch.Tensor): (D, H, W) normalized volume on the model's device
+        coords (torch.Tensor): (N, 3) candidate coordinates
+        patch_size (tuple): patch size, must suit the network depth
+        batch_size (int): patches per forward
+
+    Returns:
+        prob (torch.Tensor): (D, H, W) probability volume
+        scores (torch.Tensor): (N,) probability at every candidate centre
+    """
+    shape = torch.tensor(image.shape)
+    size = torch.tensor(patch_size)
+    half = size // 2
+    padded = F.pad(image, (int(half[2]), int(size[2] - half[2]), int(half[1]), int(size[1] - half[1]),
+                           int(half[0]), int(size[0] - half[0])))
+    prob = torch.zeros((int(shape[0]) + int(size[0]), int(shape[1]) + int(size[1]), int(shape[2]) + int(size[2])),
+                       device=image.device)
+    scores = []
+    centre = tuple(half.tolist())
+    batch = image.new_empty((min(batch_size, max(len(coords), 1)), 1) + tuple(patch_size))
+    d, h, w = patch_size
+
+    with torch.no_grad():
+        for start in range(0, len(coords), batch_size):
+            chunk = coords[start:start + batch_size].tolist()
+            # in padded coordinates the patch of a candidate starts at the candidate itself
+            for k, (z, y, x) in enumerate(chunk):
+                batch[k, 0].copy_(padded[z:z + d, y:y + h, x:x + w])
+            out = model(batch[:len(chunk)])
+            out = out[0] if isinstance(out, (tuple, list)) else out
+            p = torch.sigmoid(out[:, 0].float())
+            for k, (z, y, x) in enumerate(chunk):
+                region = prob[z:z + d, y:y + h, x:x + w]
+                torch.max(region, p[k], out=region)
+            # centre probabilities of the whole batch, copied to the host once after the loop
+            scores.append(p[(slice(None),) + centre])
+    crop = tuple(slice(int(hh), int(hh) + int(s)) for hh, s in zip(half, shape))
+    scores = torch.cat(scores).cpu() if scores else torch.zeros(0)
+    return prob[crop], scores
+
+
+def candidate_sensitivity(coords, mask, radius=3):
+    """Fraction of lesion components of `mask` with a candidate within `radius` voxels of one of their voxels."""
+    from skimage import measure
+    labels = measure.label(np.asarray(mask) > 0, connectivity=3)
+    if labels.max() == 0:
+        return float("nan")
+    hit = np.zeros(labels.max() + 1, dtype=bool)
+    for z, y, x in np.asarray(coords):
+        window = labels[max(z - radius, 0):z + radius + 1, max(y - radius, 0):y + radius + 1, max(x - radius, 0):x + radius + 1]
+        hit[np.unique(window)] = True
+    return hit[1:].mean()
+
+
+if __name__ == '__main__':
+    from data_loader import MRIDataset
+    from util import resolve_device
+
+    parser = argparse.ArgumentParser(description='Multi-scale DoG/Hessian CMB candidates and candidate-patch inference')
+
+    parser.add_argument('--data_path', type=str, required=True, help='directory with the split CSVs')
+    parser.add_argument('--mode', type=str, default='test')
+    parser.add_argument('--cache_dir', type=str, default=None, help='defaults to <data_path>/candidates')
+    parser.add_argument('--sigmas', type=float, nargs='+', default=[0.75, 1.0, 1.4, 2.0, 2.8])
+    parser.add_argument('--threshold', type=float, default=0.02, help='minimum DoG response')
+    parser.add_argument('--polarity', type=str, default='dark', choices=['dark', 'bright'])
+    parser.add_argument('--no_hessian', action='store_true', help='skip the Hessian definiteness filter')
+    parser.add_argument('--max_candidates', type=int, default=2000)
+    parser.add_argument('--weights', type=str, default=None, help='segmentation weights, run candidate-patch inference if set')
+    parser.add_argument('--out_dir', type=str, default=None, help='where to write the probability maps')
+    parser.add_argument('--patch_size', type=int, nargs=3, default=[32, 32, 24])
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--device', type=str, default='auto')
+
+    args = parser.parse_args()
+    device = resolve_device(args.device)
+    cache = CandidateCache(args.cache_dir or os.path.join(args.data_path, 'candidates'), sigmas=tuple(args.sigmas),
+                           threshold=args.threshold, polarity=args.polarity, hessian=not args.no_hessian,
+                           max_candidates=args.max_candidates)
+    dataset = MRIDataset(args.data_path, mode=args.mode)
+
+    model = None
+    if args.weights:
+        import nibabel as nib
+        from inference import load_segmentation_model
+        model = load_segmentation_model(args.weights, device)
+        if args.out_dir:
+            os.makedirs(args.out_dir, exist_ok=True)
+
+    for i in range(len(dataset)):
+        img_path = os.path.join(args.data_path, dataset.pair_list[i]["MRI_file_path"])
+        image, mask = dataset.load_pair(i)
+        candidates = cache.load(img_path, lambda: torch.as_tensor(image, dtype=torch.float32).to(device))
+        sensitivity = candidate_sensitivity(candidates["coords"], mask)
+        print(f"[{args.mode}] {i+1}/{len(dataset)} {dataset.pair_list[i]['MRI_file_path']}: "
+              f"{len(candidates['coords'])} candidates, lesion sensitivity {sensitivity:.3f}")
+
+        if model is not None:
+            volume = torch.as_tensor(image, dtype=torch.float32).to(device)
+            prob, scores = candidate_patch_inference(model, volume, candidates["coords"].to(device),
+                                                     patch_size=tuple(args.patch_size), batch_size=args.batch_size)
+            print(f"    {int((scores > 0.5).sum())} candidates above 0.5")
+            if args.out_dir:
+                name = os.path.basename(img_path).split(".nii")[0]
+                nib.save(nib.Nifti1Image(prob.cpu().numpy().astype(np.float32), nib.load(img_path).affine),
+                         os.path.join(args.out_dir, f"{name}_cand_prob.nii.gz"))
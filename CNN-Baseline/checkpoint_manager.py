@@ -0,0 +1,189 @@
+import os
+import queue
+import hashlib
+import threading
+import collections
+import torch
+
+
+def snapshot(obj):
+    """
+    Copy of a (nested) checkpoint with every tensor detached and cloned to host
+    memory, so the training thread can keep updating the originals while the copy
+    is serialized. Dicts (of the same type), lists and tuples are rebuilt, other
+    leaves are shared.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        copy = type(obj)((k, snapshot(v)) for k, v in obj.items())
+        if hasattr(obj, "_metadata"):
+            # module state dicts carry per-module versions used by load_state_dict
+            copy._metadata = obj._metadata
+        return copy
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def content_digest(obj):
+    """Digest of the keys, tensor metadata and bytes, and other leaves' repr of a snapshot."""
+    h = hashlib.blake2b(digest_size=16)
+
+    def visit(o):
+        if torch.is_tensor(o):
+            h.update(f"T{o.dtype}{tuple(o.shape)}".encode())
+            h.update(o.contiguous().reshape(-1).view(torch.uint8).numpy().tobytes() if o.numel() else b"")
+        elif isinstance(o, dict):
+            h.update(b"{")
+            for k, v in o.items():
+                h.update(repr(k).encode())
+                visit(v)
+            h.update(b"}")
+        elif isinstance(o, (list, tuple)):
+            h.update(b"[")
+            for v in o:
+                visit(v)
+            h.update(b"]")
+        else:
+            h.update(repr(o).encode())
+
+    visit(obj)
+    return h.hexdigest()
+
+
+class CheckpointManager(object):
+    """
+    Checkpoint writes off the training thread.
+
+    `save` snapshots the state to host memory (the only work done by the caller)
+    and queues it; a single background thread serializes it to a temporary file in
+    the target directory, fsyncs it and renames it over the target, so a crash never
+    leaves a truncated checkpoint behind. A state whose content is identical to a
+    file already written by this manager (e.g. `_bestLoss.pt` and `_bestDICE.pt` from
+    the same epoch) is hardlinked to it instead of being serialized again.
+
+    With `keep_last` > 0, states saved with `rotate_as` are also kept under that name
+    and only the `keep_last` most recent of them remain on disk; the other names of
+    the save are hardlinks to the rotated file.
+
+    At most `max_pending` snapshots wait in the queue, `save` blocks beyond that so
+    host memory stays bounded. A failed write is raised by the next `save`, `wait`
+    or `close`.
+
+    Args:
+        save_dir (str): directory of the checkpoints
+        keep_last (int): number of rotated checkpoints kept, 0 disables the rotation
+        max_pending (int): queued snapshots before `save` blocks
+        async_write (bool): False writes on the calling thread (same files, no thread)
+    """
+
+    def __init__(self, save_dir, keep_last=0, max_pending=2, async_write=True):
+        self.save_dir = save_dir
+        self.keep_last = keep_last
+        self.async_write = async_write
+        self.rotated = collections.deque()
+        self.digests = {}  # path -> digest of the content this manager wrote there
+        self._error = None
+        self._queue = queue.Queue(maxsize=max(max_pending, 1))
+        self._thread = None
+        if async_write:
+            self._thread = threading.Thread(target=self._worker, name="checkpoint-writer", daemon=True)
+            self._thread.start()
+
+    def save(self, state, names, rotate_as=None):
+        """
+        Args:
+            state: checkpoint object (state dict or dict of them), snapshot before returning
+            names (str or list): file name(s) in `save_dir` that receive this state
+            rotate_as (str): file name of the rotated copy, used with keep_last > 0
+        """
+        self._raise_error()
+        names = [names] if isinstance(names, str) else list(names)
+        if rotate_as is not None and self.keep_last > 0:
+            names = [rotate_as] + names
+        job = (snapshot(state), [os.path.join(self.save_dir, n) for n in names],
+               rotate_as is not None and self.keep_last > 0)
+        if self.async_write:
+            self._queue.put(job)
+        else:
+            self._write(*job)
+
+    def wait(self):
+        """Block until every queued checkpoint is on disk."""
+        if self.async_write:
+            self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        self.wait()
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("checkpoint write failed") from error
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                self._write(*job)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _write(self, state, paths, rotated):
+        digest = content_digest(state)
+        source = next((p for p, d in self.digests.items() if d == digest and p not in paths and os.path.exists(p)), None)
+        for path in paths:
+            if source is None:
+                self._atomic_save(state, path)
+                source = path
+            else:
+                self._atomic_link(source, path)
+            self.digests[path] = digest
+        if rotated:
+            self._rotate(paths[0])
+
+    def _atomic_save(self, state, path):
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        with open(tmp_path, "wb") as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _atomic_link(self, source, path):
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        try:
+            os.link(source, tmp_path)
+        except OSError:
+            # no hardlinks on this filesystem, fall back to a copy
+            with open(source, "rb") as src, open(tmp_path, "wb") as dst:
+                while True:
+                    chunk = src.read(1 << 24)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                dst.flush()
+                os.fsync(dst.fileno())
+        os.replace(tmp_path, path)
+
+    def _rotate(self, path):
+        if path in self.rotated:
+            self.rotated.remove(path)
+        self.rotated.append(path)
+        while len(self.rotated) > self.keep_last:
+            old = self.rotated.popleft()
+            self.digests.pop(old, None)
+            if os.path.exists(old):
+                os.remove(old)
@@ -0,0 +1,149 @@
+import os
+import argparse
+import h5py
+import numpy as np
+import nibabel as nib
+import pandas as pd
+from volume_cache import load_nifti_image, load_nifti_mask
+
+
+def compression_kwargs(compression, level=None):
+    """
+    Translate a compression name into h5py `create_dataset` keyword arguments.
+    gzip and lzf ship with h5py, lz4 and zstd need the optional `hdf5plugin` package.
+    """
+    if compression in [None, "none"]:
+        return {}
+    if compression == "gzip":
+        return {"compression": "gzip", "compression_opts": 4 if level is None else level}
+    if compression == "lzf":
+        return {"compression": "lzf"}
+    if compression in ["lz4", "zstd"]:
+        try:
+            import hdf5plugin
+        except ImportError:
+            raise ImportError(f"'{compression}' compression requires the hdf5plugin package (pip install hdf5plugin)")
+        if compression == "lz4":
+            return dict(hdf5plugin.LZ4())
+        return dict(hdf5plugin.Zstd() if level is None else hdf5plugin.Zstd(clevel=level))
+    raise ValueError(f"Unsupported compression: {compression}")
+
+
+def convert_split(data_path, mode, out_path, chunks=(64, 64, 48), compression="lz4", level=None,
+                  image_dtype="float32"):
+    """
+    Rewrite every volume listed in `{mode}.csv` into a single chunked HDF5 store.
+
+    Each CSV row becomes a group '00000', '00001', ... (kept in CSV order) holding
+    an 'image' dataset, already normalized to [0, 1], and a uint8 'mask' dataset.
+    Both are chunked with `chunks`, so that a sub-volume aligned to the chunk grid
+    is read by decompressing exactly one chunk.
+
+    Args:
+        data_path (str): directory holding the CSVs and the NIfTI files
+        mode (str): 'train', 'val' or 'test'
+        out_path (str): output .h5 file
+        chunks (tuple): chunk shape, should match the sub_size used for patches
+        compression (str): 'none', 'gzip', 'lzf', 'lz4' or 'zstd'
+        level (int): optional compression level
+        image_dtype (str): 'float32' or 'float16'
+    """
+    df_data = pd.read_csv(os.path.join(data_path, f"{mode}.csv"))
+    records = df_data.to_dict("records")
+    comp = compression_kwargs(compression, level)
+
+    tmp_path = out_path + ".tmp"
+    with h5py.File(tmp_path, "w") as f:
+        f.attrs["chunks"] = np.asarray(chunks)
+        f.attrs["compression"] = str(compression)
+        f.attrs["mode"] = mode
+        f.attrs["columns"] = list(df_data.columns)
+        for i, cur_item in enumerate(records):
+            img_path = os.path.join(data_path, cur_item["MRI_file_path"])
+            mask_path = os.path.join(data_path, cur_item["GT_mask_path"])
+
+            image = load_nifti_image(img_path).astype(image_dtype)
+            mask = load_nifti_mask(mask_path).astype(np.uint8)
+            assert image.shape == mask.shape, f"Image/mask shape mismatch for {img_path}"
+            vol_chunks = tuple(min(c, s) for c, s in zip(chunks, image.shape))
+
+            grp = f.create_group(f"{i:05d}")
+            for key, value in cur_item.items():
+                grp.attrs[key] = str(value)
+            grp.attrs["affine"] = nib.load(img_path).affine
+            grp.create_dataset("image", data=image, chunks=vol_chunks, **comp)
+            grp.create_dataset("mask", data=mask, chunks=vol_chunks, **comp)
+            print(f"[{mode}] {i+1}/{len(records)} {cur_item['MRI_file_path']} -> {grp.name}")
+    os.replace(tmp_path, out_path)
+
+
+class ChunkedVolumeStore(object):
+    """
+    Read-only access to a store written by `convert_split`.
+
+    The HDF5 file is opened lazily and re-opened after a fork, so one instance can
+    be shared by a Dataset across DataLoader workers. `region` arguments are tuples
+    of slices; only the chunks intersecting the region are decompressed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._pid = None
+        with h5py.File(self.path, "r") as f:
+            self.keys = sorted(f.keys())
+            self.chunks = tuple(int(c) for c in f.attrs["chunks"])
+            columns = [str(c) for c in f.attrs["columns"]]
+            self.records = [{c: str(f[k].attrs[c]) for c in columns} for k in self.keys]
+            self.shapes = [tuple(f[k]["image"].shape) for k in self.keys]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getstate__(self):
+        # h5py handles cannot be pickled into worker processes
+        state = self.__dict__.copy()
+        state["_file"] = None
+        state["_pid"] = None
+        return state
+
+    @property
+    def file(self):
+        if self._file is None or self._pid != os.getpid():
+            self._file = h5py.File(self.path, "r")
+            self._pid = os.getpid()
+        return self._file
+
+    def shape(self, index):
+        return self.shapes[index]
+
+    def affine(self, index):
+        return np.asarray(self.file[self.keys[index]].attrs["affine"])
+
+    def read_image(self, index, region=None):
+        dset = self.file[self.keys[index]]["image"]
+        return dset[()] if region is None else dset[region]
+
+    def read_mask(self, index, region=None):
+        dset = self.file[self.keys[index]]["mask"]
+        return dset[()] if region is None else dset[region]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert train/val/test NIfTI manifests into chunked HDF5 stores')
+
+    parser.add_argument('--data_path', type=str, required=True, help='directory with train.csv, val.csv, test.csv')
+    parser.add_argument('--out_path', type=str, default=None, help='output directory, defaults to <data_path>/chunked')
+    parser.add_argument('--modes', type=str, nargs='+', default=['train', 'val', 'test'])
+    parser.add_argument('--chunks', type=int, nargs=3, default=[64, 64, 48], help='chunk shape, match sub_size')
+    parser.add_argument('--compression', type=str, default='lz4', choices=['none', 'gzip', 'lzf', 'lz4', 'zstd'])
+    parser.add_argument('--level', type=int, default=None, help='compression level (gzip/zstd)')
+    parser.add_argument('--image_dtype', type=str, default='float32', choices=['float32', 'float16'])
+
+    args = parser.parse_args()
+    out_path = args.out_path or os.path.join(args.data_path, 'chunked')
+    os.makedirs(out_path, exist_ok=True)
+
+    for mode in args.modes:
+        convert_split(args.data_path, mode, os.path.join(out_path, f"{mode}.h5"), chunks=tuple(args.chunks),
+                      compression=args.compression, level=args.level, image_dtype=args.image_dtype)
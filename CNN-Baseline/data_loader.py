@@ -1,5 +1,6 @@
 import os
 import pickle
+import functools
 from PIL import Image
 import numpy as np
 import torch
@@ -9,34 +10,134 @@ import pdb
 import torch.nn.functional as F
 import nibabel as nib
 import pandas as pd
+from volume_cache import VolumeCache, load_nifti_image, load_nifti_mask, source_key
+from chunked_store import ChunkedVolumeStore
+from lesion_index import ensure_lesion_index, crop_lesions
+from torch.utils.data.dataloader import default_collate
+from util import pin_dataloader_worker
+
+def make_volume_cache(args):
+      # decoded-volume cache is optional, disabled unless --cache_dir is given
+      cache_dir = getattr(args, "cache_dir", None)
+      if not cache_dir:
+            return None
+      return VolumeCache(cache_dir, image_dtype=getattr(args, "cache_dtype", "float32"))
+
+def make_volume_store(args, mode):
+      # chunked HDF5 backend written by chunked_store.py, replaces the NIfTI files if --store_path is given
+      store_path = getattr(args, "store_path", None)
+      if not store_path:
+            return None
+      return ChunkedVolumeStore(os.path.join(store_path, f"{mode}.h5"))
+
+def attach_lesion_index(args, *datasets):
+      # with --lesion_index every item also carries its lesion catalog entry (built once, stored next to the CSVs)
+      if not getattr(args, "lesion_index", False):
+            return None
+      for dataset in datasets:
+            dataset.lesion_index = ensure_lesion_index(dataset)
+      return collate_lesions
+
+def attach_intensity_ranges(*datasets):
+      # region reads of the NIfTI files normalize with the whole-volume (min, max); compute them once here,
+      # in the main process, so that the workers inherit them instead of each decoding every volume
+      for dataset in datasets:
+            if dataset.reads_regions and dataset.store is None and dataset.cache is None:
+                  dataset.ensure_intensity_ranges()
+
+def make_worker_init(args):
+      # on CPU runs the workers are pinned to the cores left free by util.setup_cpu_threads
+      worker_cpus = getattr(args, "worker_cpus", None)
+      if not worker_cpus:
+            return None
+      return functools.partial(pin_dataloader_worker, cpus=worker_cpus)
+
+def collate_lesions(batch):
+      # lesion entries have a different number of voxels per item, keep them as a list
+      collated = default_collate([item[:4] for item in batch])
+      return collated + [[item[4] for item in batch]]
 
 def paired_loader(args):
-      train_dataset = MRIDataset(args.data_path, mode="train")
-      val_dataset = MRIDataset(args.data_path, mode="val")
-      test_dataset = MRIDataset(args.data_path, mode="test")
+      cache = make_volume_cache(args)
+      train_dataset = MRIDataset(args.data_path, mode="train", cache=cache, store=make_volume_store(args, "train"))
+      val_dataset = MRIDataset(args.data_path, mode="val", cache=cache, store=make_volume_store(args, "val"))
+      test_dataset = MRIDataset(args.data_path, mode="test", cache=cache, store=make_volume_store(args, "test"))
 
       print("===> Total size of paired train set " + str(len(train_dataset)))
       print("===> Total size of paired test set " + str(len(test_dataset)))
+      collate_fn = attach_lesion_index(args, train_dataset, val_dataset, test_dataset)
+      attach_intensity_ranges(train_dataset, val_dataset, test_dataset)
+      worker_init = make_worker_init(args)
 
-      train_data_loader = torch.utils.data.DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, num_workers=args.n_workers, drop_last=True)
-      val_data_loader = torch.utils.data.DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.n_workers, drop_last=False)
+      train_data_loader = torch.utils.data.DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, num_workers=args.n_workers, drop_last=True, collate_fn=collate_fn, worker_init_fn=worker_init)
+      val_data_loader = torch.utils.data.DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.n_workers, drop_last=False, collate_fn=collate_fn, worker_init_fn=worker_init)
 
-      test_data_loader = torch.utils.data.DataLoader(test_dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.n_workers, drop_last=False)
+      test_data_loader = torch.utils.data.DataLoader(test_dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.n_workers, drop_last=False, collate_fn=collate_fn, worker_init_fn=worker_init)
 
       return train_data_loader, val_data_loader, test_data_loader
 
 def paired_loader_patch(args):
-      train_dataset = MRIDatasetSub(args.data_path, mode="train")
-      val_dataset = MRIDatasetSub(args.data_path, mode="val")
-      test_dataset = MRIDatasetSub(args.data_path, mode="test")
+      cache = make_volume_cache(args)
+      train_dataset = MRIDatasetSub(args.data_path, mode="train", cache=cache, store=make_volume_store(args, "train"))
+      val_dataset = MRIDatasetSub(args.data_path, mode="val", cache=cache, store=make_volume_store(args, "val"))
+      test_dataset = MRIDatasetSub(args.data_path, mode="test", cache=cache, store=make_volume_store(args, "test"))
 
       print("===> Total size of paired train set " + str(len(train_dataset)))
       print("===> Total size of paired test set " + str(len(test_dataset)))
+      collate_fn = attach_lesion_index(args, train_dataset, val_dataset, test_dataset)
+      attach_intensity_ranges(train_dataset, val_dataset, test_dataset)
+      worker_init = make_worker_init(args)
 
-      train_data_loader = torch.utils.data.DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, num_workers=args.n_workers, drop_last=True)
-      val_data_loader = torch.utils.data.DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.n_workers, drop_last=False)
+      train_data_loader = torch.utils.data.DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, num_workers=args.n_workers, drop_last=True, collate_fn=collate_fn, worker_init_fn=worker_init)
+      val_data_loader = torch.utils.data.DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.n_workers, drop_last=False, collate_fn=collate_fn, worker_init_fn=worker_init)
 
-      test_data_loader = torch.utils.data.DataLoader(test_dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.n_workers, drop_last=False)
+      test_data_loader = torch.utils.data.DataLoader(test_dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.n_workers, drop_last=False, collate_fn=collate_fn, worker_init_fn=worker_init)
+
+      return train_data_loader, val_data_loader, test_data_loader
+
+def paired_loader_patch_items(args):
+      # one item per (subject, patch), minibatches of --patch_batch_size patches drawn across subjects
+      cache = make_volume_cache(args)
+      train_dataset = MRIPatchDataset(args.data_path, mode="train", cache=cache, store=make_volume_store(args, "train"))
+      val_dataset = MRIPatchDataset(args.data_path, mode="val", cache=cache, store=make_volume_store(args, "val"))
+      test_dataset = MRIPatchDataset(args.data_path, mode="test", cache=cache, store=make_volume_store(args, "test"))
+
+      print("===> Total size of paired train set " + str(len(train_dataset)) + " patches")
+      print("===> Total size of paired test set " + str(len(test_dataset)) + " patches")
+      collate_fn = attach_lesion_index(args, train_dataset, val_dataset, test_dataset)
+      attach_intensity_ranges(train_dataset, val_dataset, test_dataset)
+      worker_init = make_worker_init(args)
+
+      train_sampler = PatchBatchSampler(train_dataset, args.patch_batch_size, shuffle=True, drop_last=True)
+      val_sampler = PatchBatchSampler(val_dataset, args.patch_batch_size, shuffle=False, drop_last=False)
+      test_sampler = PatchBatchSampler(test_dataset, args.patch_batch_size, shuffle=False, drop_last=False)
+
+      train_data_loader = torch.utils.data.DataLoader(train_dataset, batch_sampler=train_sampler, num_workers=args.n_workers, collate_fn=collate_fn, worker_init_fn=worker_init)
+      val_data_loader = torch.utils.data.DataLoader(val_dataset, batch_sampler=val_sampler, num_workers=args.n_workers, collate_fn=collate_fn, worker_init_fn=worker_init)
+
+      test_data_loader = torch.utils.data.DataLoader(test_dataset, batch_sampler=test_sampler, num_workers=args.n_workers, collate_fn=collate_fn, worker_init_fn=worker_init)
+
+      return train_data_loader, val_data_loader, test_data_loader
+
+def paired_loader_crop(args):
+      # random lesion-centred / background crops for training, whole volumes one at a time for val/test
+      cache = make_volume_cache(args)
+      train_dataset = MRICropDataset(args.data_path, mode="train", crop_size=tuple(args.crop_size),
+                                     pos_fraction=args.crop_pos_fraction, crops_per_volume=args.crops_per_volume,
+                                     cache=cache, store=make_volume_store(args, "train"))
+      val_dataset = MRIDataset(args.data_path, mode="val", cache=cache, store=make_volume_store(args, "val"))
+      test_dataset = MRIDataset(args.data_path, mode="test", cache=cache, store=make_volume_store(args, "test"))
+
+      print("===> Total size of paired train set " + str(len(train_dataset)) + " crops")
+      print("===> Total size of paired test set " + str(len(test_dataset)))
+      collate_fn = attach_lesion_index(args, train_dataset, val_dataset, test_dataset)
+      attach_intensity_ranges(train_dataset, val_dataset, test_dataset)
+      worker_init = make_worker_init(args)
+
+      train_data_loader = torch.utils.data.DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, num_workers=args.n_workers, drop_last=True, collate_fn=collate_fn, worker_init_fn=worker_init)
+      val_data_loader = torch.utils.data.DataLoader(val_dataset, batch_size=1, shuffle=False, num_workers=args.n_workers, drop_last=False, collate_fn=collate_fn, worker_init_fn=worker_init)
+
+      test_data_loader = torch.utils.data.DataLoader(test_dataset, batch_size=1, shuffle=False, num_workers=args.n_workers, drop_last=False, collate_fn=collate_fn, worker_init_fn=worker_init)
 
       return train_data_loader, val_data_loader, test_data_loader
 
@@ -114,95 +215,363 @@ def divide_into_subvolumes(x, subvolume_size):
         raise ValueError(f"Unsupported input shape: {x.shape}. Expected 4D or 5D tensor.")
 
 
+def subvolume_grid(shape, subvolume_size):
+    """Number of sub-volumes along each axis, remainders are dropped as in `divide_into_subvolumes`."""
+    return tuple(s // d for s, d in zip(shape[-3:], subvolume_size))
+
+
+def subvolume_region(shape, subvolume_size, patch_id):
+    """
+    Slices of sub-volume `patch_id` within a volume of spatial `shape`, using the
+    row-major (d, h, w) ordering produced by `divide_into_subvolumes`.
+    """
+    grid = subvolume_grid(shape, subvolume_size)
+    pos = np.unravel_index(patch_id, grid)
+    return tuple(slice(p * d, (p + 1) * d) for p, d in zip(pos, subvolume_size))
+
+
 class MRIDataset(Dataset):
-    def __init__(self, data_path, mode="train", transform=None):
+    # subclasses reading sub-regions of the NIfTI files need the whole-volume intensity ranges
+    reads_regions = False
+
+    def __init__(self, data_path, mode="train", transform=None, cache=None, store=None, lesion_index=None):
         self.data_path = data_path
         self.mode = mode
         self.transform = transform
-
-        if mode == "train":
-            df_data = pd.read_csv(os.path.join(self.data_path, "train.csv"))
-        elif mode == "val":
-            df_data = pd.read_csv(os.path.join(self.data_path, "val.csv"))
-        elif mode == "test":
-            df_data = pd.read_csv(os.path.join(self.data_path, "test.csv"))
-        
-        self.pair_list = df_data.to_dict("records")
+        self.cache = cache
+        self.store = store
+        self.lesion_index = lesion_index
+
+        if store is not None:
+            # the store keeps the CSV rows in their original order
+            self.pair_list = store.records
+        else:
+            if mode == "train":
+                df_data = pd.read_csv(os.path.join(self.data_path, "train.csv"))
+            elif mode == "val":
+                df_data = pd.read_csv(os.path.join(self.data_path, "val.csv"))
+            elif mode == "test":
+                df_data = pd.read_csv(os.path.join(self.data_path, "test.csv"))
+
+            self.pair_list = df_data.to_dict("records")
+        self._intensity_range = {}
 
     def __len__(self):
         return len(self.pair_list)
 
+    def ensure_intensity_ranges(self, path=None):
+        """
+        Fill the (min, max) of every subject from `<data_path>/<mode>_intensity.npz`,
+        rebuilding the file first if it is missing or any image changed since it was
+        written. Called before the DataLoader starts so the workers get every range.
+        """
+        if path is None:
+            path = os.path.join(self.data_path, f"{self.mode}_intensity.npz")
+        keys = [source_key(os.path.join(self.data_path, item["MRI_file_path"])) for item in self.pair_list]
+        if os.path.exists(path):
+            with np.load(path) as data:
+                if list(data["source_keys"]) == keys:
+                    self._intensity_range = {i: (lo, hi) for i, (lo, hi) in enumerate(data["ranges"].tolist())}
+                    return
+            print(f"Intensity ranges {path} are stale, rebuilding...")
+        ranges = []
+        for i in range(len(self.pair_list)):
+            image = nib.load(os.path.join(self.data_path, self.pair_list[i]["MRI_file_path"])).get_fdata()
+            ranges.append((image.min(), image.max()))
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, source_keys=np.asarray(keys), ranges=np.asarray(ranges, dtype=np.float64).reshape(-1, 2))
+        os.replace(tmp_path, path)
+        self._intensity_range = dict(enumerate(ranges))
+
+    def intensity_range(self, index):
+        # (min, max) of the raw image, needed to normalize partial reads; see ensure_intensity_ranges
+        if index not in self._intensity_range:
+            img_path = os.path.join(self.data_path, self.pair_list[index]["MRI_file_path"])
+            image = nib.load(img_path).get_fdata()
+            self._intensity_range[index] = (image.min(), image.max())
+        return self._intensity_range[index]
+
+    def shape(self, index):
+        # spatial shape without decoding the voxel data
+        if self.store is not None:
+            return self.store.shape(index)
+        return nib.load(os.path.join(self.data_path, self.pair_list[index]["MRI_file_path"])).shape
+
+    def load_mask(self, index):
+        # mask only, used by the lesion indexing pass
+        if self.store is not None:
+            return self.store.read_mask(index)
+        mask_path = os.path.join(self.data_path, self.pair_list[index]["GT_mask_path"])
+        if self.cache is not None:
+            return self.cache.load_mask(mask_path)
+        return load_nifti_mask(mask_path)
+
+    def load_pair(self, index, region=None):
+        """
+        Load the image (normalized to 0-1) and mask of subject `index`.
+        With a chunked store only the chunks covering `region` (tuple of slices) are read, with the
+        cache only the mapped pages of the region are touched, otherwise the region is read through
+        nibabel's `dataobj` slicing.
+        """
+        if self.store is not None:
+            return self.store.read_image(index, region), self.store.read_mask(index, region)
+
+        cur_item = self.pair_list[index]
+        img_path = os.path.join(self.data_path, cur_item["MRI_file_path"])
+        mask_path = os.path.join(self.data_path, cur_item["GT_mask_path"])
+        if self.cache is not None:
+            return self.cache.load_pair(img_path, mask_path, region)
+        if region is None:
+            return load_nifti_image(img_path), load_nifti_mask(mask_path)
+
+        img_min, img_max = self.intensity_range(index)
+        image = np.asarray(nib.load(img_path).dataobj[region], dtype=np.float64)
+        image = (image - img_min)/(img_max - img_min)
+        mask = np.asarray(nib.load(mask_path).dataobj[region], dtype=np.float64)
+        return image, mask
+
     def __getitem__(self, index):
         cur_item = self.pair_list[index]
 
     	# load the data
         img_path = cur_item["MRI_file_path"]
-        mask_path = cur_item["GT_mask_path"]
         #hdog_path = cur_item["HDoG_file_path"]
         #cmb_label_vol = cur_item["CMB_label"]
         
-        image = nib.load(os.path.join(self.data_path, img_path)).get_fdata()
-        img_max, img_min = image.max(), image.min()
-        # normaliza image to 0-1 range
-        image = (image - img_min)/(img_max - img_min)
-        mask = nib.load(os.path.join(self.data_path, mask_path)).get_fdata()
+        image, mask = self.load_pair(index)
 
         if self.transform:
             image, mask = self.transform(image), self.transform(mask)
-        image = torch.tensor(image, dtype=torch.float32).unsqueeze(0)
-        mask = torch.tensor(mask, dtype=torch.float32).unsqueeze(0)
+        image = torch.as_tensor(image, dtype=torch.float32).unsqueeze(0)
+        mask = torch.as_tensor(mask, dtype=torch.float32).unsqueeze(0)
         cmb_label_vol = (mask.sum() > 0).long()
 
+        if self.lesion_index is not None:
+            return img_path, image, mask, cmb_label_vol, self.lesion_index.subject_tensors(index)
         return img_path, image, mask, cmb_label_vol
 
 
-class MRIDatasetSub(Dataset):
-    def __init__(self, data_path, mode="train", sub_size = (64, 64, 48), transform=None):
-        self.data_path = data_path
-        self.mode = mode
-        self.transform = transform
+class MRIDatasetSub(MRIDataset):
+    def __init__(self, data_path, mode="train", sub_size = (64, 64, 48), transform=None, cache=None, store=None,
+                 lesion_index=None):
+        super(MRIDatasetSub, self).__init__(data_path, mode=mode, transform=transform, cache=cache, store=store,
+                                            lesion_index=lesion_index)
         self.sub_size = sub_size
 
-        if mode == "train":
-            df_data = pd.read_csv(os.path.join(self.data_path, "train.csv"))
-        elif mode == "val":
-            df_data = pd.read_csv(os.path.join(self.data_path, "val.csv"))
-        elif mode == "test":
-            df_data = pd.read_csv(os.path.join(self.data_path, "test.csv"))
-        
-        self.pair_list = df_data.to_dict("records")
-
-    def __len__(self):
-        return len(self.pair_list)
+    def indexed_patch_flags(self, index):
+        # per-patch positive flags from the lesion catalog, None if they cannot be used for this item
+        if self.lesion_index is None or self.transform or self.lesion_index.sub_size != tuple(self.sub_size):
+            return None
+        return torch.from_numpy(self.lesion_index.subject(index)["patch_flags"]).float()
+
+    def read_subvolume(self, index, patch_id):
+        """
+        Read a single sub-volume of subject `index`, in the same order as `divide_into_subvolumes`.
+        On a chunked store aligned to `sub_size` this decompresses exactly one chunk.
+
+        Returns:
+            image (1, d, h, w), mask (1, d, h, w) float tensors
+        """
+        region = subvolume_region(self.shape(index), self.sub_size, patch_id)
+        image, mask = self.load_pair(index, region)
+        image = torch.as_tensor(image, dtype=torch.float32).unsqueeze(0)
+        mask = torch.as_tensor(mask, dtype=torch.float32).unsqueeze(0)
+        return image, mask
 
     def __getitem__(self, index):
         cur_item = self.pair_list[index]
 
     	# load the data
         img_path = cur_item["MRI_file_path"]
-        mask_path = cur_item["GT_mask_path"]
         #hdog_path = cur_item["HDoG_file_path"]
         #cmb_label_vol = cur_item["CMB_label"]
-        image = nib.load(os.path.join(self.data_path,img_path)).get_fdata()
+        # image is normalized to 0-1 by load_pair
+        image, mask = self.load_pair(index)
         #print("Shape of the raw data:"+str(image.shape))
-        mask = nib.load(os.path.join(self.data_path,mask_path)).get_fdata()
         #hdog = nib.load(os.path.join(self.data_path,hdog_path)).get_fdata()
 
-        # normalize image data to 0-1
-        image = (image - image.min())/(image.max() - image.min())
-
 
         if self.transform:
             image, mask = self.transform(image), self.transform(mask)
-        image = torch.tensor(image, dtype=torch.float32).unsqueeze(0)
+        image = torch.as_tensor(image, dtype=torch.float32).unsqueeze(0)
         image_subV = divide_into_subvolumes(image, self.sub_size)
         #hdog = torch.tensor(hdog, dtype=torch.float32).unsqueeze(0)
         #hdog_subV = divide_into_subvolumes(hdog, self.sub_size)
-        mask = torch.tensor(mask, dtype=torch.float32).unsqueeze(0)
+        mask = torch.as_tensor(mask, dtype=torch.float32).unsqueeze(0)
         mask_subV = divide_into_subvolumes(mask, self.sub_size)
 
         # Compute patch-level ground truth labels:
         # Label = 1 if any voxel in the mask patch is positive, else 0.
-        patch_labels = (mask_subV.view(mask_subV.size(0), -1).sum(dim=1) > 0).float()
+        patch_labels = self.indexed_patch_flags(index)
+        if patch_labels is None:
+            patch_labels = (mask_subV.view(mask_subV.size(0), -1).sum(dim=1) > 0).float()
 
+        if self.lesion_index is not None:
+            return img_path, image_subV, mask_subV, patch_labels, self.lesion_index.subject_tensors(index)
         return img_path, image_subV, mask_subV, patch_labels
+
+
+class MRIPatchDataset(MRIDatasetSub):
+    """
+    Sub-volume dataset indexed by (subject, patch_id) instead of by subject.
+
+    Only the region of the requested patch is read (see `MRIDataset.load_pair`), so an
+    item costs I/O and memory proportional to `sub_size`. Items have the same layout as
+    an `MRIDatasetSub` item holding a single patch, i.e. image/mask (1, d, h, w) and
+    patch label (1,), so batches of N patches look like N subjects with P=1.
+    """
+    reads_regions = True
+
+    def __init__(self, data_path, mode="train", sub_size = (64, 64, 48), transform=None, cache=None, store=None,
+                 lesion_index=None):
+        super(MRIPatchDataset, self).__init__(data_path, mode=mode, sub_size=sub_size, transform=transform,
+                                              cache=cache, store=store, lesion_index=lesion_index)
+        # flat (subject, patch_id) table, built from the headers only
+        num_patches = [int(np.prod(subvolume_grid(self.shape(i), self.sub_size))) for i in range(len(self.pair_list))]
+        self.patch_index = np.concatenate([np.stack([np.full(n, i), np.arange(n)], axis=1)
+                                           for i, n in enumerate(num_patches)]).astype(np.int64)
+        self.subject_offsets = np.concatenate([[0], np.cumsum(num_patches)])
+
+    def __len__(self):
+        return len(self.patch_index)
+
+    def __getitem__(self, index):
+        subject, patch_id = self.patch_index[index]
+        img_path = self.pair_list[subject]["MRI_file_path"]
+
+        image, mask = self.read_subvolume(subject, patch_id)
+        if self.transform:
+            image, mask = self.transform(image), self.transform(mask)
+
+        patch_flags = self.indexed_patch_flags(subject)
+        if patch_flags is not None:
+            patch_label = patch_flags[patch_id].view(1)
+        else:
+            patch_label = (mask.sum() > 0).float().view(1)
+
+        if self.lesion_index is not None:
+            region = subvolume_region(self.shape(subject), self.sub_size, patch_id)
+            lesions = crop_lesions(self.lesion_index.subject_tensors(subject), [r.start for r in region], self.sub_size)
+            return img_path, image, mask, patch_label, lesions
+        return img_path, image, mask, patch_label
+
+
+class MRICropDataset(MRIDataset):
+    """
+    Random fixed-size crops for training, `crops_per_volume` items per subject and epoch.
+
+    A fraction `pos_fraction` of the crops is centred (with a random jitter of up to a
+    quarter of the crop) on a lesion of the subject, the others are drawn uniformly and
+    rejected, up to `max_tries` times, while less than `min_brain_fraction` of the crop
+    is brain (normalized intensity above `brain_threshold`). Lesion centres come from the
+    lesion catalog if attached, else from the mask, once per subject and worker. Only
+    the crop region is read; crops reaching outside the volume are zero padded.
+    """
+
+    reads_regions = True
+
+    def __init__(self, data_path, mode="train", crop_size=(64, 64, 48), pos_fraction=0.5, crops_per_volume=4,
+                 brain_threshold=0.05, min_brain_fraction=0.1, max_tries=3, transform=None, cache=None, store=None,
+                 lesion_index=None):
+        super(MRICropDataset, self).__init__(data_path, mode=mode, transform=transform, cache=cache, store=store,
+                                             lesion_index=lesion_index)
+        self.crop_size = tuple(crop_size)
+        self.pos_fraction = pos_fraction
+        self.crops_per_volume = crops_per_volume
+        self.brain_threshold = brain_threshold
+        self.min_brain_fraction = min_brain_fraction
+        self.max_tries = max_tries
+        self._lesion_centres = {}
+
+    def __len__(self):
+        return len(self.pair_list) * self.crops_per_volume
+
+    def lesion_centres(self, index):
+        # (K, 3) float array of lesion centres, voxel centres if no catalog is attached
+        if self.lesion_index is not None:
+            return self.lesion_index.subject(index)["centroids"]
+        if index not in self._lesion_centres:
+            self._lesion_centres[index] = np.argwhere(np.asarray(self.load_mask(index)) > 0).astype(np.float32)
+        return self._lesion_centres[index]
+
+    def crop_origin(self, shape, centre=None):
+        # crop origin for a given centre (or a uniform random one), kept inside the volume where possible
+        origin = []
+        for k in range(3):
+            high = max(shape[k] - self.crop_size[k], 0)
+            if centre is None:
+                o = int(torch.randint(0, high + 1, (1,)))
+            else:
+                jitter = int(torch.randint(-(self.crop_size[k] // 4), self.crop_size[k] // 4 + 1, (1,)))
+                o = int(round(float(centre[k]))) - self.crop_size[k] // 2 + jitter
+            origin.append(min(max(o, 0), high))
+        return origin
+
+    def read_crop(self, index, origin, shape):
+        region = tuple(slice(o, min(o + c, s)) for o, c, s in zip(origin, self.crop_size, shape))
+        image, mask = self.load_pair(index, region)
+        image = torch.as_tensor(image, dtype=torch.float32)
+        mask = torch.as_tensor(mask, dtype=torch.float32)
+        pad = []
+        for k in reversed(range(3)):
+            pad += [0, self.crop_size[k] - image.shape[k]]
+        if any(pad):
+            image, mask = F.pad(image, pad), F.pad(mask, pad)
+        return image, mask
+
+    def __getitem__(self, index):
+        subject = index // self.crops_per_volume
+        img_path = self.pair_list[subject]["MRI_file_path"]
+        shape = self.shape(subject)
+
+        centres = self.lesion_centres(subject)
+        if len(centres) > 0 and float(torch.rand(1)) < self.pos_fraction:
+            centre = centres[int(torch.randint(0, len(centres), (1,)))]
+            origin = self.crop_origin(shape, centre)
+            image, mask = self.read_crop(subject, origin, shape)
+        else:
+            for _ in range(self.max_tries):
+                origin = self.crop_origin(shape)
+                image, mask = self.read_crop(subject, origin, shape)
+                if (image > self.brain_threshold).float().mean() >= self.min_brain_fraction:
+                    break
+
+        if self.transform:
+            image, mask = self.transform(image), self.transform(mask)
+        image = image.unsqueeze(0)
+        mask = mask.unsqueeze(0)
+        cmb_label_vol = (mask.sum() > 0).long()
+
+        if self.lesion_index is not None:
+            lesions = crop_lesions(self.lesion_index.subject_tensors(subject), origin, self.crop_size)
+            return img_path, image, mask, cmb_label_vol, lesions
+        return img_path, image, mask, cmb_label_vol
+
+
+class PatchBatchSampler(torch.utils.data.Sampler):
+    """
+    Yields fixed-size lists of `MRIPatchDataset` indices. With `shuffle` the patches of all
+    subjects are permuted together every epoch, so a minibatch mixes patches across subjects.
+    """
+
+    def __init__(self, dataset, batch_size, shuffle=True, drop_last=True):
+        self.num_items = len(dataset)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        if self.shuffle:
+            order = torch.randperm(self.num_items).tolist()
+        else:
+            order = list(range(self.num_items))
+        for start in range(0, self.num_items, self.batch_size):
+            batch = order[start:start + self.batch_size]
+            if len(batch) < self.batch_size and self.drop_last:
+                return
+            yield batch
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_items // self.batch_size
+        return (self.num_items + self.batch_size - 1) // self.batch_size
@@ -0,0 +1,258 @@
+import os
+import argparse
+import numpy as np
+import nibabel as nib
+import torch
+import torch.nn.functional as F
+
+
+def gaussian_importance_map(patch_size, sigma_scale=0.125, device=None, dtype=torch.float32):
+    """
+    Separable Gaussian weight over a patch, 1 at the centre, sigma = sigma_scale * size
+    per axis. Clamped away from zero so that every voxel of a tile contributes.
+
+    Args:
+        patch_size (tuple): (d, h, w)
+        sigma_scale (float): sigma relative to the patch size
+
+    Returns:
+        Tensor of shape (d, h, w)
+    """
+    weight = None
+    for size in patch_size:
+        x = torch.arange(size, device=device, dtype=torch.float64) - (size - 1) / 2
+        g = torch.exp(-0.5 * (x / (sigma_scale * size)) ** 2)
+        weight = g if weight is None else weight.unsqueeze(-1) * g
+    weight = weight / weight.max()
+    return weight.clamp(min=1e-3).to(dtype)
+
+
+def window_starts(size, patch, overlap):
+    """
+    Start positions of the tiles along one axis. Tiles are `patch` long, advance by
+    patch * (1 - overlap) and the last one is aligned to the end of the axis, so the
+    whole axis is covered whatever its size.
+    """
+    if size <= patch:
+        return [0]
+    step = max(int(round(patch * (1 - overlap))), 1)
+    starts = list(range(0, size - patch + 1, step))
+    if starts[-1] != size - patch:
+        starts.append(size - patch)
+    return starts
+
+
+def count_activation_bytes(model, sample):
+    """
+    Sum of the sizes of all module outputs for one forward pass of `sample`, an upper
+    bound on the activation memory of a no-grad forward.
+    """
+    total = [0]
+
+    def hook(module, inputs, output):
+        outputs = output if isinstance(output, (tuple, list)) else [output]
+        for o in outputs:
+            if torch.is_tensor(o):
+                total[0] += o.numel() * o.element_size()
+
+    handles = [m.register_forward_hook(hook) for m in model.modules()]
+    try:
+        with torch.no_grad():
+            model(sample)
+    finally:
+        for h in handles:
+            h.remove()
+    return total[0]
+
+
+class SlidingWindowInferer(object):
+    """
+    Whole-volume inference with overlapping tiles.
+
+    The (padded) volume is covered by `patch_size` tiles overlapping by `overlap`,
+    tiles are run through the model `batch_size` at a time, weighted by a Gaussian
+    (or constant) importance map and accumulated into preallocated output and weight
+    buffers, which are normalized at the end. Volumes smaller than a tile are padded
+    and the result is cropped back to the input shape.
+
+    Every tensor output of the model with the tile's spatial shape is blended (e.g.
+    logits and decoder features of `AbstractUNet`), or only those listed in
+    `outputs`; the call returns the same structure as the model, a tensor or a tuple
+    with None for the outputs that are not blended.
+
+    Args:
+        patch_size (tuple): tile size (d, h, w)
+        overlap (float): fraction of a tile shared with its neighbour, in [0, 1)
+        batch_size (int): tiles per forward, 0 to derive it from `memory_budget_mb`
+        memory_budget_mb (float): activation memory allowed per forward, used with batch_size=0
+        blend (str): 'gaussian' or 'constant'
+        sigma_scale (float): Gaussian sigma relative to the tile size
+        padding_mode (str): F.pad mode used for volumes smaller than a tile
+        pad_value (float): value for padding_mode='constant'
+        accum_device: device of the output buffers, defaults to the input's
+        outputs (tuple): indices of the model outputs to blend, None for all
+    """
+
+    def __init__(self, patch_size=(64, 64, 48), overlap=0.5, batch_size=4, memory_budget_mb=0, blend="gaussian",
+                 sigma_scale=0.125, padding_mode="constant", pad_value=0.0, accum_device=None, outputs=None):
+        assert 0 <= overlap < 1, "overlap must be in [0, 1)"
+        assert blend in ["gaussian", "constant"], f"Unsupported blend mode: {blend}"
+        self.patch_size = tuple(patch_size)
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.memory_budget_mb = memory_budget_mb
+        self.blend = blend
+        self.sigma_scale = sigma_scale
+        self.padding_mode = padding_mode
+        self.pad_value = pad_value
+        self.accum_device = accum_device
+        self.outputs = outputs
+        self._weights = {}
+        self._tile_bytes = {}
+
+    def importance_map(self, device):
+        if device not in self._weights:
+            if self.blend == "gaussian":
+                self._weights[device] = gaussian_importance_map(self.patch_size, self.sigma_scale, device=device)
+            else:
+                self._weights[device] = torch.ones(self.patch_size, device=device)
+        return self._weights[device]
+
+    def tiles_per_forward(self, model, image):
+        if self.batch_size > 0:
+            return self.batch_size
+        if not self.memory_budget_mb:
+            return 1
+        # one measuring forward per model and input layout, not per volume
+        key = (id(model), image.device, image.dtype, image.shape[1], torch.is_autocast_enabled())
+        if key not in self._tile_bytes:
+            sample = image.new_zeros((1, image.shape[1]) + self.patch_size)
+            self._tile_bytes[key] = count_activation_bytes(model, sample)
+        return max(int(self.memory_budget_mb * 2 ** 20 // max(self._tile_bytes[key], 1)), 1)
+
+    def tiles(self, shape):
+        starts = [window_starts(s, p, self.overlap) for s, p in zip(shape, self.patch_size)]
+        return [(d, h, w) for d in starts[0] for h in starts[1] for w in starts[2]]
+
+    def __call__(self, model, image):
+        """
+        Args:
+            model: callable mapping (N, C, d, h, w) tiles to a tensor or a tuple of tensors
+            image (torch.Tensor): (B, C, D, H, W) volume
+
+        Returns:
+            model outputs for the whole volume, (B, C_out, D, H, W) per blended output
+        """
+        B, C = image.shape[:2]
+        shape = tuple(image.shape[2:])
+        pad = []
+        for s, p in reversed(list(zip(shape, self.patch_size))):
+            pad += [0, max(p - s, 0)]
+        if any(pad):
+            if self.padding_mode == "constant":
+                image = F.pad(image, pad, mode="constant", value=self.pad_value)
+            else:
+                image = F.pad(image, pad, mode=self.padding_mode)
+        padded_shape = tuple(image.shape[2:])
+
+        device = image.device
+        accum_device = self.accum_device or device
+        weight_map = self.importance_map(device)
+        accum_weight = weight_map.to(accum_device)
+        tiles = self.tiles(padded_shape)
+        n_batch = self.tiles_per_forward(model, image)
+        batch = image.new_empty((min(n_batch, len(tiles)), C) + self.patch_size)
+        d, h, w = self.patch_size
+
+        outputs, weight_sum, is_tuple = None, None, False
+        with torch.no_grad():
+            weight_sum = torch.zeros((1, 1) + padded_shape, device=accum_device)
+            for b in range(B):
+                for start in range(0, len(tiles), n_batch):
+                    chunk = tiles[start:start + n_batch]
+                    for k, (z, y, x) in enumerate(chunk):
+                        batch[k].copy_(image[b, :, z:z + d, y:y + h, x:x + w])
+                    pred = model(batch[:len(chunk)])
+                    is_tuple = isinstance(pred, (tuple, list))
+                    pred = list(pred) if is_tuple else [pred]
+                    if outputs is None:
+                        # preallocate one buffer per blended output, non-spatial outputs are dropped
+                        outputs = [torch.zeros((B, p.shape[1]) + padded_shape, device=accum_device, dtype=torch.float32)
+                                   if torch.is_tensor(p) and tuple(p.shape[2:]) == self.patch_size
+                                   and (self.outputs is None or i in self.outputs) else None
+                                   for i, p in enumerate(pred)]
+                    for k, (z, y, x) in enumerate(chunk):
+                        for out, p in zip(outputs, pred):
+                            if out is not None:
+                                out[b, :, z:z + d, y:y + h, x:x + w] += (p[k].float() * weight_map).to(accum_device)
+                        if b == 0:
+                            weight_sum[0, 0, z:z + d, y:y + h, x:x + w] += accum_weight
+
+            crop = (slice(None), slice(None)) + tuple(slice(0, s) for s in shape)
+            result = []
+            for out in outputs:
+                if out is None:
+                    result.append(None)
+                    continue
+                out /= weight_sum
+                result.append(out[crop])
+        return tuple(result) if is_tuple else result[0]
+
+
+def load_segmentation_model(weights, device):
+    # same network as solver_seg.Solver
+    from model import UNet3D
+    model = UNet3D(in_channels=1, out_channels=1, num_classes=2, final_sigmoid=False, f_maps=[16, 32, 64, 128],
+                   num_levels=4, is_segmentation=True).to(device)
+    state = torch.load(weights, map_location=device)
+    if isinstance(state, dict) and "model_state_dict" in state:
+        state = state["model_state_dict"]
+    model.load_state_dict(state)
+    model.eval()
+    return model
+
+
+if __name__ == '__main__':
+    from data_loader import MRIDataset
+    from util import resolve_device, autocast_context
+
+    parser = argparse.ArgumentParser(description='Sliding-window whole-volume CMB segmentation')
+
+    parser.add_argument('--data_path', type=str, required=True, help='directory with the split CSVs')
+    parser.add_argument('--mode', type=str, default='test')
+    parser.add_argument('--weights', type=str, required=True, help='state dict (e.g. *_bestDICE.pt) or *_latestEpoch.pt')
+    parser.add_argument('--out_dir', type=str, required=True)
+    parser.add_argument('--patch_size', type=int, nargs=3, default=[64, 64, 48])
+    parser.add_argument('--overlap', type=float, default=0.5)
+    parser.add_argument('--batch_size', type=int, default=4, help='tiles per forward, 0 = derive from --memory_budget_mb')
+    parser.add_argument('--memory_budget_mb', type=float, default=0)
+    parser.add_argument('--blend', type=str, default='gaussian', choices=['gaussian', 'constant'])
+    parser.add_argument('--threshold', type=float, default=0.1, help='probability threshold of the saved mask')
+    parser.add_argument('--device', type=str, default='auto')
+    parser.add_argument('--accum_cpu', action='store_true', help='accumulate the outputs in host memory')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'], help='autocast dtype of the tile forwards')
+
+    args = parser.parse_args()
+    device = resolve_device(args.device)
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    model = load_segmentation_model(args.weights, device)
+    inferer = SlidingWindowInferer(patch_size=tuple(args.patch_size), overlap=args.overlap, batch_size=args.batch_size,
+                                   memory_budget_mb=args.memory_budget_mb, blend=args.blend,
+                                   accum_device=torch.device("cpu") if args.accum_cpu else None, outputs=(0,))
+
+    dataset = MRIDataset(args.data_path, mode=args.mode)
+    for i in range(len(dataset)):
+        img_path = os.path.join(args.data_path, dataset.pair_list[i]["MRI_file_path"])
+        image, _ = dataset.load_pair(i)
+        image = torch.as_tensor(image, dtype=torch.float32)[None, None].to(device)
+        # only the logits are blended (accumulated in fp32), the decoder features are dropped
+        with autocast_context(device, args.precision):
+            logits = inferer(model, image)[0]
+        prob = torch.sigmoid(logits.float())[0, 0].cpu().numpy()
+
+        affine = nib.load(img_path).affine
+        name = os.path.basename(img_path).split(".nii")[0]
+        nib.save(nib.Nifti1Image(prob.astype(np.float32), affine), os.path.join(args.out_dir, f"{name}_prob.nii.gz"))
+        nib.save(nib.Nifti1Image((prob > args.threshold).astype(np.uint8), affine), os.path.join(args.out_dir, f"{name}_mask.nii.gz"))
+        print(f"[{args.mode}] {i+1}/{len(dataset)} {dataset.pair_list[i]['MRI_file_path']}")
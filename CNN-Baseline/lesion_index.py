@@ -0,0 +1,223 @@
+import os
+import argparse
+import numpy as np
+import torch
+from skimage import measure
+from volume_cache import source_key
+
+
+def index_mask(mask, sub_size=(64, 64, 48), connectivity=3):
+    """
+    Extract the sparse lesion description of one binary mask.
+
+    Args:
+        mask (np.ndarray): DxHxW mask, voxels > 0 are lesion
+        sub_size (tuple): sub-volume size used for the per-patch flags
+        connectivity (int): connectivity of `measure.label`, 3 -> 26-neighbourhood
+
+    Returns:
+        dict with
+            coords (N, 3) int16 lesion voxel coordinates in raster order
+            component_ids (N,) int32 1-based connected component of every voxel
+            centroids (K, 3) float32 per component
+            bboxes (K, 6) int16 per component, (d0, h0, w0, d1, h1, w1) with exclusive upper bounds
+            patch_flags (P,) bool, True if the sub-volume contains a lesion voxel
+    """
+    fg = np.asarray(mask) > 0
+    labels, num = measure.label(fg, background=0, connectivity=connectivity, return_num=True)
+    coords = np.argwhere(fg)
+    component_ids = labels[tuple(coords.T)].astype(np.int32)
+
+    counts = np.bincount(component_ids, minlength=num + 1)[1:]
+    centroids = np.stack([np.bincount(component_ids, weights=coords[:, k], minlength=num + 1)[1:]
+                          for k in range(3)], axis=1) / np.maximum(counts, 1)[:, None]
+
+    bboxes = np.zeros((num, 6), dtype=np.int64)
+    if num > 0:
+        order = np.argsort(component_ids, kind="stable")
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        sorted_coords = coords[order]
+        bboxes[:, :3] = np.minimum.reduceat(sorted_coords, starts, axis=0)
+        bboxes[:, 3:] = np.maximum.reduceat(sorted_coords, starts, axis=0) + 1
+
+    # same grid and ordering as data_loader.divide_into_subvolumes, remainders dropped
+    grid = tuple(s // d for s, d in zip(fg.shape, sub_size))
+    patch_flags = np.zeros(int(np.prod(grid)), dtype=bool)
+    pos = coords // np.asarray(sub_size)
+    inside = np.all(pos < np.asarray(grid), axis=1)
+    if inside.any():
+        patch_flags[np.ravel_multi_index(tuple(pos[inside].T), grid)] = True
+
+    return {"coords": coords.astype(np.int16),
+            "component_ids": component_ids,
+            "centroids": centroids.astype(np.float32),
+            "bboxes": bboxes.astype(np.int16),
+            "patch_flags": patch_flags}
+
+
+def _dataset_source_keys(dataset):
+    # one key per subject, changes whenever the mask source (or the store) is rewritten
+    if dataset.store is not None:
+        return [source_key(dataset.store.path, str(i)) for i in range(len(dataset.pair_list))]
+    return [source_key(os.path.join(dataset.data_path, item["GT_mask_path"])) for item in dataset.pair_list]
+
+
+def build_lesion_index(dataset, out_path, sub_size=(64, 64, 48), connectivity=3):
+    """
+    Run `index_mask` over every subject of an `MRIDataset` and write the result as a
+    single npz catalog. Per-subject arrays are concatenated and addressed through
+    `<name>_offsets` arrays of length S+1.
+    """
+    subjects = []
+    for i in range(len(dataset.pair_list)):
+        subjects.append(index_mask(dataset.load_mask(i), sub_size, connectivity))
+        print(f"[lesion index] {i+1}/{len(dataset.pair_list)} {dataset.pair_list[i]['MRI_file_path']}: "
+              f"{len(subjects[-1]['centroids'])} lesions")
+
+    def _pack(key):
+        arrays = [s[key] for s in subjects]
+        offsets = np.concatenate([[0], np.cumsum([len(a) for a in arrays])]).astype(np.int64)
+        return np.concatenate(arrays, axis=0), offsets
+
+    coords, coord_offsets = _pack("coords")
+    component_ids, _ = _pack("component_ids")
+    centroids, lesion_offsets = _pack("centroids")
+    bboxes, _ = _pack("bboxes")
+    patch_flags, patch_offsets = _pack("patch_flags")
+
+    tmp_path = out_path + ".tmp.npz"
+    np.savez_compressed(tmp_path,
+                        fnames=np.asarray([item["MRI_file_path"] for item in dataset.pair_list]),
+                        source_keys=np.asarray(_dataset_source_keys(dataset)),
+                        sub_size=np.asarray(sub_size), connectivity=connectivity,
+                        coords=coords, coord_offsets=coord_offsets, component_ids=component_ids,
+                        centroids=centroids, bboxes=bboxes, lesion_offsets=lesion_offsets,
+                        patch_flags=patch_flags, patch_offsets=patch_offsets)
+    os.replace(tmp_path, out_path)
+    return LesionIndex(out_path)
+
+
+class LesionIndex(object):
+    """
+    Read access to a catalog written by `build_lesion_index`. The whole catalog is
+    loaded in memory, it is a few bytes per lesion voxel.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with np.load(path) as data:
+            self.data = {k: data[k] for k in data.files}
+        self.sub_size = tuple(int(s) for s in self.data["sub_size"])
+
+    def __len__(self):
+        return len(self.data["fnames"])
+
+    def _slice(self, key, offsets, index):
+        offsets = self.data[offsets]
+        return self.data[key][offsets[index]:offsets[index + 1]]
+
+    def subject(self, index):
+        """Returns the lesion description of subject `index` as a dict of numpy arrays."""
+        return {"coords": self._slice("coords", "coord_offsets", index),
+                "component_ids": self._slice("component_ids", "coord_offsets", index),
+                "centroids": self._slice("centroids", "lesion_offsets", index),
+                "bboxes": self._slice("bboxes", "lesion_offsets", index),
+                "patch_flags": self._slice("patch_flags", "patch_offsets", index)}
+
+    def subject_tensors(self, index):
+        """Same as `subject` with coordinates/ids as LongTensors, as returned by the datasets."""
+        subject = self.subject(index)
+        return {"coords": torch.from_numpy(subject["coords"].astype(np.int64)),
+                "component_ids": torch.from_numpy(subject["component_ids"].astype(np.int64)),
+                "centroids": torch.from_numpy(subject["centroids"]),
+                "bboxes": torch.from_numpy(subject["bboxes"].astype(np.int64))}
+
+    def is_current(self, dataset):
+        return list(self.data["source_keys"]) == _dataset_source_keys(dataset)
+
+
+def ensure_lesion_index(dataset, path=None, sub_size=(64, 64, 48), connectivity=3):
+    """
+    Load the catalog next to the CSVs (`<data_path>/<mode>_lesions.npz`), building it
+    first if it is missing or any mask changed since it was written.
+    """
+    if path is None:
+        path = os.path.join(dataset.data_path, f"{dataset.mode}_lesions.npz")
+    if os.path.exists(path):
+        index = LesionIndex(path)
+        if index.is_current(dataset) and index.sub_size == tuple(sub_size):
+            return index
+        print(f"Lesion index {path} is stale, rebuilding...")
+    return build_lesion_index(dataset, path, sub_size=sub_size, connectivity=connectivity)
+
+
+def crop_lesions(lesions, origin, size):
+    """
+    Restrict a `LesionIndex.subject_tensors` entry to the box starting at `origin` with
+    extent `size`, and express it in the coordinates of that box. Components keep their
+    ids; centroids are kept for components with at least one voxel inside the box and
+    bounding boxes are clipped to it.
+    """
+    origin = torch.as_tensor(origin, dtype=torch.long)
+    size = torch.as_tensor(size, dtype=torch.long)
+    coords = lesions["coords"] - origin
+    inside = ((coords >= 0) & (coords < size)).all(dim=1)
+    component_ids = lesions["component_ids"][inside]
+
+    keep = torch.zeros(len(lesions["centroids"]), dtype=torch.bool)
+    keep[component_ids - 1] = True
+    bboxes = lesions["bboxes"][keep] - origin.repeat(2)
+    bboxes = torch.max(torch.min(bboxes, size.repeat(2)), torch.zeros_like(bboxes))
+    return {"coords": coords[inside],
+            "component_ids": component_ids,
+            "centroids": lesions["centroids"][keep] - origin.float(),
+            "bboxes": bboxes}
+
+
+def positive_coords(lesions, device=None):
+    """
+    Stack the per-item `coords` of a collated batch into the (b, c, d, h, w) layout of
+    `torch.nonzero(gt_mask == 1)` on a (B, 1, D, H, W) mask.
+    """
+    coords = []
+    for b, lesion in enumerate(lesions):
+        c = lesion["coords"]
+        prefix = torch.tensor([b, 0], dtype=torch.long).expand(c.size(0), 2)
+        coords.append(torch.cat([prefix, c.long()], dim=1))
+    coords = torch.cat(coords, dim=0) if coords else torch.zeros((0, 5), dtype=torch.long)
+    return coords.to(device) if device is not None else coords
+
+
+def positive_components(lesions, device=None):
+    """
+    Component id of every row of `positive_coords(lesions)`, made unique across the
+    items of the batch.
+    """
+    ids, offset = [], 0
+    for lesion in lesions:
+        component_ids = lesion["component_ids"].long()
+        ids.append(component_ids + offset)
+        # cropped entries keep the subject's numbering, so offset by the largest id
+        offset += int(component_ids.max()) + 1 if len(component_ids) > 0 else 0
+    ids = torch.cat(ids) if ids else torch.zeros(0, dtype=torch.long)
+    return ids.to(device) if device is not None else ids
+
+
+if __name__ == '__main__':
+    from data_loader import MRIDataset
+    from chunked_store import ChunkedVolumeStore
+
+    parser = argparse.ArgumentParser(description='Build the per-split lesion coordinate catalogs')
+
+    parser.add_argument('--data_path', type=str, required=True, help='directory with train.csv, val.csv, test.csv')
+    parser.add_argument('--store_path', type=str, default=None, help='read the masks from the chunked stores instead')
+    parser.add_argument('--modes', type=str, nargs='+', default=['train', 'val', 'test'])
+    parser.add_argument('--sub_size', type=int, nargs=3, default=[64, 64, 48])
+    parser.add_argument('--connectivity', type=int, default=3, choices=[1, 2, 3])
+
+    args = parser.parse_args()
+    for mode in args.modes:
+        store = ChunkedVolumeStore(os.path.join(args.store_path, f"{mode}.h5")) if args.store_path else None
+        dataset = MRIDataset(args.data_path, mode=mode, store=store)
+        build_lesion_index(dataset, os.path.join(args.data_path, f"{mode}_lesions.npz"),
+                           sub_size=tuple(args.sub_size), connectivity=args.connectivity)
@@ -0,0 +1,240 @@
+import numpy as np
+from scipy.spatial import cKDTree
+from skimage import measure
+
+
+def lesion_components(mask, prob=None, connectivity=3):
+    """
+    Connected components of a binary mask with their geometry.
+
+    Args:
+        mask (np.ndarray): DxHxW, voxels > 0 are lesion
+        prob (np.ndarray): optional DxHxW probabilities, the score of a component is its maximum
+        connectivity (int): connectivity of `measure.label`, 3 -> 26-neighbourhood
+
+    Returns:
+        dict with
+            centroids (K, 3) float64
+            bboxes (K, 6) int64, (d0, h0, w0, d1, h1, w1) with exclusive upper bounds
+            sizes (K,) int64 voxel counts
+            scores (K,) float64, 1 without `prob`
+    """
+    labels, num = measure.label(np.asarray(mask) > 0, background=0, connectivity=connectivity, return_num=True)
+    flat = labels.ravel()
+    nz = np.flatnonzero(flat)
+    ids = flat[nz]
+    coords = np.stack(np.unravel_index(nz, labels.shape), axis=1)
+
+    sizes = np.bincount(ids, minlength=num + 1)[1:]
+    centroids = np.stack([np.bincount(ids, weights=coords[:, k], minlength=num + 1)[1:] for k in range(3)],
+                         axis=1) / np.maximum(sizes, 1)[:, None]
+    bboxes = np.zeros((num, 6), dtype=np.int64)
+    scores = np.ones(num)
+    if num > 0:
+        order = np.argsort(ids, kind="stable")
+        starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+        bboxes[:, :3] = np.minimum.reduceat(coords[order], starts, axis=0)
+        bboxes[:, 3:] = np.maximum.reduceat(coords[order], starts, axis=0) + 1
+        if prob is not None:
+            scores = np.maximum.reduceat(np.asarray(prob).ravel()[nz][order].astype(np.float64), starts)
+    return {"centroids": centroids, "bboxes": bboxes, "sizes": sizes, "scores": scores}
+
+
+def matching_pairs(pred, gt, max_distance=3.0):
+    """
+    Spatially matching (prediction, GT lesion) index pairs.
+
+    A pair matches when the centroids are at most `max_distance` voxels apart or the
+    bounding boxes overlap. Candidate pairs come from a KD-tree over the GT centroids,
+    so only nearby pairs are ever compared. A centroid lies inside its box but not
+    necessarily near its centre: when two boxes overlap, the centroids are at most the
+    sum of the two full diagonals apart, which is the query radius.
+
+    Args:
+        pred, gt (dict): `lesion_components` outputs (centroids and bboxes)
+        max_distance (float): centroid distance in voxels
+
+    Returns:
+        p, g (M,) int64 indices of the matching pairs
+    """
+    empty = np.zeros(0, dtype=np.int64)
+    if len(pred["centroids"]) == 0 or len(gt["centroids"]) == 0:
+        return empty, empty
+
+    def diagonal(bboxes):
+        return np.linalg.norm(bboxes[:, 3:] - bboxes[:, :3], axis=1)
+
+    gt_bboxes = np.asarray(gt["bboxes"])
+    pred_bboxes = np.asarray(pred["bboxes"])
+    radius = np.maximum(max_distance, diagonal(pred_bboxes) + diagonal(gt_bboxes).max())
+    neighbours = cKDTree(gt["centroids"]).query_ball_point(pred["centroids"], radius)
+
+    p = np.repeat(np.arange(len(neighbours)), [len(n) for n in neighbours])
+    if len(p) == 0:
+        return empty, empty
+    g = np.concatenate([np.asarray(n, dtype=np.int64) for n in neighbours])
+    distance = np.linalg.norm(np.asarray(pred["centroids"])[p] - np.asarray(gt["centroids"])[g], axis=1)
+    overlap = np.all((pred_bboxes[p, :3] < gt_bboxes[g, 3:]) & (gt_bboxes[g, :3] < pred_bboxes[p, 3:]), axis=1)
+    hit = (distance <= max_distance) | overlap
+    return p[hit], g[hit]
+
+
+def match_lesions(pred, gt, max_distance=3.0):
+    """
+    Many-to-many matching of `matching_pairs`: a GT lesion is detected if any
+    prediction matches it, a prediction is a false positive if it matches none.
+
+    Returns:
+        pred_matched (P,) bool, gt_detected (G,) bool, gt_scores (G,) best score of
+        the predictions matching every GT lesion (-inf if none; scores default to 1)
+    """
+    p, g = matching_pairs(pred, gt, max_distance)
+    pred_matched = np.zeros(len(pred["centroids"]), dtype=bool)
+    gt_detected = np.zeros(len(gt["centroids"]), dtype=bool)
+    pred_matched[p] = True
+    gt_detected[g] = True
+    gt_scores = np.full(len(gt_detected), -np.inf)
+    np.maximum.at(gt_scores, g, np.asarray(pred.get("scores", np.ones(len(pred_matched))), dtype=np.float64)[p])
+    return pred_matched, gt_detected, gt_scores
+
+
+def froc_curve(pred_scores, pred_matched, gt_scores, num_subjects):
+    """
+    FROC points for every distinct score threshold from a single sort.
+
+    Components are those of one binarization; raising the score threshold s drops the
+    components scoring below s. A GT lesion stays detected while its best matching
+    component is kept (`gt_scores`, -inf if never matched) and every kept unmatched
+    component is a false positive.
+
+    Args:
+        pred_scores (P,) component scores, pred_matched (P,) bool
+        gt_scores (G,) best score of the components matching every GT lesion
+        num_subjects (int): number of volumes
+
+    Returns:
+        dict with thresholds, sensitivity and fp_per_subject, by decreasing threshold
+    """
+    pred_scores = np.asarray(pred_scores, dtype=np.float64)
+    gt_scores = np.asarray(gt_scores, dtype=np.float64)
+    # one event list: +1 FP for unmatched components, +1 TP for detected GT lesions
+    scores = np.concatenate([pred_scores[~np.asarray(pred_matched, dtype=bool)], gt_scores[np.isfinite(gt_scores)]])
+    is_tp = np.concatenate([np.zeros((~np.asarray(pred_matched, dtype=bool)).sum(), dtype=bool),
+                            np.ones(np.isfinite(gt_scores).sum(), dtype=bool)])
+    order = np.argsort(-scores, kind="stable")
+    scores, is_tp = scores[order], is_tp[order]
+    tp, fp = np.cumsum(is_tp), np.cumsum(~is_tp)
+    # keep the last event of each run of equal scores
+    last = np.r_[scores[1:] != scores[:-1], True] if len(scores) else np.zeros(0, dtype=bool)
+    return {"thresholds": scores[last],
+            "sensitivity": tp[last] / max(len(gt_scores), 1),
+            "fp_per_subject": fp[last] / max(num_subjects, 1)}
+
+
+def froc_sensitivities(curve, fp_rates=(0.125, 0.25, 0.5, 1, 2, 4, 8)):
+    """Best sensitivity with at most each of `fp_rates` false positives per subject."""
+    sensitivities = []
+    for rate in fp_rates:
+        ok = curve["fp_per_subject"] <= rate
+        sensitivities.append(float(curve["sensitivity"][ok].max()) if ok.any() else 0.0)
+    return dict(zip(fp_rates, sensitivities))
+
+
+class LesionMetrics(object):
+    """
+    Per-epoch lesion-level detection metrics: sensitivity, false positives per subject
+    and lesion precision / F1.
+
+    `update` labels the binarized prediction of every item of the batch (one host copy
+    per volume) and matches it against the ground truth, taking the GT lesions from the
+    lesion catalog when the loader provides it instead of labelling the mask again.
+    The component scores and match flags are kept for `froc`, so FROC points need no
+    re-labelling per threshold. Items sharing a file name (e.g. the patches of one
+    subject) count as one subject in the per-subject rates.
+
+    Args:
+        max_distance (float): centroid distance in voxels for a match
+        connectivity (int): connectivity used for labelling
+    """
+
+    def __init__(self, max_distance=3.0, connectivity=3):
+        self.max_distance = max_distance
+        self.connectivity = connectivity
+        self.reset()
+
+    def reset(self):
+        self.records = []
+        self.pred_scores = []
+        self.pred_matched = []
+        self.gt_scores = []
+
+    def __len__(self):
+        return len(self.records)
+
+    def num_subjects(self):
+        return len({r["fname"] for r in self.records})
+
+    def update(self, fname, pred_mask, gt_mask, prob=None, lesions=None):
+        """
+        Args:
+            fname: file name(s) of the batch
+            pred_mask, gt_mask (torch.Tensor): (B, 1, D, H, W) or (B, D, H, W) binary masks
+            prob (torch.Tensor): optional probabilities of the same shape, used as component scores
+            lesions (list): optional `LesionIndex.subject_tensors` entries of the batch
+        """
+        fnames = [fname] if isinstance(fname, str) else list(fname)
+        pred_mask = pred_mask.reshape(len(fnames), *pred_mask.shape[-3:]).cpu().numpy()
+        gt_mask = gt_mask.reshape(len(fnames), *gt_mask.shape[-3:])
+        if prob is not None:
+            prob = prob.reshape(len(fnames), *prob.shape[-3:]).float().cpu().numpy()
+
+        for b, name in enumerate(fnames):
+            pred = lesion_components(pred_mask[b], None if prob is None else prob[b], self.connectivity)
+            if lesions is not None:
+                gt = {"centroids": lesions[b]["centroids"].numpy().astype(np.float64),
+                      "bboxes": lesions[b]["bboxes"].numpy().astype(np.int64)}
+            else:
+                gt = lesion_components(gt_mask[b].cpu().numpy(), connectivity=self.connectivity)
+            pred_matched, gt_detected, gt_scores = match_lesions(pred, gt, self.max_distance)
+
+            self.pred_scores.append(pred["scores"])
+            self.pred_matched.append(pred_matched)
+            self.gt_scores.append(gt_scores)
+            self.records.append({"fname": str(name), "num_gt": len(gt_detected), "num_pred": len(pred_matched),
+                                 "lesion_TP": int(gt_detected.sum()), "lesion_FN": int((~gt_detected).sum()),
+                                 "lesion_FP": int((~pred_matched).sum())})
+
+    def materialize(self):
+        """
+        Returns:
+            summary (dict): sensitivity, fp_per_subject, precision and f1 over the
+                whole set, plus the total counts
+            records (list): one dict per subject with num_gt, num_pred, lesion_TP,
+                lesion_FN and lesion_FP
+        """
+        num_gt = sum(r["num_gt"] for r in self.records)
+        tp = sum(r["lesion_TP"] for r in self.records)
+        fp = sum(r["lesion_FP"] for r in self.records)
+        matched = sum(int(m.sum()) for m in self.pred_matched)
+        num_pred = sum(r["num_pred"] for r in self.records)
+
+        sensitivity = tp / num_gt if num_gt else 0.0
+        precision = matched / num_pred if num_pred else 0.0
+        f1 = 2 * sensitivity * precision / (sensitivity + precision) if sensitivity + precision > 0 else 0.0
+        summary = {"sensitivity": sensitivity, "fp_per_subject": fp / max(self.num_subjects(), 1),
+                   "precision": precision, "f1": f1, "num_gt": num_gt, "lesion_TP": tp, "lesion_FP": fp}
+        return summary, self.records
+
+    def froc(self, fp_rates=(0.125, 0.25, 0.5, 1, 2, 4, 8)):
+        """
+        Returns:
+            curve (dict): `froc_curve` over all subjects
+            sensitivities (dict): sensitivity at each of `fp_rates` FPs per subject,
+                their mean under the key 'mean'
+        """
+        curve = froc_curve(np.concatenate(self.pred_scores) if self.pred_scores else [],
+                           np.concatenate(self.pred_matched) if self.pred_matched else [],
+                           np.concatenate(self.gt_scores) if self.gt_scores else [], self.num_subjects())
+        sensitivities = froc_sensitivities(curve, fp_rates)
+        sensitivities["mean"] = float(np.mean(list(sensitivities.values())))
+        return curve, sensitivities
@@ -1,3 +1,4 @@
+import math
 import torch
 import torch.nn.functional as F
 from torch import nn as nn
@@ -19,35 +20,37 @@ def compute_per_channel_dice(input, target, epsilon=1e-6, weight=None):
     # input and target shapes must match
     assert input.size() == target.size(), "'input' and 'target' must have the same shape"
 
-    input = flatten(input)
-    target = flatten(target)
+    # reduce over every axis but the channel one, no (C, N * Spatial) transposed copy
+    dims = (0,) + tuple(range(2, input.dim()))
     target = target.float()
 
     # compute per channel Dice Coefficient
-    intersect = (input * target).sum(-1)
+    intersect = (input * target).sum(dims)
     if weight is not None:
         intersect = weight * intersect
 
     # here we can use standard dice (input + target).sum(-1) or extension (see V-Net) (input^2 + target^2).sum(-1)
-    denominator = (input * input).sum(-1) + (target * target).sum(-1)
+    denominator = (input * input).sum(dims) + (target * target).sum(dims)
     return 2 * (intersect / denominator.clamp(min=epsilon))
 
 class UnifiedSegmentationLoss(nn.Module):
 
-    def __init__(self, ce_weight=2.0, dice_weight=1.0, edge_weight=5.0):
+    def __init__(self, ce_weight=2.0, dice_weight=1.0, edge_weight=5.0, device=None):
         super(UnifiedSegmentationLoss, self).__init__()
         self.num_class = 3
-        self.laplacian_kernel = torch.tensor(
+        self.register_buffer('laplacian_kernel', torch.tensor(
             [-1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, 26,
-             -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1], dtype=torch.float32).reshape(1, 1, 3, 3, 3).repeat(1, self.num_class, 1, 1, 1).cuda()
+             -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1], dtype=torch.float32).reshape(1, 1, 3, 3, 3).repeat(1, self.num_class, 1, 1, 1))
 
         weights = [0.001, 10.0, 100.0]
-        class_weights = torch.FloatTensor(weights).cuda()
+        class_weights = torch.FloatTensor(weights)
         self.ce_loss = WeightedCrossEntropyLoss(ignore_index=-100)
         self.dice_loss = DiceLoss(weight=class_weights, normalization='softmax')
         self.ce_weight = ce_weight
         self.dice_weight = dice_weight
         self.edge_weight = edge_weight
+        if device is not None:
+            self.to(device)
 
 
     def forward(self, pred, prediction, target, target_onehot):
@@ -131,6 +134,83 @@ class SoftDiceLoss(nn.Module):
         # average over batch
         return loss.mean()
 
+class _FusedBinarySegmentationLoss(torch.autograd.Function):
+    """
+    Dice (same definition as `DiceLoss` with sigmoid normalization) and mean BCE with
+    logits of the same logits, from a single sigmoid. Only the probabilities are kept
+    for the backward pass, whose gradient is written out analytically.
+    """
+
+    @staticmethod
+    def forward(ctx, logits, target, weight, epsilon):
+        dims = (0,) + tuple(range(2, logits.dim()))
+        probs = torch.sigmoid(logits)
+        intersect = (probs * target).sum(dims)
+        denominator = (probs * probs).sum(dims) + (target * target).sum(dims)
+        scale = 2 * (weight if weight is not None else torch.ones_like(intersect))
+        dice = scale * intersect / denominator.clamp(min=epsilon)
+        # softplus(x) - x * t is BCE with logits, stable for large |x|
+        bce = (F.softplus(logits) - logits * target).mean()
+
+        ctx.save_for_backward(probs, target, scale, intersect, denominator)
+        ctx.epsilon = epsilon
+        return 1. - dice.mean(), bce
+
+    @staticmethod
+    def backward(ctx, grad_dice, grad_bce):
+        probs, target, scale, intersect, denominator = ctx.saved_tensors
+        channels = intersect.numel()
+        shape = (1, -1) + (1,) * (probs.dim() - 2)
+        clamped = denominator.clamp(min=ctx.epsilon)
+        # d dice / d p = scale * (t / D - 2 p I / D^2), the denominator term vanishes where it is clamped
+        a = (scale / clamped).view(shape)
+        b = (2 * scale * intersect / clamped ** 2 * (denominator > ctx.epsilon)).view(shape)
+        d_dice = a * target - b * probs
+        grad = (-grad_dice / channels) * d_dice * probs * (1 - probs)
+        grad += grad_bce / probs.numel() * (probs - target)
+        return grad, None, None, None
+
+
+class BinarySegmentationLoss(nn.Module):
+    """
+    Fused Dice + BCE for single-class segmentation logits.
+
+    Replaces a `DiceLoss(normalization='sigmoid')` + `nn.BCEWithLogitsLoss()` pair on
+    the same logits: the sigmoid is computed once, the Dice terms and the BCE are
+    reduced per channel without flattening copies, and the thresholded mask is taken
+    in logit space (logits > log(t / (1 - t))) so no third sigmoid is needed.
+
+    Args:
+        weight (torch.Tensor): per-channel weight of the Dice intersection, as in `DiceLoss`
+        threshold (float): probability threshold of the returned mask
+        epsilon (float): lower clamp of the Dice denominator
+    """
+
+    def __init__(self, weight=None, threshold=0.1, epsilon=1e-6):
+        super(BinarySegmentationLoss, self).__init__()
+        self.register_buffer('weight', weight)
+        self.threshold = threshold
+        self.logit_threshold = math.log(threshold / (1 - threshold))
+        self.epsilon = epsilon
+
+    def forward(self, logits, target):
+        """
+        Args:
+            logits (torch.Tensor): NxCxSpatial segmentation logits
+            target (torch.Tensor): binary target of the same shape
+
+        Returns:
+            dice_loss, bce_loss (scalar tensors) and the (long) mask of logits above the threshold
+        """
+        assert logits.size() == target.size(), "'input' and 'target' must have the same shape"
+        # reductions in fp32 whatever the autocast dtype of the logits
+        logits = logits.float()
+        dice_loss, bce_loss = _FusedBinarySegmentationLoss.apply(logits, target.to(logits.dtype), self.weight,
+                                                                 self.epsilon)
+        pred_mask = (logits.detach() > self.logit_threshold).long()
+        return dice_loss, bce_loss, pred_mask
+
+
 class _MaskingLossWrapper(nn.Module):
     """
     Loss wrapper which prevents the gradient of the loss to be computed where target is equal to `ignore_index`.
@@ -398,8 +478,8 @@ def get_loss_criterion(config):
     if skip_last_target:
         loss = SkipLastTargetChannelWrapper(loss, loss_config.get('squeeze_channel', False))
 
-    if torch.cuda.is_available():
-        loss = loss.cuda()
+    device = config.get('device', 'cuda' if torch.cuda.is_available() else 'cpu')
+    loss = loss.to(device)
 
     return loss
 
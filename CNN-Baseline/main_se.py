@@ -85,6 +85,20 @@ if __name__ == '__main__':
     parser.add_argument('--model_save_path', type=str, default='./saved_models/')
     parser.add_argument('--fold', type=int, default=1, help='selected fold')
     parser.add_argument('--n_workers', type=int, default=4, help='# workers')
+    parser.add_argument('--device', type=str, default='auto', help="'auto', 'cpu', 'cuda' or 'cuda:N'")
+    parser.add_argument('--num_threads', type=int, default=0, help='intra-op threads, 0 = all cores not used by dataloader workers on cpu, torch default on gpu')
+    parser.add_argument('--num_interop_threads', type=int, default=0, help='inter-op threads, 0 = torch default')
+    parser.add_argument('--checkpointing', action='store_true', help='recompute UNet levels in backward to save activation memory')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'], help='autocast dtype of the forward passes, fp16 adds loss scaling')
+    parser.add_argument('--cache_dir', type=str, default=None, help='directory for decoded volume cache, disabled if not set')
+    parser.add_argument('--cache_dtype', type=str, default='float32', choices=['float32', 'float16'], help='storage type of cached images')
+    parser.add_argument('--store_path', type=str, default=None, help='directory with chunked <mode>.h5 stores from chunked_store.py, replaces the NIfTI files if set')
+    parser.add_argument('--lesion_index', action='store_true', help='use the per-split lesion catalogs (built next to the CSVs on first use)')
+    parser.add_argument('--lesion_match_distance', type=float, default=3.0, help='centroid distance (voxels) for lesion-level matching in val/test')
+    parser.add_argument('--sweep_bins', type=int, default=200, help='probability bins of the val/test threshold sweep')
+    parser.add_argument('--patch_items', action='store_true', help='sample individual patches across subjects instead of all patches of a subject')
+    parser.add_argument('--patch_batch_size', type=int, default=32, help='patches per minibatch with --patch_items')
+    parser.add_argument('--cascade_threshold', type=float, default=None, help='at test time decode only patches whose classifier lesion probability reaches this value')
     
     args = parser.parse_args()
     args = update_args(args)
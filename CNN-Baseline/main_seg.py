@@ -85,6 +85,36 @@ if __name__ == '__main__':
     parser.add_argument('--model_save_path', type=str, default='./saved_models/')
     parser.add_argument('--fold', type=int, default=1, help='selected fold')
     parser.add_argument('--n_workers', type=int, default=4, help='# workers')
+    parser.add_argument('--device', type=str, default='auto', help="'auto', 'cpu', 'cuda' or 'cuda:N'")
+    parser.add_argument('--num_threads', type=int, default=0, help='intra-op threads, 0 = all cores not used by dataloader workers on cpu, torch default on gpu')
+    parser.add_argument('--num_interop_threads', type=int, default=0, help='inter-op threads, 0 = torch default')
+    parser.add_argument('--checkpointing', action='store_true', help='recompute UNet levels in backward to save activation memory')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'], help='autocast dtype of the forward passes, fp16 adds loss scaling')
+    parser.add_argument('--cache_dir', type=str, default=None, help='directory for decoded volume cache, disabled if not set')
+    parser.add_argument('--cache_dtype', type=str, default='float32', choices=['float32', 'float16'], help='storage type of cached images')
+    parser.add_argument('--store_path', type=str, default=None, help='directory with chunked <mode>.h5 stores from chunked_store.py, replaces the NIfTI files if set')
+    parser.add_argument('--lesion_index', action='store_true', help='use the per-split lesion catalogs (built next to the CSVs on first use)')
+    parser.add_argument('--crop_size', type=int, nargs=3, default=None, help='train on random crops of this size instead of whole volumes')
+    parser.add_argument('--crop_pos_fraction', type=float, default=0.5, help='fraction of crops centred on a lesion')
+    parser.add_argument('--crops_per_volume', type=int, default=4, help='crops drawn per subject and epoch')
+    parser.add_argument('--con_neg_region', type=str, default='all', choices=['all', 'brain', 'hard'], help='where contrastive negatives are drawn: whole background, brain voxels, or predicted lesions')
+    parser.add_argument('--con_max_pos_per_lesion', type=int, default=0, help='max contrastive positives per lesion component (needs --lesion_index, else per item), 0 = all')
+    parser.add_argument('--con_max_pos', type=int, default=0, help='max contrastive positives per batch, 0 = all')
+    parser.add_argument('--con_chunk_size', type=int, default=256, help='rows per chunk of the contrastive log-sum-exp')
+    parser.add_argument('--no_contrastive', action='store_true', help='disable the contrastive loss, the model then skips returning decoder features')
+    parser.add_argument('--no_eval_contrastive', action='store_true', help='leave the contrastive loss out of val/test, sliding-window inference then blends the logits only')
+    parser.add_argument('--sliding_window', action='store_true', help='run val/test with overlapping tiles (inference.py)')
+    parser.add_argument('--sw_patch_size', type=int, nargs=3, default=[64, 64, 48], help='sliding-window tile size')
+    parser.add_argument('--sw_overlap', type=float, default=0.5, help='sliding-window tile overlap')
+    parser.add_argument('--sw_batch_size', type=int, default=4, help='tiles per forward, 0 = derive from --sw_memory_mb')
+    parser.add_argument('--sw_memory_mb', type=float, default=0, help='activation memory budget per forward for --sw_batch_size 0')
+    parser.add_argument('--lesion_match_distance', type=float, default=3.0, help='centroid distance (voxels) for lesion-level matching in val/test')
+    parser.add_argument('--sweep_bins', type=int, default=200, help='probability bins of the val/test threshold sweep')
+    parser.add_argument('--no_profile', action='store_true', help='disable the per-phase timing of the train steps')
+    parser.add_argument('--profile_sync', action='store_true', help='synchronize CUDA after every profiled phase (exact GPU times, no overlap)')
+    parser.add_argument('--profile_trace_dir', type=str, default=None, help='write a torch.profiler trace of a few train steps here')
+    parser.add_argument('--keep_checkpoints', type=int, default=0, help='also keep the last N per-epoch checkpoints (hardlinked to _latestEpoch.pt)')
+    parser.add_argument('--sync_checkpoints', action='store_true', help='write checkpoints on the training thread')
     
     args = parser.parse_args()
     args = update_args(args)
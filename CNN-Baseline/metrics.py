@@ -2,16 +2,133 @@ import importlib
 
 import numpy as np
 import torch
+from scipy import sparse
 from skimage import measure
-from skimage.metrics import adapted_rand_error, peak_signal_noise_ratio, mean_squared_error
+from skimage.metrics import peak_signal_noise_ratio, mean_squared_error
 
-from pytorch3dunet.unet3d.losses import compute_per_channel_dice
-from pytorch3dunet.unet3d.seg_metrics import AveragePrecision, Accuracy
-from pytorch3dunet.unet3d.utils import get_logger, expand_as_one_hot, convert_to_numpy
+from losses import compute_per_channel_dice
+from utils_unet import get_logger, expand_as_one_hot, convert_to_numpy
 
 logger = get_logger('EvalMetric')
 
 
+def _relabel(labels):
+    """
+    Map the labels of an integer image onto 0..K-1, keeping their order.
+
+    Non-negative labels go through a bincount and a lookup table, which is linear in
+    the number of voxels (plus the largest label); negative labels fall back to
+    `np.unique`.
+
+    Returns:
+        relabeled image (same shape), original label values (K,), voxel counts (K,)
+    """
+    labels = np.asarray(labels)
+    if labels.size and labels.min() >= 0 and np.issubdtype(labels.dtype, np.integer):
+        counts = np.bincount(labels.ravel())
+        values = np.flatnonzero(counts)
+        lut = np.zeros(len(counts), dtype=np.int64)
+        lut[values] = np.arange(len(values))
+        return lut[labels], values, counts[values]
+    values, inverse, counts = np.unique(labels, return_inverse=True, return_counts=True)
+    return inverse.reshape(labels.shape), values, counts
+
+
+def contingency_table(gt, seg):
+    """
+    Sparse overlap counts between two label images, rows for the labels of `gt` and
+    columns for those of `seg` (both relabeled to 0..K-1 by `_relabel`).
+
+    Returns:
+        table (scipy.sparse.csr_matrix), gt label values, seg label values
+    """
+    gt, gt_values, _ = _relabel(gt)
+    seg, seg_values, _ = _relabel(seg)
+    gt, seg = gt.ravel(), seg.ravel()
+    table = sparse.coo_matrix((np.ones(gt.size, dtype=np.int64), (gt, seg)),
+                              shape=(len(gt_values), len(seg_values))).tocsr()
+    return table, gt_values, seg_values
+
+
+def adapted_rand_error(gt, seg, alpha=0.5):
+    """
+    Adapted Rand error (SNEMI3D), same definition as `skimage.metrics.adapted_rand_error`
+    with the 0 label of `gt` ignored, computed from the sparse contingency table.
+    As in skimage, `alpha` weights the pair count of the rows (`gt` labels) and
+    1 - alpha that of the columns (`seg` labels).
+    """
+    table, gt_values, _ = contingency_table(gt, seg)
+    if gt_values[0] == 0:
+        table = table[1:]
+    sum_p_ij2 = float(table.data @ table.data) - table.sum()
+    a_i = np.asarray(table.sum(axis=1)).ravel()
+    b_i = np.asarray(table.sum(axis=0)).ravel()
+    sum_a2 = float(a_i @ a_i) - a_i.sum()
+    sum_b2 = float(b_i @ b_i) - b_i.sum()
+    return 1. - sum_p_ij2 / (alpha * sum_a2 + (1 - alpha) * sum_b2)
+
+
+class SegmentationMetrics:
+    """
+    Instance-level detection counts between a ground truth and a predicted instance
+    segmentation for any IoU threshold. The IoU is only computed for the overlapping
+    (gt, seg) pairs, i.e. the non-zero entries of the contingency table, and label 0
+    is background in both images.
+    """
+
+    def __init__(self, gt, seg):
+        table, gt_values, seg_values = contingency_table(gt, seg)
+        n_gt = np.asarray(table.sum(axis=1)).ravel()
+        n_seg = np.asarray(table.sum(axis=0)).ravel()
+        table = table.tocoo()
+        keep = (gt_values[table.row] != 0) & (seg_values[table.col] != 0)
+        self.rows, self.cols, inter = table.row[keep], table.col[keep], table.data[keep]
+        self.iou = inter / (n_gt[self.rows] + n_seg[self.cols] - inter)
+        self.num_gt = int(np.count_nonzero(gt_values))
+        self.num_seg = int(np.count_nonzero(seg_values))
+
+    def metrics(self, iou_threshold):
+        hit = self.iou > iou_threshold
+        if self.num_gt == 0 or self.num_seg == 0 or not hit.any():
+            tp = fp = fn = 0
+        else:
+            tp = len(np.unique(self.rows[hit]))
+            fn = self.num_gt - tp
+            fp = self.num_seg - len(np.unique(self.cols[hit]))
+        return {'precision': _ratio(tp, tp + fp), 'recall': _ratio(tp, tp + fn),
+                'accuracy': _ratio(tp, tp + fp + fn), 'f1': _ratio(2 * tp, 2 * tp + fp + fn)}
+
+
+def _ratio(num, den):
+    return num / den if den > 0 else 0
+
+
+class Accuracy:
+    """
+    Instance accuracy TP / (TP + FP + FN) at a given IoU threshold.
+    """
+
+    def __init__(self, iou_threshold):
+        self.iou_threshold = iou_threshold
+
+    def __call__(self, input_seg, gt_seg):
+        return SegmentationMetrics(gt_seg, input_seg).metrics(self.iou_threshold)['accuracy']
+
+
+class AveragePrecision:
+    """
+    Average of the instance accuracy over the IoU thresholds 0.5, 0.55, ..., 0.95.
+    """
+
+    def __init__(self, iou=None):
+        self.iou_range = np.linspace(0.50, 0.95, 10) if iou is None else [iou]
+
+    def __call__(self, input_seg, gt_seg):
+        if gt_seg.min() == gt_seg.max():
+            return 1.
+        sm = SegmentationMetrics(gt_seg, input_seg)
+        return np.mean([sm.metrics(iou)['accuracy'] for iou in self.iou_range])
+
 class DiceCoefficient:
     """Computes Dice Coefficient.
     Generalized to multiple channels by computing per-channel Dice Score
@@ -57,45 +174,34 @@ class MeanIoU:
 
         assert input.size() == target.size()
 
-        per_batch_iou = []
-        for _input, _target in zip(input, target):
-            binary_prediction = self._binarize_predictions(_input, n_classes)
-
-            if self.ignore_index is not None:
-                # zero out ignore_index
-                mask = _target == self.ignore_index
-                binary_prediction[mask] = 0
-                _target[mask] = 0
-
-            # convert to uint8 just in case
-            binary_prediction = binary_prediction.byte()
-            _target = _target.byte()
-
-            per_channel_iou = []
-            for c in range(n_classes):
-                if c in self.skip_channels:
-                    continue
-
-                per_channel_iou.append(self._jaccard_index(binary_prediction[c], _target[c]))
-
-            assert per_channel_iou, "All channels were ignored from the computation"
-            mean_iou = torch.mean(torch.tensor(per_channel_iou))
-            per_batch_iou.append(mean_iou)
-
-        return torch.mean(torch.tensor(per_batch_iou))
+        # whole batch at once: (N, C) intersections and unions
+        binary_prediction = self._binarize_predictions(input, n_classes).bool()
+        binary_target = target.bool()
+        if self.ignore_index is not None:
+            # zero out ignore_index
+            keep = target != self.ignore_index
+            binary_prediction &= keep
+            binary_target &= keep
+
+        intersection = (binary_prediction & binary_target).flatten(2).sum(-1).float()
+        union = (binary_prediction | binary_target).flatten(2).sum(-1).float()
+        channels = [c for c in range(n_classes) if c not in self.skip_channels]
+        assert channels, "All channels were ignored from the computation"
+        iou = intersection[:, channels] / torch.clamp(union[:, channels], min=1e-8)
+        return iou.mean(dim=1).mean()
 
     def _binarize_predictions(self, input, n_classes):
         """
         Puts 1 for the class/channel with the highest probability and 0 in other channels. Returns byte tensor of the
-        same size as the input tensor.
+        same size as the (NxCxDxHxW) input tensor.
         """
         if n_classes == 1:
             # for single channel input just threshold the probability map
             result = input > 0.5
             return result.long()
 
-        _, max_index = torch.max(input, dim=0, keepdim=True)
-        return torch.zeros_like(input, dtype=torch.uint8).scatter_(0, max_index, 1)
+        _, max_index = torch.max(input, dim=1, keepdim=True)
+        return torch.zeros_like(input, dtype=torch.uint8).scatter_(1, max_index, 1)
 
     def _jaccard_index(self, prediction, target):
         """
@@ -149,7 +255,7 @@ class AdaptedRandError:
 
         per_batch_arand = []
         for _input, _target in zip(input, target):
-            if np.all(_target == _target.flat[0]):  # skip ARand eval if there is only one label in the patch due to zero-division
+            if _target.min() == _target.max():  # skip ARand eval if there is only one label in the patch due to zero-division
                 logger.info('Skipping ARandError computation: only 1 label present in the ground truth')
                 per_batch_arand.append(0.)
                 continue
@@ -159,7 +265,7 @@ class AdaptedRandError:
             assert segm.ndim == 4
 
             # compute per channel arand and return the minimum value
-            per_channel_arand = [adapted_rand_error(_target, channel_segm)[0] for channel_segm in segm]
+            per_channel_arand = [adapted_rand_error(_target, channel_segm) for channel_segm in segm]
             per_batch_arand.append(np.min(per_channel_arand))
 
         # return mean arand error
@@ -317,10 +423,10 @@ class GenericAveragePrecision:
         :param input: input instance segmentation
         """
         if self.min_instance_size is not None:
-            labels, counts = np.unique(input, return_counts=True)
-            for label, count in zip(labels, counts):
-                if count < self.min_instance_size:
-                    input[input == label] = 0
+            # one lookup table maps every small instance to 0 in a single pass
+            relabeled, labels, counts = _relabel(input)
+            lut = np.where(counts < self.min_instance_size, 0, labels).astype(input.dtype)
+            input = lut[relabeled]
         return input
 
     def input_to_seg(self, input, target=None):
@@ -435,7 +541,7 @@ def get_evaluation_metric(config):
     """
 
     def _metric_class(class_name):
-        m = importlib.import_module('pytorch3dunet.unet3d.metrics')
+        m = importlib.import_module(__name__)
         clazz = getattr(m, class_name)
         return clazz
 
@@ -0,0 +1,151 @@
+import json
+import time
+import atexit
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+import torch
+
+
+def _plain(value):
+    # JSON-native scalar (or list) of a metric value
+    if torch.is_tensor(value):
+        value = value.detach().cpu()
+        return value.item() if value.numel() == 1 else value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, (tuple, list)) and all(isinstance(v, str) for v in value):
+        return ",".join(value)
+    return value
+
+
+class MetricsLog(object):
+    """
+    Append-only metrics store of a training run, one JSON object per line in a
+    single file shared by all runs, splits and epochs.
+
+    Every row carries run_id, epoch, split, kind ('subject' for per-volume records,
+    'summary' for epoch means, or any curve name) and subject, plus the metric
+    columns of the record with plain int / float / str values. Rows are buffered
+    and appended by a background thread every `flush_interval` seconds or once
+    `flush_rows` rows are pending, so logging never waits on the disk; `close`
+    (also run at exit) writes what is left.
+
+    Args:
+        path (str): JSONL file, created if missing
+        run_id (str): identifier of this run in the shared file
+        flush_interval (float): seconds between background flushes
+        flush_rows (int): pending rows that trigger an early flush
+    """
+
+    def __init__(self, path, run_id, flush_interval=5.0, flush_rows=1000):
+        self.path = path
+        self.run_id = run_id
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+        self._rows = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._error = None
+        self._thread = threading.Thread(target=self._worker, name="metrics-log", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def log(self, split, epoch, records, kind="subject"):
+        """
+        Queue one row per record.
+
+        Args:
+            split (str): 'train', 'val' or 'test'
+            epoch (int): epoch of the records
+            records (list of dict): metric columns; 'fname' becomes the subject column
+            kind (str): row kind
+        """
+        if self._error is not None:
+            raise RuntimeError("metrics log write failed") from self._error
+        now = time.time()
+        rows = []
+        for record in records:
+            row = {"run_id": self.run_id, "epoch": int(epoch), "split": split, "kind": kind,
+                   "subject": _plain(record.get("fname")), "time": now}
+            row.update((k, _plain(v)) for k, v in record.items() if k != "fname")
+            rows.append(json.dumps(row))
+        with self._lock:
+            self._rows.extend(rows)
+            pending = len(self._rows)
+        if pending >= self.flush_rows:
+            self._wake.set()
+
+    def log_summary(self, split, epoch, summary):
+        """One 'summary' row with the scalar entries of `summary`."""
+        self.log(split, epoch, [{k: v for k, v in summary.items() if np.ndim(_plain(v)) == 0}], kind="summary")
+
+    def log_curve(self, split, epoch, kind, curve):
+        """One `kind` row per point of a dict of equal-length columns (e.g. a FROC curve)."""
+        columns = {k: _plain(v) for k, v in curve.items()}
+        self.log(split, epoch, [dict(zip(columns, point)) for point in zip(*columns.values())], kind=kind)
+
+    def flush(self):
+        with self._lock:
+            rows, self._rows = self._rows, []
+        if rows:
+            with open(self.path, "a") as f:
+                f.write("\n".join(rows) + "\n")
+
+    def _worker(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                self._error = e
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._wake.set()
+        self._thread.join()
+        self.flush()
+
+
+def load_history(path, run_id=None, split=None, kind="subject"):
+    """
+    Rows of a metrics log as a DataFrame. run_id / split / kind accept None for
+    all; run_id=-1 keeps the last run of the file. Lines of other runs, splits or
+    kinds are skipped by substring before being parsed.
+    """
+    with open(path) as f:
+        lines = [line for line in f if line.strip()]
+    if run_id == -1:
+        run_id = json.loads(lines[-1])["run_id"] if lines else None
+    # `log` writes these keys with json.dumps' default separators
+    needles = [f'"{k}": {json.dumps(v)}' for k, v in [("run_id", run_id), ("split", split), ("kind", kind)]
+               if v is not None]
+    rows = [json.loads(line) for line in lines if all(n in line for n in needles)]
+    rows = [r for r in rows if (run_id is None or r["run_id"] == run_id) and (split is None or r["split"] == split)
+            and (kind is None or r["kind"] == kind)]
+    df = pd.DataFrame.from_records(rows)
+    if len(df):
+        df["epoch"] = df["epoch"].astype(np.int64)
+        for column in ["run_id", "split", "kind"]:
+            df[column] = df[column].astype("category")
+        df["time"] = pd.to_datetime(df["time"], unit="s")
+    return df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize a metrics log')
+
+    parser.add_argument('path', type=str, help='metrics.jsonl of a model directory')
+    parser.add_argument('--run_id', type=str, default=None, help='default: the last run of the file')
+    parser.add_argument('--split', type=str, default=None)
+
+    args = parser.parse_args()
+    df = load_history(args.path, run_id=args.run_id if args.run_id is not None else -1, split=args.split, kind="summary")
+    print(df.drop(columns=["kind", "subject", "time"], errors="ignore").to_string(index=False))
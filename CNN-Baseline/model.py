@@ -1,4 +1,6 @@
+import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 
 from buildingblocks import DoubleConv, ResNetBlock, ResNetBlockSE, \
     create_decoders, create_encoders
@@ -41,12 +43,19 @@ class AbstractUNet(nn.Module):
             Default: 'default' (chooses automatically)
         dropout_prob (float or tuple): dropout probability, default: 0.1
         is3d (bool): if True the model is 3D, otherwise 2D, default: True
+        checkpointing (bool): recompute every encoder/decoder level in the backward pass instead of
+            storing its intermediate activations (training only), default: False
+        return_decoder_feat (bool): return the last decoder feature map next to the logits, None
+            otherwise, default: True
     """
 
     def __init__(self, in_channels, out_channels, final_sigmoid, basic_module, f_maps=64, layer_order='gcr',
                  num_groups=8, num_levels=4, is_segmentation=True, conv_kernel_size=3, pool_kernel_size=2,
-                 conv_padding=1, conv_upscale=2, upsample='default', dropout_prob=0.1, is3d=True):
+                 conv_padding=1, conv_upscale=2, upsample='default', dropout_prob=0.1, is3d=True,
+                 checkpointing=False, return_decoder_feat=True):
         super(AbstractUNet, self).__init__()
+        self.checkpointing = checkpointing
+        self.return_decoder_feat = return_decoder_feat
 
         if isinstance(f_maps, int):
             f_maps = number_of_features_per_level(f_maps, num_levels=num_levels)
@@ -82,11 +91,17 @@ class AbstractUNet(nn.Module):
             # regression problem
             self.final_activation = None
 
+    def run_level(self, module, *inputs):
+        # with checkpointing only the level inputs are kept, its activations are recomputed in backward
+        if self.checkpointing and self.training and torch.is_grad_enabled():
+            return checkpoint(module, *inputs, use_reentrant=False)
+        return module(*inputs)
+
     def forward(self, x):
         # encoder part
         encoders_features = []
         for encoder in self.encoders:
-            x = encoder(x)
+            x = self.run_level(encoder, x)
             # reverse the encoder outputs to be aligned with the decoder
             encoders_features.insert(0, x)
 
@@ -95,13 +110,13 @@ class AbstractUNet(nn.Module):
         encoders_features = encoders_features[1:]
 
         # decoder part
-        for decoder, encoder_features in zip(self.decoders, encoders_features):
+        for decoder in self.decoders:
             # pass the output from the corresponding encoder and the output
-            # of the previous decoder
-            x = decoder(encoder_features, x)
+            # of the previous decoder; popping drops the reference once used (freed without grad)
+            x = self.run_level(decoder, encoders_features.pop(0), x)
 
-        #change 1 - decoder_feat = x.copy()
-        decoder_feat = x.clone()
+        # final_conv is out of place, so the feature map can be returned as is (no clone)
+        decoder_feat = x if self.return_decoder_feat else None
         x = self.final_conv(x)
 
         # apply final_activation (i.e. Sigmoid or Softmax) only during prediction.
@@ -123,7 +138,8 @@ class UNet3D(AbstractUNet):
 
     def __init__(self, in_channels, out_channels, final_sigmoid=True, f_maps=64, layer_order='gcr',
                  num_groups=8, num_levels=4, is_segmentation=True, conv_padding=1,
-                 conv_upscale=2, upsample='default', dropout_prob=0.1, **kwargs):
+                 conv_upscale=2, upsample='default', dropout_prob=0.1, checkpointing=False,
+                 return_decoder_feat=True, **kwargs):
         super(UNet3D, self).__init__(in_channels=in_channels,
                                      out_channels=out_channels,
                                      final_sigmoid=final_sigmoid,
@@ -137,7 +153,9 @@ class UNet3D(AbstractUNet):
                                      conv_upscale=conv_upscale,
                                      upsample=upsample,
                                      dropout_prob=dropout_prob,
-                                     is3d=True)
+                                     is3d=True,
+                                     checkpointing=checkpointing,
+                                     return_decoder_feat=return_decoder_feat)
 
 class UNetWithClassifier(AbstractUNet):
     def __init__(self, in_channels, out_channels, num_classes,
@@ -145,14 +163,15 @@ class UNetWithClassifier(AbstractUNet):
                  num_groups=8, num_levels=4, is_segmentation=True,
                  conv_kernel_size=3, pool_kernel_size=2, conv_padding=1,
                  conv_upscale=2, upsample='default', dropout_prob=0.1,
-                 is3d=True):
+                 is3d=True, checkpointing=False):
         
         super(UNetWithClassifier, self).__init__(in_channels, out_channels, final_sigmoid,
                                                  basic_module, f_maps, layer_order,
                                                  num_groups, num_levels, is_segmentation,
                                                  conv_kernel_size, pool_kernel_size,
                                                  conv_padding, conv_upscale, upsample,
-                                                 dropout_prob, is3d)
+                                                 dropout_prob, is3d, checkpointing=checkpointing,
+                                                 return_decoder_feat=False)
 
         # Classifier Head
         bottleneck_features = f_maps[-1]
@@ -172,33 +191,64 @@ class UNetWithClassifier(AbstractUNet):
             nn.Linear(bottleneck_features // 2, num_classes)
         )
 
-    def forward(self, x):
+    def encode(self, x):
+        """
+        Run the encoders and the classifier head.
 
-        input_x = x
+        Returns:
+            encoders_features (list): encoder outputs, deepest (bottleneck) first
+            cls_logits (torch.Tensor): (N, num_classes)
+        """
         # encoder part
         encoders_features = []
         for encoder in self.encoders:
-            x = encoder(x)
+            x = self.run_level(encoder, x)
             encoders_features.insert(0, x)
 
-        # Bottleneck feature (deepest encoder output)
-        bottleneck_feature = encoders_features[0]
-
-        # Classification branch
-        cls_out = self.global_pool(bottleneck_feature)
+        # Classification branch on the bottleneck feature (deepest encoder output)
+        cls_out = self.global_pool(encoders_features[0])
         cls_logits = self.classifier(cls_out)
+        return encoders_features, cls_logits
 
-        # remove bottleneck feature from encoder features for decoder
-        encoders_features = encoders_features[1:]
-
-        # decoder part
-        for decoder, encoder_features in zip(self.decoders, encoders_features):
-            x = decoder(encoder_features, x)
+    def decode(self, encoders_features):
+        """
+        Run the decoders on the output of `encode`, returns the segmentation logits.
+        The list is consumed, so that every skip connection can be freed once used.
+        """
+        # decoder part, the bottleneck feature is the decoder input
+        x = encoders_features.pop(0)
+        for decoder in self.decoders:
+            x = self.run_level(decoder, encoders_features.pop(0), x)
 
-        seg_output = self.final_conv(x)
+        return self.final_conv(x)
 
+    def forward(self, x):
+        encoders_features, cls_logits = self.encode(x)
+        seg_output = self.decode(encoders_features)
         return seg_output, cls_logits
 
+    def forward_cascade(self, x, threshold=0.5, fill_value=-1e4):
+        """
+        Early-exit inference: the whole batch goes through the encoders and the
+        classifier head, only the patches whose lesion probability
+        (sigmoid of cls_logits[:, 1], as trained with BCEWithLogitsLoss) reaches
+        `threshold` are decoded. The segmentation logits of the other patches are
+        set to `fill_value`, i.e. a zero probability in the stitched output.
+
+        Returns:
+            seg_output (torch.Tensor): (N, out_channels, ...) logits
+            cls_logits (torch.Tensor): (N, num_classes)
+            decoded (torch.Tensor): (N,) bool, False for the patches that were not decoded
+        """
+        encoders_features, cls_logits = self.encode(x)
+        keep = torch.sigmoid(cls_logits[:, 1]) >= threshold
+        idx = torch.nonzero(keep, as_tuple=False).squeeze(1)
+
+        seg_output = x.new_full((x.shape[0], self.final_conv.out_channels) + tuple(x.shape[2:]), fill_value)
+        if len(idx) > 0:
+            seg_output[idx] = self.decode([f[idx] for f in encoders_features]).to(seg_output.dtype)
+        return seg_output, cls_logits, keep
+
 
 
 class ResidualUNet3D(AbstractUNet):
@@ -211,7 +261,8 @@ class ResidualUNet3D(AbstractUNet):
 
     def __init__(self, in_channels, out_channels, final_sigmoid=True, f_maps=64, layer_order='gcr',
                  num_groups=8, num_levels=5, is_segmentation=True, conv_padding=1,
-                 conv_upscale=2, upsample='default', dropout_prob=0.1, **kwargs):
+                 conv_upscale=2, upsample='default', dropout_prob=0.1, checkpointing=False,
+                 return_decoder_feat=True, **kwargs):
         super(ResidualUNet3D, self).__init__(in_channels=in_channels,
                                              out_channels=out_channels,
                                              final_sigmoid=final_sigmoid,
@@ -225,7 +276,9 @@ class ResidualUNet3D(AbstractUNet):
                                              conv_upscale=conv_upscale,
                                              upsample=upsample,
                                              dropout_prob=dropout_prob,
-                                             is3d=True)
+                                             is3d=True,
+                                             checkpointing=checkpointing,
+                                             return_decoder_feat=return_decoder_feat)
 
 
 class ResidualUNetSE3D(AbstractUNet):
@@ -240,7 +293,8 @@ class ResidualUNetSE3D(AbstractUNet):
 
     def __init__(self, in_channels, out_channels, final_sigmoid=True, f_maps=64, layer_order='gcr',
                  num_groups=8, num_levels=5, is_segmentation=True, conv_padding=1,
-                 conv_upscale=2, upsample='default', dropout_prob=0.1, **kwargs):
+                 conv_upscale=2, upsample='default', dropout_prob=0.1, checkpointing=False,
+                 return_decoder_feat=True, **kwargs):
         super(ResidualUNetSE3D, self).__init__(in_channels=in_channels,
                                                out_channels=out_channels,
                                                final_sigmoid=final_sigmoid,
@@ -254,7 +308,9 @@ class ResidualUNetSE3D(AbstractUNet):
                                                conv_upscale=conv_upscale,
                                                upsample=upsample,
                                                dropout_prob=dropout_prob,
-                                               is3d=True)
+                                               is3d=True,
+                                               checkpointing=checkpointing,
+                                               return_decoder_feat=return_decoder_feat)
 
 
 class UNet2D(AbstractUNet):
@@ -265,7 +321,8 @@ class UNet2D(AbstractUNet):
 
     def __init__(self, in_channels, out_channels, final_sigmoid=True, f_maps=64, layer_order='gcr',
                  num_groups=8, num_levels=4, is_segmentation=True, conv_padding=1,
-                 conv_upscale=2, upsample='default', dropout_prob=0.1, **kwargs):
+                 conv_upscale=2, upsample='default', dropout_prob=0.1, checkpointing=False,
+                 return_decoder_feat=True, **kwargs):
         super(UNet2D, self).__init__(in_channels=in_channels,
                                      out_channels=out_channels,
                                      final_sigmoid=final_sigmoid,
@@ -279,7 +336,9 @@ class UNet2D(AbstractUNet):
                                      conv_upscale=conv_upscale,
                                      upsample=upsample,
                                      dropout_prob=dropout_prob,
-                                     is3d=False)
+                                     is3d=False,
+                                     checkpointing=checkpointing,
+                                     return_decoder_feat=return_decoder_feat)
 
 
 class ResidualUNet2D(AbstractUNet):
@@ -289,7 +348,8 @@ class ResidualUNet2D(AbstractUNet):
 
     def __init__(self, in_channels, out_channels, final_sigmoid=True, f_maps=64, layer_order='gcr',
                  num_groups=8, num_levels=5, is_segmentation=True, conv_padding=1,
-                 conv_upscale=2, upsample='default', dropout_prob=0.1, **kwargs):
+                 conv_upscale=2, upsample='default', dropout_prob=0.1, checkpointing=False,
+                 return_decoder_feat=True, **kwargs):
         super(ResidualUNet2D, self).__init__(in_channels=in_channels,
                                              out_channels=out_channels,
                                              final_sigmoid=final_sigmoid,
@@ -303,7 +363,9 @@ class ResidualUNet2D(AbstractUNet):
                                              conv_upscale=conv_upscale,
                                              upsample=upsample,
                                              dropout_prob=dropout_prob,
-                                             is3d=False)
+                                             is3d=False,
+                                             checkpointing=checkpointing,
+                                             return_decoder_feat=return_decoder_feat)
 
 
 def get_model(model_config):
@@ -0,0 +1,184 @@
+import os
+import time
+import contextlib
+import numpy as np
+import torch
+
+
+class StepProfiler(object):
+    """
+    Wall-clock timing of named regions of a training loop.
+
+    Regions are timed with `time.perf_counter_ns` and kept as plain lists of
+    nanoseconds, so the cost per region is two clock reads and an append. A step
+    spans one item of the wrapped loader, from the request of the batch (the
+    'data' region, DataLoader wait) to the request of the next one; `summary`
+    reports p50/p95 per region and per step and the throughput in voxels/s of the
+    voxels passed to `count`. Regions timed outside the steps (e.g. the end-of-epoch
+    metrics) are reported apart, without a share of the step time.
+
+    CUDA kernels are asynchronous: without `sync` the GPU regions measure launch
+    time and the wait shows up in the next region that blocks (usually metrics or
+    the host copy). `sync=True` synchronizes at the end of every region, which
+    gives per-phase GPU times at the price of the overlap.
+
+    With `trace_dir`, a `torch.profiler` trace of steps `trace_wait` .. `trace_wait
+    + trace_active` of the first profiled epoch is written in TensorBoard format and
+    the regions are annotated with `record_function` while it records.
+
+    Args:
+        enabled (bool): False turns every call into a no-op
+        sync (bool): synchronize `device` at the end of each region
+        device: device of the timed work, only used with `sync`
+        trace_dir (str): directory of the torch.profiler trace, None for no trace
+        trace_wait, trace_warmup, trace_active (int): torch.profiler schedule
+    """
+
+    def __init__(self, enabled=True, sync=False, device=None, trace_dir=None, trace_wait=5, trace_warmup=2,
+                 trace_active=5):
+        self.enabled = enabled
+        self.sync = sync and device is not None and torch.device(device).type == "cuda"
+        self.device = device
+        self.trace_dir = trace_dir
+        self.trace_schedule = (trace_wait, trace_warmup, trace_active)
+        self._trace = None
+        self._traced = False
+        self.reset()
+
+    def reset(self):
+        self.regions = {}
+        self.epoch_regions = {}
+        self.steps = []
+        self.step_voxels = []
+        self._step_start = None
+        self._voxels = 0
+
+    def _record(self, name, elapsed):
+        regions = self.regions if self._step_start is not None else self.epoch_regions
+        if name not in regions:
+            regions[name] = []
+        regions[name].append(elapsed)
+
+    @contextlib.contextmanager
+    def region(self, name):
+        """Time the enclosed block under `name`."""
+        if not self.enabled:
+            yield
+            return
+        annotate = torch.profiler.record_function(name) if self._trace is not None else contextlib.nullcontext()
+        start = time.perf_counter_ns()
+        try:
+            with annotate:
+                yield
+        finally:
+            if self.sync:
+                torch.cuda.synchronize(self.device)
+            self._record(name, time.perf_counter_ns() - start)
+
+    def count(self, voxels):
+        """Add `voxels` processed voxels to the current step."""
+        self._voxels += int(voxels)
+
+    def _end_step(self, now):
+        if self._step_start is not None:
+            self.steps.append(now - self._step_start)
+            self.step_voxels.append(self._voxels)
+            if self._trace is not None:
+                self._trace.step()
+        self._step_start = now
+        self._voxels = 0
+
+    def iterate(self, loader, name="data"):
+        """
+        Yield the items of `loader`, timing every fetch under `name` and starting a
+        new step with it. The last step ends when the loader is exhausted.
+        """
+        if not self.enabled:
+            yield from loader
+            return
+        self._start_trace()
+        iterator = iter(loader)
+        try:
+            while True:
+                start = time.perf_counter_ns()
+                self._end_step(start)
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    self._step_start = None
+                    return
+                self._record(name, time.perf_counter_ns() - start)
+                yield item
+        finally:
+            # a loop left early drops its unfinished step
+            self._step_start = None
+            self._stop_trace()
+
+    def _start_trace(self):
+        if self.trace_dir is None or self._traced:
+            return
+        os.makedirs(self.trace_dir, exist_ok=True)
+        wait, warmup, active = self.trace_schedule
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self._trace = torch.profiler.profile(activities=activities,
+                                             schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+                                             on_trace_ready=torch.profiler.tensorboard_trace_handler(self.trace_dir))
+        self._trace.__enter__()
+
+    def _stop_trace(self):
+        if self._trace is not None:
+            self._trace.__exit__(None, None, None)
+            self._trace = None
+            self._traced = True
+            if os.listdir(self.trace_dir):
+                print(f"Profiler trace written to {self.trace_dir}")
+            else:
+                print(f"No profiler trace written, the epoch has fewer than {sum(self.trace_schedule)} steps")
+
+    def summary(self):
+        """
+        Returns:
+            dict region -> {count, total_s, p50_ms, p95_ms, share, voxels_per_s, in_step}, with
+            the whole steps under 'step'; share is the fraction of the step time and
+            voxels_per_s the counted voxels over the region's total time, both None for
+            the regions timed outside the steps (in_step False, a name clashing with a
+            step region gets an ' (epoch)' suffix)
+        """
+        voxels = float(sum(self.step_voxels))
+        step_total = sum(self.steps)
+        timings = dict(self.regions)
+        if self.steps:
+            timings["step"] = self.steps
+        summary = {}
+        for name, values in timings.items():
+            values = np.asarray(values, dtype=np.float64)
+            total = values.sum()
+            p50, p95 = np.percentile(values, [50, 95]) / 1e6
+            summary[name] = {"count": len(values), "total_s": total / 1e9, "p50_ms": p50, "p95_ms": p95,
+                             "share": total / step_total if step_total else 0.0,
+                             "voxels_per_s": voxels / (total / 1e9) if total and voxels else 0.0, "in_step": True}
+        for name, values in self.epoch_regions.items():
+            values = np.asarray(values, dtype=np.float64)
+            p50, p95 = np.percentile(values, [50, 95]) / 1e6
+            summary[name + " (epoch)" if name in summary else name] = {
+                "count": len(values), "total_s": values.sum() / 1e9, "p50_ms": p50, "p95_ms": p95,
+                "share": None, "voxels_per_s": None, "in_step": False}
+        return summary
+
+    def report(self, prefix=""):
+        """Print `summary` one region per line, by decreasing total time, and return it."""
+        summary = self.summary()
+        ordered = sorted(summary.items(), key=lambda kv: -kv[1]["total_s"])
+        for name, s in ordered:
+            if s["in_step"]:
+                print(f"{prefix}{name:>12s}: p50 {s['p50_ms']:8.2f} ms  p95 {s['p95_ms']:8.2f} ms  "
+                      f"total {s['total_s']:8.2f} s ({100 * s['share']:5.1f}%)  {s['voxels_per_s']:.3g} vox/s  n={s['count']}")
+        outside = [(name, s) for name, s in ordered if not s["in_step"]]
+        if outside:
+            print(f"{prefix}outside the steps:")
+        for name, s in outside:
+            print(f"{prefix}{name:>12s}: p50 {s['p50_ms']:8.2f} ms  p95 {s['p95_ms']:8.2f} ms  "
+                  f"total {s['total_s']:8.2f} s  n={s['count']}")
+        return summary
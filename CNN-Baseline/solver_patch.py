@@ -2,12 +2,13 @@ import torch
 import torch.nn as nn
 import os
 from torch import optim
-import csv
-from data_loader import paired_loader_patch
+from data_loader import paired_loader_patch, paired_loader_patch_items
 #from data_loader_orig import paired_loader
 from torchsummary import summary
 from models.unet3d import *
-from util import adjust_learning_rate, to_img, iou, dice_coeff, pixelwise_acc, dice_loss
+from metrics_log import MetricsLog
+from lesion_metrics import LesionMetrics
+from util import adjust_learning_rate, to_img, iou, pixelwise_acc, dice_loss, MetricAccumulator, ThresholdSweep, resolve_device, setup_cpu_threads, autocast_context, make_grad_scaler
 from utils.evaluation_functions import PSNR, SSIM3D
 import numpy as np
 import torch.nn.functional as F
@@ -24,18 +25,28 @@ class Solver(object):
     def __init__(self, args):
 
         self.args = args
+        self.device = resolve_device(getattr(self.args, "device", "auto"))
+        setup_cpu_threads(self.args, self.device)
+        # --precision: autocast for the forward passes, loss scaling for fp16 training
+        self.precision = getattr(self.args, "precision", "fp32")
+        self.scaler = make_grad_scaler(self.device, self.precision)
         #self.args.lr = 0.0002
-        self.train_dataloader, self.val_dataloader, self.test_dataloader = paired_loader_patch(self.args)
+        if getattr(self.args, "patch_items", False):
+            # one patch per item, fixed-size patch minibatches across subjects
+            self.train_dataloader, self.val_dataloader, self.test_dataloader = paired_loader_patch_items(self.args)
+        else:
+            self.train_dataloader, self.val_dataloader, self.test_dataloader = paired_loader_patch(self.args)
         # define the network here
-        self.model = UNetWithClassifier(in_channels=1, out_channels=1, num_classes=2, final_sigmoid=False, f_maps=[16, 32, 64, 128], num_levels=4, is_segmentation=True).cuda()
+        self.model = UNetWithClassifier(in_channels=1, out_channels=1, num_classes=2, final_sigmoid=False, f_maps=[16, 32, 64, 128], num_levels=4, is_segmentation=True,
+                                        checkpointing=getattr(self.args, "checkpointing", False)).to(self.device)
         # self.model = UNetWithClassifier(in_channels=1, out_channels=2, num_classes=2, final_sigmoid=False, f_maps=[32, 64], num_levels=2, is_segmentation=True).cuda()
         # define the loss here, add focal loss later
         weights = [100.0]
-        class_weights = torch.FloatTensor(weights).cuda()
+        class_weights = torch.FloatTensor(weights).to(self.device)
         #self.seg_ce_loss = nn.CrossEntropyLoss(weight=class_weights)
         self.ce_loss = nn.BCEWithLogitsLoss()
-        self.seg_ce_loss = nn.BCEWithLogitsLoss()
-        self.dice_loss = DiceLoss(weight=class_weights, normalization='sigmoid') 
+        # fused Dice + BCE, also returns the sigmoid > 0.1 mask
+        self.seg_loss = BinarySegmentationLoss(weight=class_weights, threshold=0.1)
         #self.fc_loss = FocalLoss(alpha=class_weights, gamma=2)
 
 
@@ -43,6 +54,9 @@ class Solver(object):
         print("Current time " + cur_time_str)
 
         self.save_info = True
+        # per-subject records, epoch summaries and curves of all splits, appended to one file
+        self.metrics_log = MetricsLog(os.path.join(self.args.model_save_path, "metrics.jsonl"),
+                                      run_id=self.args.model_name + "_" + cur_time_str)
 
 
     def train(self):
@@ -81,89 +95,50 @@ class Solver(object):
 
         for i in range(self.cur_epoch, self.args.total_iters):
             self.model.train()  # Set the model to train mode
-            total_dice = []
-            total_dice_bg = []
-            train_dice_loss, train_ce_loss, train_seg_ce_loss = 0, 0, 0
-            total_loss = 0.0
-            total_true_positives = 0
-            total_false_positives = 0
-            total_false_negatives = 0
-            sample_metrics = []
-
-            for fname, inputs, gt_mask, patch_labels in self.train_dataloader:
-                inputs, gt_mask, patch_labels = inputs.cuda(), gt_mask.cuda(), patch_labels.cuda()
+            metrics = MetricAccumulator()
+
+            for fname, inputs, gt_mask, patch_labels, *_ in self.train_dataloader:
+                inputs, gt_mask, patch_labels = inputs.to(self.device), gt_mask.to(self.device), patch_labels.to(self.device)
                 inputs_shape = inputs.shape
                 # reshape to (B*P,C,D,H,W), P - patches
                 inputs = inputs.view(inputs_shape[0]*inputs_shape[1], 1, inputs_shape[2], inputs_shape[3], inputs_shape[4])
                 gt_mask = gt_mask.view(inputs_shape[0]*inputs_shape[1], inputs_shape[2], inputs_shape[3], inputs_shape[4]) # 256, 64, 64, 48
-                patch_labels = patch_labels.permute(1, 0)
+                # (B*P,), same order as the flattened patches; the former permute(1, 0) + squeeze() gave the
+                # same targets for B=1, P>1 and a shape mismatch in ce_loss for any other B or P=1
+                patch_labels = patch_labels.reshape(-1)
                 #cmb_label = F.one_hot(cmb_label, num_classes=2)
                 #pdb.set_trace()
                 self.optimizer.zero_grad()
 
-                pred_logits, pred_label = self.model(inputs)
-                pred_mask = torch.sigmoid(pred_logits)
-                pred_mask = (pred_mask > 0.1).long()
+                with autocast_context(self.device, self.precision):
+                    pred_logits, pred_label = self.model(inputs)
                 #pred_mask = torch.argmax(pred_mask, dim=1)
-                mask_one_hot = F.one_hot(gt_mask.long(), num_classes=1).permute(0, 4, 1, 2, 3).cuda() # 256, 1, 64, 64, 48
-                patch_labels_oh = F.one_hot(patch_labels.long(), num_classes=2).squeeze().float().cuda()
+                mask_one_hot = F.one_hot(gt_mask.long(), num_classes=1).permute(0, 4, 1, 2, 3).to(self.device) # 256, 1, 64, 64, 48
+                patch_labels_oh = F.one_hot(patch_labels.long(), num_classes=2).float().to(self.device)
                 # loss calculation
-                dice_loss = self.dice_loss(pred_logits, mask_one_hot.float())
-                #pdb.set_trace()
-                seg_ce_loss = self.seg_ce_loss(pred_logits, gt_mask.long())
-                ce_loss = self.ce_loss(pred_label, patch_labels_oh)
+                dice_loss, seg_ce_loss, pred_mask = self.seg_loss(pred_logits, mask_one_hot)
+                ce_loss = self.ce_loss(pred_label.float(), patch_labels_oh)
                 batch_loss = dice_loss + seg_ce_loss + ce_loss
 
-                # epoch loss
-                train_dice_loss += dice_loss.item()
-                train_ce_loss += ce_loss.item()
-                train_seg_ce_loss += seg_ce_loss.item()
-                total_loss += dice_loss.item() + seg_ce_loss.item() + ce_loss.item()
                 
                 # updates the parameters
-                batch_loss.backward()
-                self.optimizer.step()
+                self.scaler.scale(batch_loss).backward()
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
                 
-                #outputs = outputs > 0.1
-                metrics_dict = {}
-
-                dice_bg, dice, dice_hash = dice_coeff(gt_mask, pred_mask, smooth=1e-6, num_classes=2)
-                metrics_dict['fname'] = str(fname)
-                metrics_dict['dice'] = dice
-                metrics_dict['dice_bg'] = dice_bg
-
-                # Convert outputs and labels to boolean for bitwise operations
-                pred_mask = pred_mask.bool()
-                gt_mask = gt_mask.bool()
-
-                # Calculate intersection and union for overlap details
-                true_positives = (pred_mask & gt_mask).float().sum()
-                false_positives = (pred_mask & ~gt_mask).float().sum()
-                false_negatives = (~pred_mask & gt_mask).float().sum()
-                metrics_dict['TP'] = true_positives
-                metrics_dict['FP'] = false_positives
-                metrics_dict['FN'] = false_negatives
-
-                sample_metrics.append(metrics_dict)
-                del metrics_dict
-
-                # Update totals
-                total_dice.append(dice)
-                total_dice_bg.append(dice_bg)
-                total_true_positives += true_positives
-                total_false_positives += false_positives
-                total_false_negatives += false_negatives
+                metrics.update(fname, pred_mask, gt_mask, dice_loss=dice_loss, seg_ce_loss=seg_ce_loss, ce_loss=ce_loss)
             
             
-            avg_train_dice = sum(total_dice)/len(total_dice)
-            avg_train_dice_bg = sum(total_dice_bg)/len(total_dice_bg)
-            avg_train_loss = total_loss/len(self.train_dataloader)
-            avg_train_segce_loss = train_seg_ce_loss/len(self.train_dataloader)
-            avg_train_ce_loss = train_ce_loss/len(self.train_dataloader)
-            avg_train_dice_loss = train_dice_loss/len(self.train_dataloader)
-            average_tp = total_true_positives/len(self.train_dataloader)
-            average_fp = total_false_positives/len(self.train_dataloader)
-            average_fn = total_false_negatives/len(self.train_dataloader)
+            stats, sample_metrics = metrics.materialize()
+            avg_train_dice = stats['dice']
+            avg_train_dice_bg = stats['dice_bg']
+            avg_train_loss = stats['loss']
+            avg_train_segce_loss = stats['seg_ce_loss']
+            avg_train_ce_loss = stats['ce_loss']
+            avg_train_dice_loss = stats['dice_loss']
+            average_tp = stats['TP']
+            average_fp = stats['FP']
+            average_fn = stats['FN']
 
             logger['epochs'].append(i)
             logger['loss'].append(avg_train_loss)
@@ -184,12 +159,8 @@ class Solver(object):
             print(f'Iteration:{i+1}/{self.args.total_iters}\tTrain False Negative: {average_fn}')
 
             if self.save_info:
-                keys = sample_metrics[0].keys()
-
-                with open(os.path.join(self.args.model_save_path, f'train_metrics_{i}.csv'), 'w', newline='\n') as output_file:
-                    dict_writer = csv.DictWriter(output_file, keys)
-                    dict_writer.writeheader()
-                    dict_writer.writerows(sample_metrics)
+                self.metrics_log.log('train', i, sample_metrics)
+                self.metrics_log.log_summary('train', i, stats)
 
             if (i+1) % self.args.test_iter == 0:
                 print("Testing saved model...")
@@ -223,6 +194,7 @@ class Solver(object):
                         'model_state_dict': self.model.state_dict(),
                         'optimizer_state_dict': self.optimizer.state_dict(),
                         'scheduler_state_dict': self.scheduler.state_dict(),
+                        'scaler_state_dict': self.scaler.state_dict(),
                         'best_loss': best_loss,
                         'best_dice': best_dice,
                         'train_logger': logger,
@@ -234,21 +206,15 @@ class Solver(object):
     def val(self, train=False, cur_iter=0):
     
         self.model.eval()  # Set the model to evaluation mode
-        total_dice = []
-        total_dice_bg = []
-        total_loss = 0.0
-        dice_loss_test = 0
-        ce_loss_test = 0
-        seg_ce_loss_test = 0
-        total_true_positives = 0
-        total_false_positives = 0
-        total_false_negatives = 0
-        count = 0
-        sample_metrics = []
+        metrics = MetricAccumulator()
+        # lesions are matched per patch (a lesion cut by a patch border counts in each part), the
+        # per-subject rates are taken over the subjects of the patches
+        lesion_metrics = LesionMetrics(max_distance=getattr(self.args, "lesion_match_distance", 3.0))
+        sweep = ThresholdSweep(num_bins=getattr(self.args, "sweep_bins", 200))
 
         with torch.no_grad():
-            for fname, inputs, gt_mask, patch_labels in self.val_dataloader:
-                inputs, gt_mask, patch_labels = inputs.cuda(), gt_mask.cuda(), patch_labels.cuda()
+            for fname, inputs, gt_mask, patch_labels, *_ in self.val_dataloader:
+                inputs, gt_mask, patch_labels = inputs.to(self.device), gt_mask.to(self.device), patch_labels.to(self.device)
                 #cmb_label = F.one_hot(cmb_label, num_classes=2)
                 inputs_shape = inputs.shape
                 # inputs = inputs.view(inputs_shape[0]*inputs_shape[1], 1, inputs_shape[2], inputs_shape[3], inputs_shape[4])
@@ -256,53 +222,26 @@ class Solver(object):
                 inputs = inputs.view(inputs_shape[0]*inputs_shape[1], 1, inputs_shape[2], inputs_shape[3], inputs_shape[4])
                 gt_mask = gt_mask.view(inputs_shape[0]*inputs_shape[1], inputs_shape[2], inputs_shape[3], inputs_shape[4]) # 256, 64, 64, 48                
                 
-                patch_labels = patch_labels.permute(1, 0)
+                # (B*P,), same order as the flattened patches; the former permute(1, 0) + squeeze() gave the
+                # same targets for B=1, P>1 and a shape mismatch in ce_loss for any other B or P=1
+                patch_labels = patch_labels.reshape(-1)
                 
-                pred_logits, pred_label = self.model(inputs)
-                pred_mask = torch.sigmoid(pred_logits)
-                pred_mask = (pred_mask > 0.1).long()
+                with autocast_context(self.device, self.precision):
+                    pred_logits, pred_label = self.model(inputs)
                 # print(f"Max output value: {outputs.max().item()}, Min output value: {outputs.min().item()}")
                 #pred_mask = torch.argmax(pred_mask, dim=1)
-                mask_one_hot = F.one_hot(gt_mask.long(), num_classes=1).permute(0, 4, 1, 2, 3).cuda()
-                patch_labels_oh = F.one_hot(patch_labels.long(), num_classes=2).squeeze().float().cuda()
+                mask_one_hot = F.one_hot(gt_mask.long(), num_classes=1).permute(0, 4, 1, 2, 3).to(self.device)
+                patch_labels_oh = F.one_hot(patch_labels.long(), num_classes=2).float().to(self.device)
                 # dice_loss = self.dice_loss(pred_mask, mask_one_hot.float())
                 # seg_ce_loss = self.seg_ce_loss(pred_mask, gt_mask)
-                dice_loss = self.dice_loss(pred_logits, mask_one_hot.float())
-                seg_ce_loss = self.seg_ce_loss(pred_logits, gt_mask.long())
-                ce_loss = self.ce_loss(pred_label, patch_labels_oh)
-
-                dice_loss_test += dice_loss.item()
-                ce_loss_test += ce_loss.item()
-                seg_ce_loss_test += seg_ce_loss.item()
-                total_loss += dice_loss.item() + seg_ce_loss.item() + ce_loss.item()
-                #outputs = outputs > 0.1
-                metrics_dict = {}
-
-                dice_bg, dice, dice_hash = dice_coeff(gt_mask, pred_mask, smooth=1e-6, num_classes=2)
-                metrics_dict['fname'] = str(fname)
-                metrics_dict['dice'] = dice
-                metrics_dict['dice_bg'] = dice_bg
-
-                # Convert outputs and labels to boolean for bitwise operations
-                pred_mask = pred_mask.bool()
-                gt_mask = gt_mask.bool()
-
-                # Calculate intersection and union for overlap details
-                true_positives = (pred_mask & gt_mask).float().sum()
-                false_positives = (pred_mask & ~gt_mask).float().sum()
-                false_negatives = (~pred_mask & gt_mask).float().sum()
-                metrics_dict['TP'] = true_positives
-                metrics_dict['FP'] = false_positives
-                metrics_dict['FN'] = false_negatives
-
-                sample_metrics.append(metrics_dict)
-                del metrics_dict
-                # Update totals
-                total_dice.append(dice)
-                total_dice_bg.append(dice_bg)
-                total_true_positives += true_positives
-                total_false_positives += false_positives
-                total_false_negatives += false_negatives
+                dice_loss, seg_ce_loss, pred_mask = self.seg_loss(pred_logits, mask_one_hot)
+                ce_loss = self.ce_loss(pred_label.float(), patch_labels_oh)
+
+                metrics.update(fname, pred_mask, gt_mask, dice_loss=dice_loss, seg_ce_loss=seg_ce_loss, ce_loss=ce_loss)
+                patch_fnames = [f for f in fname for _ in range(inputs_shape[1])]
+                pred_prob = torch.sigmoid(pred_logits.float())
+                lesion_metrics.update(patch_fnames, pred_mask, gt_mask, prob=pred_prob)
+                sweep.update(fname, pred_prob, gt_mask)
 
                 # # Calculate Dice coefficient for the current batch and accumulate
                 # if(true_positives + false_positives + false_negatives>0):
@@ -314,15 +253,19 @@ class Solver(object):
         # Calculate average metrics
         #average_dice = 2 * total_true_positives / (2 * total_true_positives + total_false_positives + total_false_negatives)
         # print(f"Average Dice Coefficient: {average_dice:.4f}")
-        average_dice = sum(total_dice)/len(total_dice)
-        average_dice_bg = sum(total_dice_bg)/len(total_dice_bg)
-        average_tp = total_true_positives/len(self.test_dataloader)
-        average_fp = total_false_positives/len(self.test_dataloader)
-        average_fn = total_false_negatives/len(self.test_dataloader)
-        average_loss = total_loss/len(self.test_dataloader)
-        avg_dice_loss = dice_loss_test/len(self.test_dataloader)
-        avg_segce_loss = seg_ce_loss_test/len(self.test_dataloader)
-        avg_ce_loss = ce_loss_test/len(self.test_dataloader)
+        stats, sample_metrics = metrics.materialize()
+        lesion_stats, _ = lesion_metrics.materialize()
+        froc_curve, froc = lesion_metrics.froc()
+        sweep_stats, _ = sweep.materialize()
+        average_dice = stats['dice']
+        average_dice_bg = stats['dice_bg']
+        average_tp = stats['TP']
+        average_fp = stats['FP']
+        average_fn = stats['FN']
+        average_loss = stats['loss']
+        avg_dice_loss = stats['dice_loss']
+        avg_segce_loss = stats['seg_ce_loss']
+        avg_ce_loss = stats['ce_loss']
 
         print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest Loss: {average_loss}')
         print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest Pixel-based BCE Loss: {avg_segce_loss}')
@@ -333,15 +276,27 @@ class Solver(object):
         print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest True Positive: {average_tp}')
         print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest False Positive: {average_fp}')
         print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest False Negative: {average_fn}')
+        print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest Lesion Sensitivity (per patch): {lesion_stats["sensitivity"]:.4f} '
+              f'({lesion_stats["lesion_TP"]}/{lesion_stats["num_gt"]})')
+        print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest Lesion FP per subject: {lesion_stats["fp_per_subject"]:.4f}')
+        print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest Lesion Precision: {lesion_stats["precision"]:.4f}, F1: {lesion_stats["f1"]:.4f}')
+        print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest FROC sensitivity at 1/2/4 FP per subject: '
+              f'{froc[1]:.4f}/{froc[2]:.4f}/{froc[4]:.4f} (mean {froc["mean"]:.4f})')
+        print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest Best DICE threshold: {sweep_stats["best_threshold"]:.3f} '
+              f'(DICE {sweep_stats["best_dice"]:.4f})')
 
 
         if self.save_info:
-            keys = sample_metrics[0].keys()
+            self.metrics_log.log('val', cur_iter+1, sample_metrics)
+            epoch_summary = dict(stats, best_threshold=sweep_stats["best_threshold"], best_dice=sweep_stats["best_dice"])
+            epoch_summary.update((k if k.startswith("lesion_") else "lesion_" + k, v) for k, v in lesion_stats.items())
+            epoch_summary.update((f"froc_{k}", v) for k, v in froc.items())
+            self.metrics_log.log_summary('val', cur_iter+1, epoch_summary)
 
-            with open(os.path.join(self.args.model_save_path, f'val_metrics_{cur_iter+1}.csv'), 'w', newline='\n') as output_file:
-                dict_writer = csv.DictWriter(output_file, keys)
-                dict_writer.writeheader()
-                dict_writer.writerows(sample_metrics)
+            # operating-point curves, to pick thresholds without re-running inference
+            self.metrics_log.log_curve('val', cur_iter+1, "threshold",
+                                       {k: sweep_stats[k] for k in ["thresholds", "dice", "TP", "FP", "FN"]})
+            self.metrics_log.log_curve('val', cur_iter+1, "froc", froc_curve)
 
         print(f"{type} -> Average TP : {average_tp}, FP: {average_fp}, FN: {average_fn}")
         return average_dice, average_dice_bg, average_loss
@@ -349,21 +304,19 @@ class Solver(object):
     def test(self, train=False, cur_iter=0):
     
         self.model.eval()  # Set the model to evaluation mode
-        total_dice = []
-        total_dice_bg = []
-        total_loss = 0.0
-        dice_loss_test = 0
-        ce_loss_test = 0
-        seg_ce_loss_test = 0
-        total_true_positives = 0
-        total_false_positives = 0
-        total_false_negatives = 0
-        count = 0
-        sample_metrics = []
+        metrics = MetricAccumulator()
+        # lesions are matched per patch (a lesion cut by a patch border counts in each part), the
+        # per-subject rates are taken over the subjects of the patches
+        lesion_metrics = LesionMetrics(max_distance=getattr(self.args, "lesion_match_distance", 3.0))
+        sweep = ThresholdSweep(num_bins=getattr(self.args, "sweep_bins", 200))
+        # with --cascade_threshold only patches scored as lesion by the classifier head are decoded
+        cascade_threshold = getattr(self.args, "cascade_threshold", None)
+        # skipped patches / lesion voxels in them, kept on device and read once after the loop
+        num_patches, cascade_counts = 0, torch.zeros(2, dtype=torch.long, device=self.device)
 
         with torch.no_grad():
-            for fname, inputs, gt_mask, patch_labels in self.test_dataloader:
-                inputs, gt_mask, patch_labels = inputs.cuda(), gt_mask.cuda(), patch_labels.cuda()
+            for fname, inputs, gt_mask, patch_labels, *_ in self.test_dataloader:
+                inputs, gt_mask, patch_labels = inputs.to(self.device), gt_mask.to(self.device), patch_labels.to(self.device)
                 #cmb_label = F.one_hot(cmb_label, num_classes=2)
                 inputs_shape = inputs.shape
                 # inputs = inputs.view(inputs_shape[0]*inputs_shape[1], 1, inputs_shape[2], inputs_shape[3], inputs_shape[4])
@@ -371,53 +324,42 @@ class Solver(object):
                 inputs = inputs.view(inputs_shape[0]*inputs_shape[1], 1, inputs_shape[2], inputs_shape[3], inputs_shape[4])
                 gt_mask = gt_mask.view(inputs_shape[0]*inputs_shape[1], inputs_shape[2], inputs_shape[3], inputs_shape[4]) # 256, 64, 64, 48          
                 
-                patch_labels = patch_labels.permute(1, 0)
+                # (B*P,), same order as the flattened patches; the former permute(1, 0) + squeeze() gave the
+                # same targets for B=1, P>1 and a shape mismatch in ce_loss for any other B or P=1
+                patch_labels = patch_labels.reshape(-1)
                 
-                pred_logits, pred_label = self.model(inputs)
-                pred_mask = torch.sigmoid(pred_logits)
-                pred_mask = (pred_mask > 0.1).long()
+                if cascade_threshold is not None:
+                    with autocast_context(self.device, self.precision):
+                        pred_logits, pred_label, decoded = self.model.forward_cascade(inputs, threshold=cascade_threshold)
+                    skipped = ~decoded.to(gt_mask.device)
+                    num_patches += inputs.shape[0]
+                    cascade_counts += torch.stack([skipped.sum(), (gt_mask.flatten(1).sum(1) * skipped).sum().long()])
+                else:
+                    with autocast_context(self.device, self.precision):
+                        pred_logits, pred_label = self.model(inputs)
                 # print(f"Max output value: {outputs.max().item()}, Min output value: {outputs.min().item()}")
                 #pred_mask = torch.argmax(pred_mask, dim=1)
-                mask_one_hot = F.one_hot(gt_mask.long(), num_classes=1).permute(0, 4, 1, 2, 3).cuda()
-                patch_labels_oh = F.one_hot(patch_labels.long(), num_classes=2).squeeze().float().cuda()
+                mask_one_hot = F.one_hot(gt_mask.long(), num_classes=1).permute(0, 4, 1, 2, 3).to(self.device)
+                patch_labels_oh = F.one_hot(patch_labels.long(), num_classes=2).float().to(self.device)
                 # dice_loss = self.dice_loss(pred_mask, mask_one_hot.float())
                 # seg_ce_loss = self.seg_ce_loss(pred_mask, gt_mask)
-                dice_loss = self.dice_loss(pred_logits, mask_one_hot.float())
-                seg_ce_loss = self.seg_ce_loss(pred_logits, gt_mask.long())
-                ce_loss = self.ce_loss(pred_label, patch_labels_oh)
-
-                dice_loss_test += dice_loss.item()
-                ce_loss_test += ce_loss.item()
-                seg_ce_loss_test += seg_ce_loss.item()
-                total_loss += dice_loss.item() + seg_ce_loss.item() + ce_loss.item()
-                #outputs = outputs > 0.1
-                metrics_dict = {}
-
-                dice_bg, dice, dice_hash = dice_coeff(gt_mask, pred_mask, smooth=1e-6, num_classes=2)
-                metrics_dict['fname'] = str(fname)
-                metrics_dict['dice'] = dice
-                metrics_dict['dice_bg'] = dice_bg
-
-                # Convert outputs and labels to boolean for bitwise operations
-                pred_mask = pred_mask.bool()
-                gt_mask = gt_mask.bool()
-
-                # Calculate intersection and union for overlap details
-                true_positives = (pred_mask & gt_mask).float().sum()
-                false_positives = (pred_mask & ~gt_mask).float().sum()
-                false_negatives = (~pred_mask & gt_mask).float().sum()
-                metrics_dict['TP'] = true_positives
-                metrics_dict['FP'] = false_positives
-                metrics_dict['FN'] = false_negatives
-
-                sample_metrics.append(metrics_dict)
-                del metrics_dict
-                # Update totals
-                total_dice.append(dice)
-                total_dice_bg.append(dice_bg)
-                total_true_positives += true_positives
-                total_false_positives += false_positives
-                total_false_negatives += false_negatives
+                if cascade_threshold is not None:
+                    # the fill logits of skipped patches only enter the mask and the counts, the Dice/BCE
+                    # losses are those of the decoded patches (NaN, i.e. left out of the means, if none)
+                    pred_mask = (pred_logits.detach() > self.seg_loss.logit_threshold).long()
+                    if decoded.any():
+                        dice_loss, seg_ce_loss, _ = self.seg_loss(pred_logits[decoded], mask_one_hot[decoded])
+                    else:
+                        dice_loss = seg_ce_loss = torch.tensor(float('nan'), device=pred_logits.device)
+                else:
+                    dice_loss, seg_ce_loss, pred_mask = self.seg_loss(pred_logits, mask_one_hot)
+                ce_loss = self.ce_loss(pred_label.float(), patch_labels_oh)
+
+                metrics.update(fname, pred_mask, gt_mask, dice_loss=dice_loss, seg_ce_loss=seg_ce_loss, ce_loss=ce_loss)
+                patch_fnames = [f for f in fname for _ in range(inputs_shape[1])]
+                pred_prob = torch.sigmoid(pred_logits.float())
+                lesion_metrics.update(patch_fnames, pred_mask, gt_mask, prob=pred_prob)
+                sweep.update(fname, pred_prob, gt_mask)
 
                 # # Calculate Dice coefficient for the current batch and accumulate
                 # if(true_positives + false_positives + false_negatives>0):
@@ -429,15 +371,19 @@ class Solver(object):
         # Calculate average metrics
         #average_dice = 2 * total_true_positives / (2 * total_true_positives + total_false_positives + total_false_negatives)
         # print(f"Average Dice Coefficient: {average_dice:.4f}")
-        average_dice = sum(total_dice)/len(total_dice)
-        average_dice_bg = sum(total_dice_bg)/len(total_dice_bg)
-        average_tp = total_true_positives/len(self.test_dataloader)
-        average_fp = total_false_positives/len(self.test_dataloader)
-        average_fn = total_false_negatives/len(self.test_dataloader)
-        average_loss = total_loss/len(self.test_dataloader)
-        avg_dice_loss = dice_loss_test/len(self.test_dataloader)
-        avg_segce_loss = seg_ce_loss_test/len(self.test_dataloader)
-        avg_ce_loss = ce_loss_test/len(self.test_dataloader)
+        stats, sample_metrics = metrics.materialize()
+        lesion_stats, _ = lesion_metrics.materialize()
+        froc_curve, froc = lesion_metrics.froc()
+        sweep_stats, _ = sweep.materialize()
+        average_dice = stats['dice']
+        average_dice_bg = stats['dice_bg']
+        average_tp = stats['TP']
+        average_fp = stats['FP']
+        average_fn = stats['FN']
+        average_loss = stats['loss']
+        avg_dice_loss = stats['dice_loss']
+        avg_segce_loss = stats['seg_ce_loss']
+        avg_ce_loss = stats['ce_loss']
 
         print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest Loss: {average_loss}')
         print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest Pixel-based BCE Loss: {avg_segce_loss}')
@@ -448,16 +394,33 @@ class Solver(object):
         print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest True Positive: {average_tp}')
         print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest False Positive: {average_fp}')
         print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest False Negative: {average_fn}')
+        print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest Lesion Sensitivity (per patch): {lesion_stats["sensitivity"]:.4f} '
+              f'({lesion_stats["lesion_TP"]}/{lesion_stats["num_gt"]})')
+        print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest Lesion FP per subject: {lesion_stats["fp_per_subject"]:.4f}')
+        print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest Lesion Precision: {lesion_stats["precision"]:.4f}, F1: {lesion_stats["f1"]:.4f}')
+        print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest FROC sensitivity at 1/2/4 FP per subject: '
+              f'{froc[1]:.4f}/{froc[2]:.4f}/{froc[4]:.4f} (mean {froc["mean"]:.4f})')
+        print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest Best DICE threshold: {sweep_stats["best_threshold"]:.3f} '
+              f'(DICE {sweep_stats["best_dice"]:.4f})')
 
 
         if self.save_info:
-            keys = sample_metrics[0].keys()
-
-            with open(os.path.join(self.args.model_save_path, f'test_metrics_{cur_iter+1}.csv'), 'w', newline='\n') as output_file:
-                dict_writer = csv.DictWriter(output_file, keys)
-                dict_writer.writeheader()
-                dict_writer.writerows(sample_metrics)
-
+            self.metrics_log.log('test', cur_iter+1, sample_metrics)
+            epoch_summary = dict(stats, best_threshold=sweep_stats["best_threshold"], best_dice=sweep_stats["best_dice"])
+            epoch_summary.update((k if k.startswith("lesion_") else "lesion_" + k, v) for k, v in lesion_stats.items())
+            epoch_summary.update((f"froc_{k}", v) for k, v in froc.items())
+            self.metrics_log.log_summary('test', cur_iter+1, epoch_summary)
+
+            # operating-point curves, to pick thresholds without re-running inference
+            self.metrics_log.log_curve('test', cur_iter+1, "threshold",
+                                       {k: sweep_stats[k] for k in ["thresholds", "dice", "TP", "FP", "FN"]})
+            self.metrics_log.log_curve('test', cur_iter+1, "froc", froc_curve)
+
+        if cascade_threshold is not None:
+            num_skipped, skipped_lesion_voxels = cascade_counts.tolist()
+            print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tCascade: skipped {num_skipped}/{num_patches} patches '
+                  f'({100.0 * num_skipped / max(num_patches, 1):.1f}% of decoder passes), {skipped_lesion_voxels} lesion voxels '
+                  f'in skipped patches; Dice/BCE losses over the decoded patches only')
         print(f"{type} -> Average TP : {average_tp}, FP: {average_fp}, FN: {average_fn}")
         return average_dice, average_dice_bg, average_loss
 
@@ -465,10 +428,12 @@ class Solver(object):
     
         if self.args.method == "cnn_classifier" or self.args.method == "cnn":
             if resume:
-                checkpoint = torch.load(os.path.join(self.args.model_save_path, self.args.model_name+"_latestEpoch.pt"))
+                checkpoint = torch.load(os.path.join(self.args.model_save_path, self.args.model_name+"_latestEpoch.pt"), map_location=self.device)
                 self.model.load_state_dict(checkpoint["model_state_dict"])
                 self.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
                 self.scheduler.load_state_dict(checkpoint['scheduler_state_dict'])
+                if 'scaler_state_dict' in checkpoint:
+                    self.scaler.load_state_dict(checkpoint['scaler_state_dict'])
                 self.cur_epoch = checkpoint['epoch']
                 self.best_loss = checkpoint['best_loss']
                 self.best_dice = checkpoint['best_dice']
@@ -478,7 +443,7 @@ class Solver(object):
                 #checkpoint = torch.load(os.path.join(self.args.model_save_path, self.args.model_name+".pt"))
                 #pdb.set_trace()
                 #self.model.load_state_dict(checkpoint["model_state_dict"])
-                self.model.load_state_dict(torch.load(os.path.join(self.args.model_save_path, self.args.model_name+"_bestDICE.pt")))
+                self.model.load_state_dict(torch.load(os.path.join(self.args.model_save_path, self.args.model_name+"_bestDICE.pt"), map_location=self.device))
         else:
             raise Exception("Not Implemented")
 
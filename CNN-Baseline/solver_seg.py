@@ -2,12 +2,12 @@ import torch
 import torch.nn as nn
 import os
 from torch import optim
-import csv
-from data_loader import paired_loader
+from data_loader import paired_loader, paired_loader_crop
 #from data_loader_orig import paired_loader
 from torchsummary import summary
 from models.unet3d import *
-from util import adjust_learning_rate, to_img, iou, dice_coeff, pixelwise_acc, dice_loss
+from metrics_log import MetricsLog
+from util import adjust_learning_rate, to_img, iou, pixelwise_acc, dice_loss, MetricAccumulator, ThresholdSweep, resolve_device, setup_cpu_threads, autocast_context, make_grad_scaler
 from utils.evaluation_functions import PSNR, SSIM3D
 import numpy as np
 import torch.nn.functional as F
@@ -18,53 +18,207 @@ import time
 from model import UNetWithClassifier, UNet3D
 from losses import *
 import itertools
-
-def sample_positives(gt_mask):
+from torch.utils.checkpoint import checkpoint
+from lesion_index import positive_coords, positive_components
+from inference import SlidingWindowInferer
+from lesion_metrics import LesionMetrics
+from profiler import StepProfiler
+from checkpoint_manager import CheckpointManager
+
+def sample_positives(gt_mask, lesions=None):
     """
-    gt_mask: Tensor [B, D, H, W], binary {0,1}
-    Returns: LongTensor of shape [N_pos,4] with (b, d, h, w) coords
+    gt_mask: Tensor [B, 1, D, H, W], binary {0,1}
+    lesions: optional list of per-item lesion catalog entries (see lesion_index.py);
+             if given the coordinates are taken from it instead of scanning gt_mask
+    Returns: LongTensor of shape [N_pos,5] with (b, c, d, h, w) coords
     """
+    if lesions is not None:
+        return positive_coords(lesions, device=gt_mask.device)
     return torch.nonzero(gt_mask==1, as_tuple=False)
 
-def sample_negatives(gt_mask, avoid_coords, num_neg):
+def unravel_coords(flat, shape):
+    """
+    flat:  LongTensor [N] of indices into a contiguous tensor of the given shape
+    Returns: LongTensor [N, len(shape)] coords
+    """
+    coords = []
+    for size in reversed(shape):
+        coords.append(flat % size)
+        flat = torch.div(flat, size, rounding_mode='floor')
+    return torch.stack(coords[::-1], dim=1)
+
+def sample_negatives(gt_mask, avoid_coords, num_neg, region=None, max_rounds=10, max_draws=1 << 22):
     """
-    gt_mask:       [B, D, H, W] binary
-    avoid_coords:  LongTensor [N_pos,4] coords to avoid
+    Uniform background coordinates drawn by rejection: random voxels are drawn and
+    dropped if they are lesion (in gt_mask or in avoid_coords), outside `region`, or
+    already drawn. Each round draws as many voxels as the acceptance rate of the
+    previous one says are needed (at most `max_draws` or the volume size), so a round costs
+    O(num_neg / accepted fraction) and the volume is neither reduced nor enumerated
+    unless the whole background is about as small as num_neg.
+
+    gt_mask:       [B, C, D, H, W] binary
+    avoid_coords:  LongTensor [N_pos,5] coords to avoid
     num_neg:       int, number of negatives desired
-    Returns: LongTensor [num_neg,4]
+    region:        optional bool Tensor like gt_mask, draws are restricted to it
+                   (brain mask, hard negatives), topped up uniformly if too few of its
+                   voxels are found
+    Returns: LongTensor [num_neg,5], fewer only if the background is smaller than num_neg
+    """
+    gt_mask = gt_mask.contiguous()
+    shape = gt_mask.shape
+    numel = gt_mask.numel()
+    flat_mask = gt_mask.reshape(-1)
+    flat_region = region.reshape(-1).bool() if region is not None else None
+    # linearized positives, looked up with isin instead of a per-batch dense mask
+    strides = torch.tensor(gt_mask.stride(), device=gt_mask.device)
+    avoid = (avoid_coords.to(gt_mask.device) * strides).sum(1) if avoid_coords.numel() > 0 else None
+
+    def shuffled(idx):
+        # unique() sorts, shuffle before truncating
+        return idx[torch.randperm(len(idx), device=idx.device)]
+
+    def draw(taken, restrict, need):
+        found = torch.zeros(0, dtype=torch.long, device=gt_mask.device)
+        num_draws, cap = 2 * need, min(max_draws, numel)
+        for _ in range(max_rounds):
+            missing = need - len(found)
+            if missing <= 0:
+                break
+            num_draws = min(num_draws, cap)
+            idx = torch.randint(0, numel, (num_draws,), device=gt_mask.device)
+            keep = (flat_mask[idx] == 0) & ~torch.isin(idx, taken)
+            if restrict:
+                keep &= flat_region[idx]
+            if avoid is not None:
+                keep &= ~torch.isin(idx, avoid)
+            found = torch.unique(torch.cat([found, idx[keep]]))
+            new = len(found) - (need - missing)
+            if new > 0:
+                num_draws = int(2 * (missing - new) * num_draws / new) + 1
+            elif num_draws == cap:
+                # an empty (or vanishing) region, give up on it
+                break
+            else:
+                num_draws *= 16
+        return shuffled(found)[:need]
+
+    accepted = torch.zeros(0, dtype=torch.long, device=gt_mask.device)
+    if flat_region is not None:
+        accepted = draw(accepted, True, num_neg)
+    # top up with uniform background draws
+    if len(accepted) < num_neg:
+        accepted = torch.cat([accepted, draw(accepted, False, num_neg - len(accepted))])
+    if len(accepted) < num_neg:
+        # (almost) no background left, enumerate it
+        candidates = torch.nonzero(flat_mask == 0, as_tuple=False).squeeze(1)
+        candidates = candidates[~torch.isin(candidates, accepted)]
+        if avoid is not None:
+            candidates = candidates[~torch.isin(candidates, avoid)]
+        accepted = torch.cat([accepted, shuffled(candidates)])
+    return unravel_coords(accepted[:num_neg], shape)
+
+def window_sums(volume, b, d, h, w, size):
+    """
+    Sum of `volume` over the size^3 window [p - size//2, p - size//2 + size) of every
+    coordinate, gathered for these windows only; voxels outside the volume count as zero.
+
+    volume:  Tensor [B, C, D, H, W]
+    b, d, h, w: LongTensor [N] coordinates
+    Returns: sums Tensor [N, C], number of in-volume voxels of each window Tensor [N]
+    """
+    offsets = torch.arange(size, device=volume.device) - size // 2
+    idx, valid = [], []
+    for p, length in zip((d, h, w), volume.shape[2:]):
+        q = p.unsqueeze(1) + offsets  # [N,size]
+        valid.append((q >= 0) & (q < length))
+        idx.append(q.clamp(0, length - 1))
+    weight = (valid[0][:, :, None, None] & valid[1][:, None, :, None] & valid[2][:, None, None, :]).to(volume.dtype)
+    # advanced indices around the channel slice put the window dims first: [N,size,size,size,C]
+    windows = volume[b[:, None, None, None], :, idx[0][:, :, None, None], idx[1][:, None, :, None],
+                     idx[2][:, None, None, :]]
+    return (windows * weight.unsqueeze(-1)).sum((1, 2, 3)), weight.sum((1, 2, 3))
+
+def extract_window_embeddings(decoder_feats, pred_logits, coords, size=20, chunk_size=64):
+    """
+    Mean decoder feature and mean logit over a size^3 window around each coordinate,
+    the window [d-size/2, d+size/2) being clipped to the volume at the borders. Only
+    the windows are read, `chunk_size` coordinates at a time.
+
+    decoder_feats: Tensor [B, F, D, H, W]
+    pred_logits:   Tensor [B, 1, D, H, W]
+    coords:        LongTensor [N, 5] (b, c, d, h, w) or [N, 4] (b, d, h, w)
+    Returns: Tensor [N, F+1]
+    """
+    b, d, h, w = coords[:, 0], coords[:, -3], coords[:, -2], coords[:, -1]
+    embeddings = []
+    for start in range(0, len(coords), chunk_size):
+        chunk = (b[start:start + chunk_size], d[start:start + chunk_size], h[start:start + chunk_size],
+                 w[start:start + chunk_size])
+        feats, count = window_sums(decoder_feats, *chunk, size)
+        logits, _ = window_sums(pred_logits, *chunk, size)
+        embeddings.append(torch.cat([feats, logits], dim=1) / count.unsqueeze(1))
+    if not embeddings:
+        return decoder_feats.new_zeros(0, decoder_feats.size(1) + pred_logits.size(1))
+    return torch.cat(embeddings)
+
+def subsample_positives(pos_coords, groups, max_per_group=0, max_total=0):
     """
-    #B,D,H,W = gt_mask.shape
-    B,C,D,H,W = gt_mask.shape
-    # Gather all background coords
-    all_bg = []
-    for b in range(B):
-        pos = avoid_coords[avoid_coords[:,0]==b][:,1:]
-        # create a mask to exclude pos coords
-        mask = torch.ones((C,D,H,W), dtype=torch.bool, device=gt_mask.device)
-        if pos.numel()>0:
-            mask[pos[:,0], pos[:,1], pos[:,2], pos[:,3]] = False
-        coords = torch.nonzero((gt_mask[b]==0) & mask, as_tuple=False)
-        bcol = torch.full((coords.size(0),1), b, device=coords.device, dtype=torch.long)
-        all_bg.append(torch.cat([bcol, coords], dim=1))
-    all_bg = torch.cat(all_bg, dim=0)
-    if all_bg.size(0) <= num_neg:
-        return all_bg
-    idx = torch.randperm(all_bg.size(0), device=all_bg.device)[:num_neg]
-    return all_bg[idx]
+    Random subset of the positive coordinates with at most `max_per_group` per group
+    (lesion component) and `max_total` overall, 0 meaning no limit.
+
+    pos_coords: LongTensor [N_pos,5]
+    groups:     LongTensor [N_pos] group id of every coordinate
+    Returns: LongTensor [<=N_pos,5]
+    """
+    keep = torch.randperm(len(pos_coords), device=pos_coords.device)
+    if max_per_group > 0 and len(keep) > 0:
+        # rank of every (shuffled) coordinate inside its group
+        order = torch.sort(groups[keep], stable=True).indices
+        keep = keep[order]
+        _, counts = torch.unique_consecutive(groups[keep], return_counts=True)
+        starts = torch.cumsum(counts, 0) - counts
+        rank = torch.arange(len(keep), device=keep.device) - torch.repeat_interleave(starts, counts)
+        keep = keep[rank < max_per_group]
+        keep = keep[torch.randperm(len(keep), device=keep.device)]
+    if max_total > 0:
+        keep = keep[:max_total]
+    return pos_coords[keep]
 
 class PatchContrastiveLoss(nn.Module):
-    def __init__(self, tau=0.07):
+    """
+    Supervised contrastive loss over the rows of Z. The log-sum-exp over all other
+    rows is evaluated `chunk_size` rows at a time (recomputed in backward when training)
+    and the positive term uses per-class sums of Z, so memory is O(M * chunk_size)
+    instead of O(M^2).
+    """
+    def __init__(self, tau=0.07, chunk_size=256):
         super().__init__()
         self.tau = tau
+        self.chunk_size = chunk_size
+
+    def _chunk_lse(self, Zc, Z, start):
+        sim = (Zc @ Z.T) / self.tau            # [chunk,M]
+        rows = torch.arange(len(Zc), device=Z.device)
+        sim[rows, rows + start] = float('-inf')  # exclude self
+        return torch.logsumexp(sim, dim=1)
 
     def forward(self, Z, labels):
         # Z: [M, d], labels: [M] in {0,1}
-        sim = (Z @ Z.T) / self.tau            # [M,M]
-        mask = labels.unsqueeze(1).eq(labels.unsqueeze(0)).float()
-        mask.fill_diagonal_(0)                # exclude self
-        exp_sim = torch.exp(sim) * (1 - torch.eye(len(Z), device=Z.device))
-        log_prob = sim - torch.log(exp_sim.sum(1, keepdim=True) + 1e-12)
-        mean_log_prob_pos = (mask * log_prob).sum(1) / (mask.sum(1) + 1e-12)
+        lse = []
+        for start in range(0, len(Z), self.chunk_size):
+            Zc = Z[start:start + self.chunk_size]
+            if torch.is_grad_enabled() and Z.requires_grad:
+                lse.append(checkpoint(self._chunk_lse, Zc, Z, start, use_reentrant=False))
+            else:
+                lse.append(self._chunk_lse(Zc, Z, start))
+        lse = torch.cat(lse)                   # [M]
+
+        # sum of sim over same-label rows except self: Z_i . (S_label - Z_i) / tau
+        onehot = F.one_hot(labels, num_classes=2).to(Z.dtype)  # [M,2]
+        class_sums = onehot.T @ Z                              # [2,d]
+        same_sum = (Z * (class_sums[labels] - Z)).sum(1) / self.tau
+        num_same = onehot.sum(0)[labels] - 1
+        mean_log_prob_pos = torch.where(num_same > 0, same_sum / num_same.clamp(min=1) - lse, torch.zeros_like(lse))
         return -mean_log_prob_pos.mean()
 
 
@@ -72,23 +226,46 @@ class Solver(object):
     def __init__(self, args):
 
         self.args = args
+        self.device = resolve_device(getattr(self.args, "device", "auto"))
+        setup_cpu_threads(self.args, self.device)
+        # --precision: autocast for the forward passes, loss scaling for fp16 training
+        self.precision = getattr(self.args, "precision", "fp32")
+        self.scaler = make_grad_scaler(self.device, self.precision)
         #self.args.lr = 0.0002
-        self.train_dataloader, self.val_dataloader, self.test_dataloader = paired_loader(self.args)
+        if getattr(self.args, "crop_size", None):
+            # train on lesion-centred / background crops, evaluate on whole volumes
+            self.train_dataloader, self.val_dataloader, self.test_dataloader = paired_loader_crop(self.args)
+        else:
+            self.train_dataloader, self.val_dataloader, self.test_dataloader = paired_loader(self.args)
         # define the network here
-        self.model = UNet3D(in_channels=1, out_channels=1, num_classes=2, final_sigmoid=False, f_maps=[16, 32, 64, 128], num_levels=4, is_segmentation=True).cuda()
+        # without the contrastive term the decoder features are not returned at all
+        self.use_contrastive = not getattr(self.args, "no_contrastive", False)
+        # --no_eval_contrastive leaves the contrastive loss out of val/test, whose inference then skips the features
+        self.eval_contrastive = self.use_contrastive and not getattr(self.args, "no_eval_contrastive", False)
+        self.model = UNet3D(in_channels=1, out_channels=1, num_classes=2, final_sigmoid=False, f_maps=[16, 32, 64, 128], num_levels=4, is_segmentation=True,
+                            checkpointing=getattr(self.args, "checkpointing", False), return_decoder_feat=self.use_contrastive).to(self.device)
         self.proj_head = nn.Sequential(
                 nn.Linear(17, 32), nn.ReLU(inplace=True),
-                nn.Linear(32, 16)).cuda()
+                nn.Linear(32, 16)).to(self.device)
         # self.model = UNetWithClassifier(in_channels=1, out_channels=2, num_classes=2, final_sigmoid=False, f_maps=[32, 64], num_levels=2, is_segmentation=True).cuda()
         # define the loss here, add focal loss later
         self.con_batch = 64
+        self.neg_region = getattr(self.args, "con_neg_region", "all")
         weights = [100.0]
-        class_weights = torch.FloatTensor(weights).cuda()
+        class_weights = torch.FloatTensor(weights).to(self.device)
         #self.seg_ce_loss = nn.CrossEntropyLoss(weight=class_weights)
         #self.ce_loss = nn.BCEWithLogitsLoss()
-        self.seg_ce_loss = nn.BCEWithLogitsLoss()
-        self.dice_loss = DiceLoss(weight=class_weights, normalization='sigmoid') 
-        self.contrastive_loss = PatchContrastiveLoss(tau=0.1)
+        # fused Dice + BCE, also returns the sigmoid > 0.1 mask
+        self.seg_loss = BinarySegmentationLoss(weight=class_weights, threshold=0.1)
+        self.inferer = None
+        if getattr(self.args, "sliding_window", False):
+            # val/test on overlapping tiles with Gaussian blending instead of one whole-volume forward
+            self.inferer = SlidingWindowInferer(patch_size=tuple(self.args.sw_patch_size), overlap=self.args.sw_overlap,
+                                                batch_size=self.args.sw_batch_size, memory_budget_mb=self.args.sw_memory_mb,
+                                                outputs=None if self.eval_contrastive else (0,))
+        self.contrastive_loss = PatchContrastiveLoss(tau=0.1, chunk_size=getattr(self.args, "con_chunk_size", 256))
+        self.con_max_pos_per_lesion = getattr(self.args, "con_max_pos_per_lesion", 0)
+        self.con_max_pos = getattr(self.args, "con_max_pos", 0)
         #self.fc_loss = FocalLoss(alpha=class_weights, gamma=2)
 
 
@@ -96,7 +273,42 @@ class Solver(object):
         print("Current time " + cur_time_str)
 
         self.save_info = True
-
+        # per-subject records, epoch summaries and curves of all splits, appended to one file
+        self.metrics_log = MetricsLog(os.path.join(self.args.model_save_path, "metrics.jsonl"),
+                                      run_id=self.args.model_name + "_" + cur_time_str)
+
+
+    def contrastive_step(self, inputs, pred_logits, decoder_feats, gt_mask, lesions=None):
+        """
+        Contrastive loss between window embeddings of lesion voxels and of sampled
+        background voxels, zero for volumes without lesions. Negatives are drawn from
+        the whole background, the brain, or the predicted lesions (--con_neg_region).
+        Zero as well with --no_contrastive, where the model returns no decoder features.
+        """
+        if decoder_feats is None:
+            return torch.tensor(0., device=gt_mask.device)
+        pos_coords = sample_positives(gt_mask, lesions)
+        if self.con_max_pos_per_lesion > 0 or self.con_max_pos > 0:
+            # per-lesion caps need the catalog components, otherwise group by batch item
+            groups = positive_components(lesions, device=gt_mask.device) if lesions is not None else pos_coords[:, 0]
+            pos_coords = subsample_positives(pos_coords, groups, self.con_max_pos_per_lesion, self.con_max_pos)
+        # if CMB volume, start contrastive loss
+        if pos_coords.size(0) == 0:
+            return torch.tensor(0., device=gt_mask.device)
+        region = None
+        if self.neg_region == 'brain':
+            region = inputs > 0.05
+        elif self.neg_region == 'hard':
+            region = pred_logits.detach() > self.seg_loss.logit_threshold  # predicted lesion, same cut as the seg mask
+        neg_coords = sample_negatives(gt_mask, pos_coords, self.con_batch, region=region)
+        all_coords = torch.cat([pos_coords, neg_coords], dim=0)
+        labels = torch.cat([torch.ones(len(pos_coords)), torch.zeros(len(neg_coords))], 0).long().to(gt_mask.device)
+
+        # called outside autocast, the embeddings and the similarity logsumexp stay in fp32
+        E = extract_window_embeddings(decoder_feats.float(), pred_logits.float(), all_coords)  # [2P,17]
+        # project & normalize
+        Z = F.normalize(self.proj_head(E), dim=1)
+        return self.contrastive_loss(Z, labels)
 
     def train(self):
 
@@ -135,186 +347,151 @@ class Solver(object):
             test_logger = self.test_logger
 
 
-        for i in range(self.cur_epoch, self.args.total_iters):
-            self.model.train()  # Set the model to train mode
-            total_dice = []
-            total_dice_bg = []
-            train_dice_loss, train_ce_loss, train_seg_ce_loss, train_con_loss = 0, 0, 0, 0
-            total_loss = 0.0
-            total_true_positives = 0
-            total_false_positives = 0
-            total_false_negatives = 0
-            sample_metrics = []
-
-            for fname, inputs, gt_mask, cmb_label in self.train_dataloader:
-                inputs, gt_mask, cmb_label = inputs.cuda(), gt_mask.cuda(), cmb_label.cuda()
-                inputs_shape = inputs.shape
-                #print(fname)
-                # reshape to (B*P,C,D,H,W), P - patches
-                #inputs = inputs.view(inputs_shape[0]*inputs_shape[1], 1, inputs_shape[2], inputs_shape[3], inputs_shape[4])
-                #gt_mask = gt_mask.view(inputs_shape[0]*inputs_shape[1], inputs_shape[2], inputs_shape[3], inputs_shape[4]) # 256, 1, 64, 64, 48
-                #patch_labels = patch_labels.permute(1, 0)
-                cmb_label = F.one_hot(cmb_label, num_classes=2)
-                #pdb.set_trace()
-                self.optimizer.zero_grad()
-
-                pred_logits, decoder_feats = self.model(inputs)
-                pred_mask = torch.sigmoid(pred_logits)
-                pred_mask = (pred_mask > 0.1).long()
-                #pred_mask = torch.argmax(pred_mask, dim=1)
-                #mask_one_hot = F.one_hot(gt_mask.long(), num_classes=1).permute(0, 4, 1, 2, 3).cuda() # 256, 2, 1, 64, 64, 48
-                mask_one_hot = gt_mask
-                #patch_labels_oh = F.one_hot(patch_labels.long(), num_classes=2).squeeze().float().cuda()
-                # loss calculation
-                dice_loss = self.dice_loss(pred_logits, mask_one_hot.float())
-                #pdb.set_trace()
-                seg_ce_loss = self.seg_ce_loss(pred_logits, gt_mask.float())
-                #ce_loss = self.ce_loss(pred_label, cmb_label.float())
-                
-
-                pos_coords = sample_positives(gt_mask)
-                neg_coords = sample_negatives(gt_mask, pos_coords, self.con_batch)
-                # if CMB volume, start contrastive loss
-                if pos_coords.size(0) > 0:
-                    all_coords = torch.cat([pos_coords, neg_coords], dim=0)
-                    labels = torch.cat([torch.ones(len(pos_coords)), torch.zeros(len(neg_coords))], 0).long().to(inputs.device)
-
-                    embs = []
-                    for (b,c,d,h,w) in all_coords:
-                        f_patch = decoder_feats[b, :, d-10:d+10, h-10:h+10, w-10:w+10]  # [16,20,20,20]
-                        l_patch = pred_logits[b, :, d-10:d+10, h-10:h+10, w-10:w+10]      # [1,20,20,20]
-                        v_feat = f_patch.contiguous().view(16, -1).mean(dim=1)
-                        l_feat = l_patch.contiguous().view(1, -1).mean(dim=1)
-                        embs.append(torch.cat([v_feat, l_feat], dim=0))
-                    E = torch.stack(embs, dim=0)  # [2P,17]
+        # per-phase timings of the train steps, summarized every epoch
+        profiler = StepProfiler(enabled=not getattr(self.args, "no_profile", False),
+                                sync=getattr(self.args, "profile_sync", False), device=self.device,
+                                trace_dir=getattr(self.args, "profile_trace_dir", None))
+
+        # checkpoints are snapshot to host memory here and written by a background thread
+        checkpoints = CheckpointManager(self.args.model_save_path, keep_last=getattr(self.args, "keep_checkpoints", 0),
+                                        async_write=not getattr(self.args, "sync_checkpoints", False))
+
+        # joins the writer on any exit, so a crash still leaves the queued checkpoints on disk
+        try:
+            for i in range(self.cur_epoch, self.args.total_iters):
+                self.model.train()  # Set the model to train mode
+                metrics = MetricAccumulator()
+                profiler.reset()
+
+                for fname, inputs, gt_mask, cmb_label, *lesions in profiler.iterate(self.train_dataloader):
+                    lesions = lesions[0] if lesions else None # lesion catalog entries with --lesion_index
+                    with profiler.region("h2d"):
+                        inputs, gt_mask, cmb_label = inputs.to(self.device), gt_mask.to(self.device), cmb_label.to(self.device)
+                    profiler.count(inputs.numel())
+                    inputs_shape = inputs.shape
+                    #print(fname)
+                    # reshape to (B*P,C,D,H,W), P - patches
+                    #inputs = inputs.view(inputs_shape[0]*inputs_shape[1], 1, inputs_shape[2], inputs_shape[3], inputs_shape[4])
+                    #gt_mask = gt_mask.view(inputs_shape[0]*inputs_shape[1], inputs_shape[2], inputs_shape[3], inputs_shape[4]) # 256, 1, 64, 64, 48
+                    #patch_labels = patch_labels.permute(1, 0)
+                    cmb_label = F.one_hot(cmb_label, num_classes=2)
+                    #pdb.set_trace()
+                    self.optimizer.zero_grad()
+
+                    with profiler.region("forward"), autocast_context(self.device, self.precision):
+                        pred_logits, decoder_feats = self.model(inputs)
+                    #pred_mask = torch.argmax(pred_mask, dim=1)
+                    #mask_one_hot = F.one_hot(gt_mask.long(), num_classes=1).permute(0, 4, 1, 2, 3).cuda() # 256, 2, 1, 64, 64, 48
+                    mask_one_hot = gt_mask
+                    #patch_labels_oh = F.one_hot(patch_labels.long(), num_classes=2).squeeze().float().cuda()
+                    # loss calculation
+                    with profiler.region("loss"):
+                        dice_loss, seg_ce_loss, pred_mask = self.seg_loss(pred_logits, mask_one_hot)
+                    #ce_loss = self.ce_loss(pred_label, cmb_label.float())
                 
-                    # project & normalize
-                    Z = F.normalize(self.proj_head(E), dim=1)  # define proj_head in __init__
-                
-                    # contrastive loss
-                    loss_con = self.contrastive_loss(Z, labels)
-                else:
-                    loss_con = torch.tensor(0.).cuda()
 
-                batch_loss = dice_loss + seg_ce_loss + loss_con # + ce_loss
+                    with profiler.region("contrastive"):
+                        loss_con = self.contrastive_step(inputs, pred_logits, decoder_feats, gt_mask, lesions)
 
-                # epoch loss
-                train_dice_loss += dice_loss.item()
-                #train_ce_loss += ce_loss.item()
-                train_seg_ce_loss += seg_ce_loss.item()
-                train_con_loss += loss_con.item()
-                total_loss += dice_loss.item() + seg_ce_loss.item() + loss_con.item() # + ce_loss.item()
+                    batch_loss = dice_loss + seg_ce_loss + loss_con # + ce_loss
 
+                    # updates the parameters
+                    with profiler.region("backward"):
+                        self.scaler.scale(batch_loss).backward()
+                    with profiler.region("optimizer"):
+                        self.scaler.step(self.optimizer)
+                        self.scaler.update()
                 
-                # updates the parameters
-                batch_loss.backward()
-                self.optimizer.step()
-                
-                #outputs = outputs > 0.1
-                metrics_dict = {}
-
-                dice_bg, dice, dice_hash = dice_coeff(gt_mask, pred_mask, smooth=1e-6, num_classes=2)
-                metrics_dict['fname'] = str(fname)
-                metrics_dict['dice'] = dice
-                metrics_dict['dice_bg'] = dice_bg
-
-                # Convert outputs and labels to boolean for bitwise operations
-                pred_mask = pred_mask.bool()
-                gt_mask = gt_mask.bool()
-
-                # Calculate intersection and union for overlap details
-                true_positives = (pred_mask & gt_mask).float().sum()
-                false_positives = (pred_mask & ~gt_mask).float().sum()
-                false_negatives = (~pred_mask & gt_mask).float().sum()
-                metrics_dict['TP'] = true_positives
-                metrics_dict['FP'] = false_positives
-                metrics_dict['FN'] = false_negatives
-
-                sample_metrics.append(metrics_dict)
-                del metrics_dict
-
-                # Update totals
-                total_dice.append(dice)
-                total_dice_bg.append(dice_bg)
-                total_true_positives += true_positives
-                total_false_positives += false_positives
-                total_false_negatives += false_negatives
+                    with profiler.region("metrics"):
+                        metrics.update(fname, pred_mask, gt_mask, dice_loss=dice_loss, seg_ce_loss=seg_ce_loss, con_loss=loss_con)
             
             
-            avg_train_dice = sum(total_dice)/len(total_dice)
-            avg_train_dice_bg = sum(total_dice_bg)/len(total_dice_bg)
-            avg_train_loss = total_loss/len(self.train_dataloader)
-            avg_train_segce_loss = train_seg_ce_loss/len(self.train_dataloader)
-            avg_train_con_loss = train_con_loss/len(self.train_dataloader)
-            #avg_train_ce_loss = train_ce_loss/len(self.train_dataloader)
-            avg_train_dice_loss = train_dice_loss/len(self.train_dataloader)
-            average_tp = total_true_positives/len(self.train_dataloader)
-            average_fp = total_false_positives/len(self.train_dataloader)
-            average_fn = total_false_negatives/len(self.train_dataloader)
-
-            logger['epochs'].append(i)
-            logger['loss'].append(avg_train_loss)
-            logger['dice'].append(avg_train_dice)
-            logger['dice_bg'].append(avg_train_dice_bg)
-            #logger['bce_loss'].append(avg_train_ce_loss)
-            logger['seg_bce_loss'].append(avg_train_segce_loss)
-            logger['dice_loss'].append(avg_train_dice_loss)
-
-            print(f'Iteration:{i+1}/{self.args.total_iters}\tTrain Loss: {avg_train_loss}')
-            print(f'Iteration:{i+1}/{self.args.total_iters}\tTrain Pixel-based BCE Loss: {avg_train_segce_loss}')
-            #print(f'Iteration:{i+1}/{self.args.total_iters}\tTrain BCE Loss: {avg_train_ce_loss}')
-            print(f'Iteration:{i+1}/{self.args.total_iters}\tTrain Dice Loss: {avg_train_dice_loss}')
-            print(f'Iteration:{i+1}/{self.args.total_iters}\tTrain Contrastive Loss: {avg_train_con_loss}')
-            print(f'Iteration:{i+1}/{self.args.total_iters}\tTrain DICE Coeff: {avg_train_dice}')
-            print(f'Iteration:{i+1}/{self.args.total_iters}\tTrain DICE Coeff (with background): {avg_train_dice_bg}')
-            print(f'Iteration:{i+1}/{self.args.total_iters}\tTrain True Positive: {average_tp}')
-            print(f'Iteration:{i+1}/{self.args.total_iters}\tTrain False Positive: {average_fp}')
-            print(f'Iteration:{i+1}/{self.args.total_iters}\tTrain False Negative: {average_fn}')
-
-            if self.save_info:
-                keys = sample_metrics[0].keys()
-
-                with open(os.path.join(self.args.model_save_path, f'train_metrics_{i}.csv'), 'w', newline='\n') as output_file:
-                    dict_writer = csv.DictWriter(output_file, keys)
-                    dict_writer.writeheader()
-                    dict_writer.writerows(sample_metrics)
-
-            if (i+1) % self.args.test_iter == 0:
-                print("Testing saved model...")
-                val_dice, val_dice_bg, val_loss = self.val(train=True, cur_iter=i)
-                #test_logger['epochs'].append(i)
-                #test_logger['loss'].append(test_loss)
-                #test_logger['dice'].append(test_dice)
-                #test_logger['dice_bg'].append(test_dice_bg)
+                # the deferred device->host sync of the epoch's metrics, reported apart from the steps
+                with profiler.region("materialize"):
+                    stats, sample_metrics = metrics.materialize()
+                avg_train_dice = stats['dice']
+                avg_train_dice_bg = stats['dice_bg']
+                avg_train_loss = stats['loss']
+                avg_train_segce_loss = stats['seg_ce_loss']
+                avg_train_con_loss = stats['con_loss']
+                #avg_train_ce_loss = stats['ce_loss']
+                avg_train_dice_loss = stats['dice_loss']
+                average_tp = stats['TP']
+                average_fp = stats['FP']
+                average_fn = stats['FN']
+
+                logger['epochs'].append(i)
+                logger['loss'].append(avg_train_loss)
+                logger['dice'].append(avg_train_dice)
+                logger['dice_bg'].append(avg_train_dice_bg)
+                #logger['bce_loss'].append(avg_train_ce_loss)
+                logger['seg_bce_loss'].append(avg_train_segce_loss)
+                logger['dice_loss'].append(avg_train_dice_loss)
+
+                print(f'Iteration:{i+1}/{self.args.total_iters}\tTrain Loss: {avg_train_loss}')
+                print(f'Iteration:{i+1}/{self.args.total_iters}\tTrain Pixel-based BCE Loss: {avg_train_segce_loss}')
+                #print(f'Iteration:{i+1}/{self.args.total_iters}\tTrain BCE Loss: {avg_train_ce_loss}')
+                print(f'Iteration:{i+1}/{self.args.total_iters}\tTrain Dice Loss: {avg_train_dice_loss}')
+                print(f'Iteration:{i+1}/{self.args.total_iters}\tTrain Contrastive Loss: {avg_train_con_loss}')
+                print(f'Iteration:{i+1}/{self.args.total_iters}\tTrain DICE Coeff: {avg_train_dice}')
+                print(f'Iteration:{i+1}/{self.args.total_iters}\tTrain DICE Coeff (with background): {avg_train_dice_bg}')
+                print(f'Iteration:{i+1}/{self.args.total_iters}\tTrain True Positive: {average_tp}')
+                print(f'Iteration:{i+1}/{self.args.total_iters}\tTrain False Positive: {average_fp}')
+                print(f'Iteration:{i+1}/{self.args.total_iters}\tTrain False Negative: {average_fn}')
+
+                if self.save_info:
+                    with profiler.region("metrics_log"):
+                        self.metrics_log.log('train', i, sample_metrics)
+                        self.metrics_log.log_summary('train', i, stats)
+
+                if profiler.enabled:
+                    print(f'Iteration:{i+1}/{self.args.total_iters}\tTrain step profile:')
+                    profiler.report(prefix='\t')
+
+                if (i+1) % self.args.test_iter == 0:
+                    print("Testing saved model...")
+                    val_dice, val_dice_bg, val_loss = self.val(train=True, cur_iter=i)
+                    #test_logger['epochs'].append(i)
+                    #test_logger['loss'].append(test_loss)
+                    #test_logger['dice'].append(test_dice)
+                    #test_logger['dice_bg'].append(test_dice_bg)
                 
-                if val_loss < best_loss:
-                    torch.save(self.model.state_dict(), os.path.join(self.args.model_save_path, self.args.model_name+"_bestLoss.pt"))
-                if val_dice_bg > best_dice:
-                    torch.save(self.model.state_dict(), os.path.join(self.args.model_save_path, self.args.model_name+"_bestDICE.pt"))
+                    best_names = []
+                    if val_loss < best_loss:
+                        best_names.append(self.args.model_name+"_bestLoss.pt")
+                    if val_dice_bg > best_dice:
+                        best_names.append(self.args.model_name+"_bestDICE.pt")
+                    if best_names:
+                        # written once, the second name is a hardlink
+                        checkpoints.save(self.model.state_dict(), best_names)
 
                 
-                best_dice = max(val_dice_bg, best_dice)
-                best_loss = min(val_loss, best_loss)
-                print(f'Best test loss: {best_loss:.4f}')
-                self.scheduler.step(val_loss)
-                new_lr = self.optimizer.param_groups[0]['lr']
-                print(f"Iteration:{i+1}\tlr: {new_lr: .8f}")
+                    best_dice = max(val_dice_bg, best_dice)
+                    best_loss = min(val_loss, best_loss)
+                    print(f'Best test loss: {best_loss:.4f}')
+                    self.scheduler.step(val_loss)
+                    new_lr = self.optimizer.param_groups[0]['lr']
+                    print(f"Iteration:{i+1}\tlr: {new_lr: .8f}")
                 
-                print("Testing saved model...")
-                test_dice, test_dice_bg, test_loss = self.test(train=True, cur_iter=i)
-                test_logger['epochs'].append(i)
-                test_logger['loss'].append(test_loss)
-                test_logger['dice'].append(test_dice)
-                test_logger['dice_bg'].append(test_dice_bg)
+                    print("Testing saved model...")
+                    test_dice, test_dice_bg, test_loss = self.test(train=True, cur_iter=i)
+                    test_logger['epochs'].append(i)
+                    test_logger['loss'].append(test_loss)
+                    test_logger['dice'].append(test_dice)
+                    test_logger['dice_bg'].append(test_dice_bg)
             
-            torch.save({'epoch': i+1,
-                        'model_state_dict': self.model.state_dict(),
-                        'optimizer_state_dict': self.optimizer.state_dict(),
-                        'scheduler_state_dict': self.scheduler.state_dict(),
-                        'best_loss': best_loss,
-                        'best_dice': best_dice,
-                        'train_logger': logger,
-                        'test_logger': test_logger}, os.path.join(self.args.model_save_path, self.args.model_name+"_latestEpoch.pt"))
+                checkpoints.save({'epoch': i+1,
+                                  'model_state_dict': self.model.state_dict(),
+                                  'optimizer_state_dict': self.optimizer.state_dict(),
+                                  'scheduler_state_dict': self.scheduler.state_dict(),
+                                  'scaler_state_dict': self.scaler.state_dict(),
+                                  'best_loss': best_loss,
+                                  'best_dice': best_dice,
+                                  'train_logger': logger,
+                                  'test_logger': test_logger}, self.args.model_name+"_latestEpoch.pt",
+                                 rotate_as=self.args.model_name+f"_epoch{i+1:04d}.pt")
+        finally:
+            checkpoints.close()
 
         plot_and_save_training_metrics(logger, os.path.join(self.args.output_path, "train_logs.png"))
         plot_and_save_training_metrics(test_logger, os.path.join(self.args.output_path, "test_logs.png"))
@@ -323,22 +500,14 @@ class Solver(object):
     
         self.model.eval()  # Set the model to evaluation mode
         self.proj_head.eval()
-        total_dice = []
-        total_dice_bg = []
-        total_loss = 0.0
-        dice_loss_test = 0
-        ce_loss_test = 0
-        seg_ce_loss_test = 0
-        con_loss_test = 0
-        total_true_positives = 0
-        total_false_positives = 0
-        total_false_negatives = 0
-        count = 0
-        sample_metrics = []
+        metrics = MetricAccumulator()
+        lesion_metrics = LesionMetrics(max_distance=getattr(self.args, "lesion_match_distance", 3.0))
+        sweep = ThresholdSweep(num_bins=getattr(self.args, "sweep_bins", 200))
 
         with torch.no_grad():
-            for fname, inputs, gt_mask, cmb_label in self.val_dataloader:
-                inputs, gt_mask, cmb_label = inputs.cuda(), gt_mask.cuda(), cmb_label.cuda()
+            for fname, inputs, gt_mask, cmb_label, *lesions in self.val_dataloader:
+                lesions = lesions[0] if lesions else None # lesion catalog entries with --lesion_index
+                inputs, gt_mask, cmb_label = inputs.to(self.device), gt_mask.to(self.device), cmb_label.to(self.device)
                 cmb_label = F.one_hot(cmb_label, num_classes=2)
                 inputs_shape = inputs.shape
                 # inputs = inputs.view(inputs_shape[0]*inputs_shape[1], 1, inputs_shape[2], inputs_shape[3], inputs_shape[4])
@@ -347,9 +516,11 @@ class Solver(object):
                 #gt_mask = gt_mask.view(inputs_shape[0]*inputs_shape[1], inputs_shape[2], inputs_shape[3], inputs_shape[4]) # 256, 1, 64, 64, 48                
                 #patch_labels = patch_labels.permute(1, 0)
                 
-                pred_logits, decoder_feats = self.model(inputs)
-                pred_mask = torch.sigmoid(pred_logits)
-                pred_mask = (pred_mask > 0.1).long()
+                with autocast_context(self.device, self.precision):
+                    pred_logits, decoder_feats = self.inferer(self.model, inputs) if self.inferer is not None else self.model(inputs)
+                if not self.eval_contrastive:
+                    decoder_feats = None
+                pred_prob = torch.sigmoid(pred_logits.float())
                 # print(f"Max output value: {outputs.max().item()}, Min output value: {outputs.min().item()}")
                 #pred_mask = torch.argmax(pred_mask, dim=1)
                 #mask_one_hot = F.one_hot(gt_mask.long(), num_classes=1).permute(0, 4, 1, 2, 3).cuda()
@@ -357,68 +528,14 @@ class Solver(object):
                 #patch_labels_oh = F.one_hot(patch_labels.long(), num_classes=2).squeeze().float().cuda()
                 # dice_loss = self.dice_loss(pred_mask, mask_one_hot.float())
                 # seg_ce_loss = self.seg_ce_loss(pred_mask, gt_mask)
-                dice_loss = self.dice_loss(pred_logits, mask_one_hot.float())
-                seg_ce_loss = self.seg_ce_loss(pred_logits, gt_mask.float())
+                dice_loss, seg_ce_loss, pred_mask = self.seg_loss(pred_logits, mask_one_hot)
                 #ce_loss = self.ce_loss(pred_label, cmb_label.float())
 
-                dice_loss_test += dice_loss.item()
-                #ce_loss_test += ce_loss.item()
-                seg_ce_loss_test += seg_ce_loss.item()
-
-                pos_coords = sample_positives(gt_mask)
-                neg_coords = sample_negatives(gt_mask, pos_coords, self.con_batch)
-                # if CMB volume, start contrastive loss
-                if pos_coords.size(0) > 0:
-                    all_coords = torch.cat([pos_coords, neg_coords], dim=0)
-                    labels = torch.cat([torch.ones(len(pos_coords)), torch.zeros(len(neg_coords))], 0).long().to(inputs.device)
-
-                    embs = []
-                    for (b,d,h,w) in all_coords:
-                        f_patch = decoder_feats[b, :, d-10:d+10, h-10:h+10, w-10:w+10]  # [16,20,20,20]
-                        l_patch = pred_logits[b, :, d-10:d+10, h-10:h+10, w-10:w+10]      # [1,20,20,20]
-                        v_feat = f_patch.view(16, -1).mean(dim=1)
-                        l_feat = l_patch.view(1, -1).mean(dim=1)
-                        embs.append(torch.cat([v_feat, l_feat], dim=0))
-                    E = torch.stack(embs, dim=0)  # [2P,17]
-                
-                    # project & normalize
-                    Z = F.normalize(self.proj_head(E), dim=1)  # define proj_head in __init__
-                
-                    # contrastive loss
-                    loss_con = self.contrastive_loss(Z, labels)
-                else:
-                    loss_con = torch.tensor(0.).cuda()
-
-                con_loss_test += loss_con.item()
-                total_loss += dice_loss.item() + seg_ce_loss.item() + loss_con.item() # + ce_loss.item()
-                #outputs = outputs > 0.1
-                metrics_dict = {}
-
-                dice_bg, dice, dice_hash = dice_coeff(gt_mask, pred_mask, smooth=1e-6, num_classes=2)
-                metrics_dict['fname'] = str(fname)
-                metrics_dict['dice'] = dice
-                metrics_dict['dice_bg'] = dice_bg
-
-                # Convert outputs and labels to boolean for bitwise operations
-                pred_mask = pred_mask.bool()
-                gt_mask = gt_mask.bool()
-
-                # Calculate intersection and union for overlap details
-                true_positives = (pred_mask & gt_mask).float().sum()
-                false_positives = (pred_mask & ~gt_mask).float().sum()
-                false_negatives = (~pred_mask & gt_mask).float().sum()
-                metrics_dict['TP'] = true_positives
-                metrics_dict['FP'] = false_positives
-                metrics_dict['FN'] = false_negatives
-
-                sample_metrics.append(metrics_dict)
-                del metrics_dict
-                # Update totals
-                total_dice.append(dice)
-                total_dice_bg.append(dice_bg)
-                total_true_positives += true_positives
-                total_false_positives += false_positives
-                total_false_negatives += false_negatives
+                loss_con = self.contrastive_step(inputs, pred_logits, decoder_feats, gt_mask, lesions)
+
+                metrics.update(fname, pred_mask, gt_mask, dice_loss=dice_loss, seg_ce_loss=seg_ce_loss, con_loss=loss_con)
+                lesion_metrics.update(fname, pred_mask, gt_mask, prob=pred_prob, lesions=lesions)
+                sweep.update(fname, pred_prob, gt_mask)
 
                 # # Calculate Dice coefficient for the current batch and accumulate
                 # if(true_positives + false_positives + false_negatives>0):
@@ -430,16 +547,24 @@ class Solver(object):
         # Calculate average metrics
         #average_dice = 2 * total_true_positives / (2 * total_true_positives + total_false_positives + total_false_negatives)
         # print(f"Average Dice Coefficient: {average_dice:.4f}")
-        average_dice = sum(total_dice)/len(total_dice)
-        average_dice_bg = sum(total_dice_bg)/len(total_dice_bg)
-        average_tp = total_true_positives/len(self.test_dataloader)
-        average_fp = total_false_positives/len(self.test_dataloader)
-        average_fn = total_false_negatives/len(self.test_dataloader)
-        average_loss = total_loss/len(self.test_dataloader)
-        avg_dice_loss = dice_loss_test/len(self.test_dataloader)
-        avg_segce_loss = seg_ce_loss_test/len(self.test_dataloader)
-        avg_con_loss = con_loss_test/len(self.test_dataloader)
-        #avg_ce_loss = ce_loss_test/len(self.test_dataloader)
+        stats, sample_metrics = metrics.materialize()
+        lesion_stats, lesion_records = lesion_metrics.materialize()
+        froc_curve, froc = lesion_metrics.froc()
+        sweep_stats, _ = sweep.materialize()
+        if len(lesion_records) == len(sample_metrics):
+            # one volume per step, merge the lesion counts into the per-subject rows
+            for record, lesion_record in zip(sample_metrics, lesion_records):
+                record.update({k: v for k, v in lesion_record.items() if k != "fname"})
+        average_dice = stats['dice']
+        average_dice_bg = stats['dice_bg']
+        average_tp = stats['TP']
+        average_fp = stats['FP']
+        average_fn = stats['FN']
+        average_loss = stats['loss']
+        avg_dice_loss = stats['dice_loss']
+        avg_segce_loss = stats['seg_ce_loss']
+        avg_con_loss = stats['con_loss']
+        #avg_ce_loss = stats['ce_loss']
 
         print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest Loss: {average_loss}')
         print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest Pixel-based BCE Loss: {avg_segce_loss}')
@@ -451,15 +576,26 @@ class Solver(object):
         print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest True Positive: {average_tp}')
         print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest False Positive: {average_fp}')
         print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest False Negative: {average_fn}')
-
+        print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest Lesion Sensitivity: {lesion_stats["sensitivity"]:.4f} '
+              f'({lesion_stats["lesion_TP"]}/{lesion_stats["num_gt"]})')
+        print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest Lesion FP per subject: {lesion_stats["fp_per_subject"]:.4f}')
+        print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest Lesion Precision: {lesion_stats["precision"]:.4f}, F1: {lesion_stats["f1"]:.4f}')
+        print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest FROC sensitivity at 1/2/4 FP per subject: '
+              f'{froc[1]:.4f}/{froc[2]:.4f}/{froc[4]:.4f} (mean {froc["mean"]:.4f})')
+        print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest Best DICE threshold: {sweep_stats["best_threshold"]:.3f} '
+              f'(DICE {sweep_stats["best_dice"]:.4f})')
 
         if self.save_info:
-            keys = sample_metrics[0].keys()
+            self.metrics_log.log('val', cur_iter+1, sample_metrics)
+            epoch_summary = dict(stats, best_threshold=sweep_stats["best_threshold"], best_dice=sweep_stats["best_dice"])
+            epoch_summary.update((k if k.startswith("lesion_") else "lesion_" + k, v) for k, v in lesion_stats.items())
+            epoch_summary.update((f"froc_{k}", v) for k, v in froc.items())
+            self.metrics_log.log_summary('val', cur_iter+1, epoch_summary)
 
-            with open(os.path.join(self.args.model_save_path, f'val_metrics_{cur_iter+1}.csv'), 'w', newline='\n') as output_file:
-                dict_writer = csv.DictWriter(output_file, keys)
-                dict_writer.writeheader()
-                dict_writer.writerows(sample_metrics)
+            # operating-point curves, to pick thresholds without re-running inference
+            self.metrics_log.log_curve('val', cur_iter+1, "threshold",
+                                       {k: sweep_stats[k] for k in ["thresholds", "dice", "TP", "FP", "FN"]})
+            self.metrics_log.log_curve('val', cur_iter+1, "froc", froc_curve)
 
         print(f"{type} -> Average TP : {average_tp}, FP: {average_fp}, FN: {average_fn}")
         return average_dice, average_dice_bg, average_loss
@@ -467,22 +603,14 @@ class Solver(object):
     def test(self, train=False, cur_iter=0):
     
         self.model.eval()  # Set the model to evaluation mode
-        total_dice = []
-        total_dice_bg = []
-        total_loss = 0.0
-        dice_loss_test = 0
-        ce_loss_test = 0
-        seg_ce_loss_test = 0
-        con_loss_test = 0
-        total_true_positives = 0
-        total_false_positives = 0
-        total_false_negatives = 0
-        count = 0
-        sample_metrics = []
+        metrics = MetricAccumulator()
+        lesion_metrics = LesionMetrics(max_distance=getattr(self.args, "lesion_match_distance", 3.0))
+        sweep = ThresholdSweep(num_bins=getattr(self.args, "sweep_bins", 200))
 
         with torch.no_grad():
-            for fname, inputs, gt_mask, cmb_label in self.test_dataloader:
-                inputs, gt_mask, cmb_label = inputs.cuda(), gt_mask.cuda(), cmb_label.cuda()
+            for fname, inputs, gt_mask, cmb_label, *lesions in self.test_dataloader:
+                lesions = lesions[0] if lesions else None # lesion catalog entries with --lesion_index
+                inputs, gt_mask, cmb_label = inputs.to(self.device), gt_mask.to(self.device), cmb_label.to(self.device)
                 cmb_label = F.one_hot(cmb_label, num_classes=2)
                 inputs_shape = inputs.shape
                 # inputs = inputs.view(inputs_shape[0]*inputs_shape[1], 1, inputs_shape[2], inputs_shape[3], inputs_shape[4])
@@ -492,9 +620,11 @@ class Solver(object):
                 
                 #patch_labels = patch_labels.permute(1, 0)
                 
-                pred_logits, decoder_feats = self.model(inputs)
-                pred_mask = torch.sigmoid(pred_logits)
-                pred_mask = (pred_mask > 0.1).long()
+                with autocast_context(self.device, self.precision):
+                    pred_logits, decoder_feats = self.inferer(self.model, inputs) if self.inferer is not None else self.model(inputs)
+                if not self.eval_contrastive:
+                    decoder_feats = None
+                pred_prob = torch.sigmoid(pred_logits.float())
                 # print(f"Max output value: {outputs.max().item()}, Min output value: {outputs.min().item()}")
                 #pred_mask = torch.argmax(pred_mask, dim=1)
                 #mask_one_hot = F.one_hot(gt_mask.long(), num_classes=1).permute(0, 4, 1, 2, 3).cuda()
@@ -502,69 +632,15 @@ class Solver(object):
                 #patch_labels_oh = F.one_hot(patch_labels.long(), num_classes=2).squeeze().float().cuda()
                 # dice_loss = self.dice_loss(pred_mask, mask_one_hot.float())
                 # seg_ce_loss = self.seg_ce_loss(pred_mask, gt_mask)
-                dice_loss = self.dice_loss(pred_logits, mask_one_hot.float())
-                seg_ce_loss = self.seg_ce_loss(pred_logits, gt_mask.float())
+                dice_loss, seg_ce_loss, pred_mask = self.seg_loss(pred_logits, mask_one_hot)
                 #ce_loss = self.ce_loss(pred_label, cmb_label.float())
 
-                dice_loss_test += dice_loss.item()
-                #ce_loss_test += ce_loss.item()
-                seg_ce_loss_test += seg_ce_loss.item()
-
-                pos_coords = sample_positives(gt_mask)
-                neg_coords = sample_negatives(gt_mask, pos_coords, self.con_batch)
-                # if CMB volume, start contrastive loss
-                if pos_coords.size(0) > 0:
-                    all_coords = torch.cat([pos_coords, neg_coords], dim=0)
-                    labels = torch.cat([torch.ones(len(pos_coords)), torch.zeros(len(neg_coords))], 0).long().to(inputs.device)
-
-                    embs = []
-                    for (b,d,h,w) in all_coords:
-                        f_patch = decoder_feats[b, :, d-10:d+10, h-10:h+10, w-10:w+10]  # [16,20,20,20]
-                        l_patch = pred_logits[b, :, d-10:d+10, h-10:h+10, w-10:w+10]      # [1,20,20,20]
-                        v_feat = f_patch.view(16, -1).mean(dim=1)
-                        l_feat = l_patch.view(1, -1).mean(dim=1)
-                        embs.append(torch.cat([v_feat, l_feat], dim=0))
-                    E = torch.stack(embs, dim=0)  # [2P,17]
-                
-                    # project & normalize
-                    Z = F.normalize(self.proj_head(E), dim=1)  # define proj_head in __init__
-                
-                    # contrastive loss
-                    loss_con = self.contrastive_loss(Z, labels)
-                else:
-                    loss_con = torch.tensor(0.).cuda()
-
-                con_loss_test += loss_con.item()
-
-                total_loss += dice_loss.item() + seg_ce_loss.item() + loss_con.item() # + ce_loss.item()
-                #outputs = outputs > 0.1
-                metrics_dict = {}
-
-                dice_bg, dice, dice_hash = dice_coeff(gt_mask, pred_mask, smooth=1e-6, num_classes=2)
-                metrics_dict['fname'] = str(fname)
-                metrics_dict['dice'] = dice
-                metrics_dict['dice_bg'] = dice_bg
-
-                # Convert outputs and labels to boolean for bitwise operations
-                pred_mask = pred_mask.bool()
-                gt_mask = gt_mask.bool()
-
-                # Calculate intersection and union for overlap details
-                true_positives = (pred_mask & gt_mask).float().sum()
-                false_positives = (pred_mask & ~gt_mask).float().sum()
-                false_negatives = (~pred_mask & gt_mask).float().sum()
-                metrics_dict['TP'] = true_positives
-                metrics_dict['FP'] = false_positives
-                metrics_dict['FN'] = false_negatives
-
-                sample_metrics.append(metrics_dict)
-                del metrics_dict
-                # Update totals
-                total_dice.append(dice)
-                total_dice_bg.append(dice_bg)
-                total_true_positives += true_positives
-                total_false_positives += false_positives
-                total_false_negatives += false_negatives
+                loss_con = self.contrastive_step(inputs, pred_logits, decoder_feats, gt_mask, lesions)
+
+
+                metrics.update(fname, pred_mask, gt_mask, dice_loss=dice_loss, seg_ce_loss=seg_ce_loss, con_loss=loss_con)
+                lesion_metrics.update(fname, pred_mask, gt_mask, prob=pred_prob, lesions=lesions)
+                sweep.update(fname, pred_prob, gt_mask)
 
                 # # Calculate Dice coefficient for the current batch and accumulate
                 # if(true_positives + false_positives + false_negatives>0):
@@ -576,16 +652,24 @@ class Solver(object):
         # Calculate average metrics
         #average_dice = 2 * total_true_positives / (2 * total_true_positives + total_false_positives + total_false_negatives)
         # print(f"Average Dice Coefficient: {average_dice:.4f}")
-        average_dice = sum(total_dice)/len(total_dice)
-        average_dice_bg = sum(total_dice_bg)/len(total_dice_bg)
-        average_tp = total_true_positives/len(self.test_dataloader)
-        average_fp = total_false_positives/len(self.test_dataloader)
-        average_fn = total_false_negatives/len(self.test_dataloader)
-        average_loss = total_loss/len(self.test_dataloader)
-        avg_dice_loss = dice_loss_test/len(self.test_dataloader)
-        avg_segce_loss = seg_ce_loss_test/len(self.test_dataloader)
-        avg_con_loss = con_loss_test/len(self.test_dataloader)
-        #avg_ce_loss = ce_loss_test/len(self.test_dataloader)
+        stats, sample_metrics = metrics.materialize()
+        lesion_stats, lesion_records = lesion_metrics.materialize()
+        froc_curve, froc = lesion_metrics.froc()
+        sweep_stats, _ = sweep.materialize()
+        if len(lesion_records) == len(sample_metrics):
+            # one volume per step, merge the lesion counts into the per-subject rows
+            for record, lesion_record in zip(sample_metrics, lesion_records):
+                record.update({k: v for k, v in lesion_record.items() if k != "fname"})
+        average_dice = stats['dice']
+        average_dice_bg = stats['dice_bg']
+        average_tp = stats['TP']
+        average_fp = stats['FP']
+        average_fn = stats['FN']
+        average_loss = stats['loss']
+        avg_dice_loss = stats['dice_loss']
+        avg_segce_loss = stats['seg_ce_loss']
+        avg_con_loss = stats['con_loss']
+        #avg_ce_loss = stats['ce_loss']
 
         print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest Loss: {average_loss}')
         print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest Pixel-based BCE Loss: {avg_segce_loss}')
@@ -597,15 +681,26 @@ class Solver(object):
         print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest True Positive: {average_tp}')
         print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest False Positive: {average_fp}')
         print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest False Negative: {average_fn}')
-
+        print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest Lesion Sensitivity: {lesion_stats["sensitivity"]:.4f} '
+              f'({lesion_stats["lesion_TP"]}/{lesion_stats["num_gt"]})')
+        print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest Lesion FP per subject: {lesion_stats["fp_per_subject"]:.4f}')
+        print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest Lesion Precision: {lesion_stats["precision"]:.4f}, F1: {lesion_stats["f1"]:.4f}')
+        print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest FROC sensitivity at 1/2/4 FP per subject: '
+              f'{froc[1]:.4f}/{froc[2]:.4f}/{froc[4]:.4f} (mean {froc["mean"]:.4f})')
+        print(f'Iteration:{cur_iter+1}/{self.args.total_iters}\tTest Best DICE threshold: {sweep_stats["best_threshold"]:.3f} '
+              f'(DICE {sweep_stats["best_dice"]:.4f})')
 
         if self.save_info:
-            keys = sample_metrics[0].keys()
+            self.metrics_log.log('test', cur_iter+1, sample_metrics)
+            epoch_summary = dict(stats, best_threshold=sweep_stats["best_threshold"], best_dice=sweep_stats["best_dice"])
+            epoch_summary.update((k if k.startswith("lesion_") else "lesion_" + k, v) for k, v in lesion_stats.items())
+            epoch_summary.update((f"froc_{k}", v) for k, v in froc.items())
+            self.metrics_log.log_summary('test', cur_iter+1, epoch_summary)
 
-            with open(os.path.join(self.args.model_save_path, f'test_metrics_{cur_iter+1}.csv'), 'w', newline='\n') as output_file:
-                dict_writer = csv.DictWriter(output_file, keys)
-                dict_writer.writeheader()
-                dict_writer.writerows(sample_metrics)
+            # operating-point curves, to pick thresholds without re-running inference
+            self.metrics_log.log_curve('test', cur_iter+1, "threshold",
+                                       {k: sweep_stats[k] for k in ["thresholds", "dice", "TP", "FP", "FN"]})
+            self.metrics_log.log_curve('test', cur_iter+1, "froc", froc_curve)
 
         print(f"{type} -> Average TP : {average_tp}, FP: {average_fp}, FN: {average_fn}")
         return average_dice, average_dice_bg, average_loss
@@ -614,10 +709,12 @@ class Solver(object):
     
         if self.args.method == "cnn_classifier" or self.args.method == "cnn":
             if resume:
-                checkpoint = torch.load(os.path.join(self.args.model_save_path, self.args.model_name+"_latestEpoch.pt"))
+                checkpoint = torch.load(os.path.join(self.args.model_save_path, self.args.model_name+"_latestEpoch.pt"), map_location=self.device)
                 self.model.load_state_dict(checkpoint["model_state_dict"])
                 self.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
                 self.scheduler.load_state_dict(checkpoint['scheduler_state_dict'])
+                if 'scaler_state_dict' in checkpoint:
+                    self.scaler.load_state_dict(checkpoint['scaler_state_dict'])
                 self.cur_epoch = checkpoint['epoch']
                 self.best_loss = checkpoint['best_loss']
                 self.best_dice = checkpoint['best_dice']
@@ -627,7 +724,7 @@ class Solver(object):
                 #checkpoint = torch.load(os.path.join(self.args.model_save_path, self.args.model_name+".pt"))
                 #pdb.set_trace()
                 #self.model.load_state_dict(checkpoint["model_state_dict"])
-                self.model.load_state_dict(torch.load(os.path.join(self.args.model_save_path, self.args.model_name+"_bestDICE.pt")))
+                self.model.load_state_dict(torch.load(os.path.join(self.args.model_save_path, self.args.model_name+"_bestDICE.pt"), map_location=self.device))
         else:
             raise Exception("Not Implemented")
 
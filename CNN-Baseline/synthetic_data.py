@@ -0,0 +1,151 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from scipy import ndimage
+
+
+def smooth_noise(shape, sigma, rng):
+    """Zero-mean, unit-std Gaussian-filtered noise, a cheap low-frequency texture."""
+    noise = ndimage.gaussian_filter(rng.standard_normal(shape), sigma)
+    return (noise - noise.mean()) / max(noise.std(), 1e-8)
+
+
+def make_brain(shape, rng, noise_std=0.03):
+    """
+    Brain-like susceptibility-weighted volume: an ellipsoidal head with a bright
+    scalp rim, grey/white matter texture, dark ventricles and Rician-like noise,
+    in arbitrary units around 0-1000 like the raw scans.
+
+    Returns:
+        image (D, H, W) float32, brain (D, H, W) bool
+    """
+    grid = np.stack(np.meshgrid(*[np.linspace(-1, 1, s) for s in shape], indexing="ij"))
+    radii = np.array([0.8, 0.9, 0.85]) * rng.uniform(0.92, 1.05, 3)
+    r = np.sqrt(((grid / radii[:, None, None, None]) ** 2).sum(0))
+    r = r + 0.04 * smooth_noise(shape, max(shape) / 16, rng)  # irregular outline
+
+    head = r < 1.0
+    brain = r < 0.88
+    ventricles = np.sqrt(((grid - np.array([0, -0.05, 0])[:, None, None, None]) /
+                          np.array([0.25, 0.12, 0.3])[:, None, None, None]) ** 2).sum(0) < 1.0
+
+    # grey matter near the cortex and in a blotchy pattern, white matter elsewhere
+    gm = np.clip(0.5 + 0.6 * smooth_noise(shape, max(shape) / 24, rng) + 2.5 * (r - 0.7), 0, 1)
+    tissue = 600 * (1 - gm) + 450 * gm
+    image = np.where(head, 800.0, 0.0)               # scalp / skull rim
+    image = np.where(brain, tissue, image)
+    image = np.where(brain & ventricles, 250.0, image)
+    image = ndimage.gaussian_filter(image, 0.8)      # partial volume
+
+    noise = noise_std * 1000
+    image = np.sqrt((image + noise * rng.standard_normal(shape)) ** 2 + (noise * rng.standard_normal(shape)) ** 2)
+    return image.astype(np.float32), brain & ~ventricles
+
+
+def add_microbleeds(image, brain, num_lesions, rng, radius=(0.8, 2.5), contrast=(0.5, 0.85), min_distance=6):
+    """
+    Insert `num_lesions` small hypointense spheres inside `brain`, in place.
+
+    Every lesion is a sphere of random radius with a soft (Gaussian) edge that darkens
+    the tissue by a random `contrast` fraction at its centre; the mask is the voxels
+    whose centre lies within the radius (at least the centre voxel). Centres are kept
+    `min_distance` voxels apart so that lesions stay separate components.
+
+    Returns:
+        mask (D, H, W) uint8, centres (K, 3) of the inserted lesions
+    """
+    mask = np.zeros(image.shape, dtype=np.uint8)
+    # keep the lesions off the brain border
+    candidates = np.argwhere(ndimage.binary_erosion(brain, iterations=int(np.ceil(radius[1])) + 1))
+    centres = []
+    for _ in range(100 * num_lesions):
+        if len(centres) == num_lesions or len(candidates) == 0:
+            break
+        c = candidates[rng.integers(len(candidates))]
+        if centres and np.min(np.linalg.norm(np.asarray(centres) - c, axis=1)) < min_distance:
+            continue
+        centres.append(c)
+
+        rad = rng.uniform(*radius)
+        half = int(np.ceil(2 * rad)) + 1
+        box = tuple(slice(max(x - half, 0), x + half + 1) for x in c)
+        offsets = np.stack(np.meshgrid(*[np.arange(s.start, s.stop) - x for s, x in zip(box, c)], indexing="ij"))
+        dist = np.sqrt((offsets ** 2).sum(0))
+        profile = np.exp(-0.5 * (dist / max(rad, 0.5)) ** 4)  # flat top, soft edge
+        image[box] *= (1 - rng.uniform(*contrast) * profile).astype(image.dtype)
+        mask[box] |= (dist <= max(rad, 0.5)).astype(np.uint8)
+    return mask, np.asarray(centres, dtype=np.int64).reshape(-1, 3)
+
+
+def generate_subject(shape, num_lesions, seed=None, **lesion_kwargs):
+    """One synthetic (image, mask) pair; `lesion_kwargs` go to `add_microbleeds`."""
+    rng = np.random.default_rng(seed)
+    image, brain = make_brain(shape, rng)
+    mask, _ = add_microbleeds(image, brain, num_lesions, rng, **lesion_kwargs)
+    return image, mask
+
+
+def write_dataset(out_dir, splits=None, shape=(128, 128, 96), lesions_per_subject=3.0, lesion_free_fraction=0.3,
+                  voxel_size=(1.0, 1.0, 1.0), seed=0, **lesion_kwargs):
+    """
+    Write a complete fake dataset under `out_dir`: images/ and masks/ as NIfTI and one
+    CSV per split with the MRI_file_path / GT_mask_path columns read by `MRIDataset`,
+    relative to `out_dir`.
+
+    The number of lesions of a subject is 0 with probability `lesion_free_fraction`
+    and 1 + Poisson(lesions_per_subject - 1) otherwise.
+
+    Args:
+        splits (dict): split name -> number of subjects, default train 8, val 2, test 2
+        shape (tuple): volume size (D, H, W)
+        voxel_size (tuple): spacing written in the affine
+        seed (int): every subject is generated from (seed, split, index), so any split
+            or subject can be regenerated alone
+    """
+    splits = splits or {"train": 8, "val": 2, "test": 2}
+    os.makedirs(os.path.join(out_dir, "images"), exist_ok=True)
+    os.makedirs(os.path.join(out_dir, "masks"), exist_ok=True)
+    affine = np.diag(list(voxel_size) + [1.0])
+
+    for split_id, (split, count) in enumerate(splits.items()):
+        records = []
+        for i in range(count):
+            rng = np.random.default_rng([seed, split_id, i])
+            num_lesions = 0
+            if rng.uniform() >= lesion_free_fraction:
+                num_lesions = 1 + rng.poisson(max(lesions_per_subject - 1, 0))
+            image, mask = generate_subject(shape, num_lesions, seed=rng.integers(2 ** 32), **lesion_kwargs)
+
+            name = f"{split}_{i:03d}"
+            image_path = os.path.join("images", f"{name}_swi.nii.gz")
+            mask_path = os.path.join("masks", f"{name}_mask.nii.gz")
+            nib.save(nib.Nifti1Image(image, affine), os.path.join(out_dir, image_path))
+            nib.save(nib.Nifti1Image(mask, affine), os.path.join(out_dir, mask_path))
+            records.append({"MRI_file_path": image_path, "GT_mask_path": mask_path})
+            print(f"[{split}] {i+1}/{count} {image_path}: {num_lesions} lesions, {int(mask.sum())} lesion voxels")
+        pd.DataFrame(records, columns=["MRI_file_path", "GT_mask_path"]).to_csv(os.path.join(out_dir, f"{split}.csv"),
+                                                                                index=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic CMB dataset (NIfTI volumes, masks and split CSVs)')
+
+    parser.add_argument('--out_dir', type=str, required=True)
+    parser.add_argument('--num_train', type=int, default=8)
+    parser.add_argument('--num_val', type=int, default=2)
+    parser.add_argument('--num_test', type=int, default=2)
+    parser.add_argument('--shape', type=int, nargs=3, default=[128, 128, 96])
+    parser.add_argument('--voxel_size', type=float, nargs=3, default=[1.0, 1.0, 1.0])
+    parser.add_argument('--lesions_per_subject', type=float, default=3.0, help='mean lesion count of the subjects with lesions')
+    parser.add_argument('--lesion_free_fraction', type=float, default=0.3)
+    parser.add_argument('--radius', type=float, nargs=2, default=[0.8, 2.5], help='lesion radius range in voxels')
+    parser.add_argument('--contrast', type=float, nargs=2, default=[0.5, 0.85], help='relative signal drop range at the lesion centre')
+    parser.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args()
+    write_dataset(args.out_dir, splits={"train": args.num_train, "val": args.num_val, "test": args.num_test},
+                  shape=tuple(args.shape), lesions_per_subject=args.lesions_per_subject,
+                  lesion_free_fraction=args.lesion_free_fraction, voxel_size=tuple(args.voxel_size), seed=args.seed,
+                  radius=tuple(args.radius), contrast=tuple(args.contrast))
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules of CNN-Baseline are imported flat, as the entry scripts do
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
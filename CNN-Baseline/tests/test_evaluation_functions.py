@@ -0,0 +1,44 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from utils.evaluation_functions import SSIM3D, batch_ssim_psnr, create_window_3D, ssim3D
+
+
+def reference_ssim_map(img1, img2, window_size=11):
+    # the original single window_size^3 Gaussian convolution
+    channel = img1.size(1)
+    window = create_window_3D(window_size, channel).type_as(img1)
+    conv = lambda x: F.conv3d(x, window, padding=window_size // 2, groups=channel)
+    mu1, mu2 = conv(img1), conv(img2)
+    sigma1_sq = conv(img1 * img1) - mu1.pow(2)
+    sigma2_sq = conv(img2 * img2) - mu2.pow(2)
+    sigma12 = conv(img1 * img2) - mu1 * mu2
+    C1, C2 = 0.01 ** 2, 0.03 ** 2
+    return ((2 * mu1 * mu2 + C1) * (2 * sigma12 + C2)) / ((mu1.pow(2) + mu2.pow(2) + C1) * (sigma1_sq + sigma2_sq + C2))
+
+
+def random_pair(shape, seed):
+    g = torch.Generator().manual_seed(seed)
+    img1 = torch.rand(shape, generator=g, dtype=torch.float64)
+    img2 = (img1 + 0.2 * torch.randn(shape, generator=g, dtype=torch.float64)).clamp(0, 1)
+    return img1, img2
+
+
+@pytest.mark.parametrize("shape, window_size", [((2, 1, 16, 14, 12), 11), ((1, 2, 9, 10, 7), 5), ((1, 1, 6, 6, 6), 11)])
+def test_separable_ssim_matches_dense_window(shape, window_size):
+    img1, img2 = random_pair(shape, 0)
+    expected = reference_ssim_map(img1, img2, window_size)
+    torch.testing.assert_close(ssim3D(img1, img2, window_size), expected.mean())
+    torch.testing.assert_close(SSIM3D(window_size)(img1, img2), expected.mean())
+    torch.testing.assert_close(ssim3D(img1, img2, window_size, size_average=False), expected.flatten(1).mean(1))
+
+
+def test_batch_ssim_psnr_chunks():
+    img1, img2 = random_pair((5, 1, 12, 12, 10), 1)
+    ssim_values, psnr_values = batch_ssim_psnr(img1, img2, chunk_size=2)
+    torch.testing.assert_close(ssim_values, reference_ssim_map(img1, img2).flatten(1).mean(1))
+    mse = (img1 - img2).pow(2).flatten(1).mean(1)
+    torch.testing.assert_close(psnr_values, 10 * torch.log10(1 / mse))
+    # a list of (C, D, H, W) volumes gives the same values
+    torch.testing.assert_close(batch_ssim_psnr(list(img1), list(img2))[0], ssim_values)
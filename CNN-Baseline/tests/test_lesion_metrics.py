@@ -0,0 +1,71 @@
+import numpy as np
+import torch
+from skimage import measure
+
+from lesion_metrics import LesionMetrics, froc_curve
+
+
+def random_volume(rng, shape=(24, 24, 20), num_blobs=6):
+    # Gaussian blobs of random height, so components get different scores; float32 as the
+    # solvers pass them, so the brute force compares the same scores
+    grid = np.stack(np.meshgrid(*[np.arange(s) for s in shape], indexing="ij"), axis=-1)
+    prob = np.zeros(shape)
+    gt = np.zeros(shape, dtype=np.float32)
+    for k in range(num_blobs):
+        centre = rng.uniform(0, shape)
+        prob = np.maximum(prob, rng.uniform(0.55, 1.0) * np.exp(-((grid - centre) ** 2).sum(-1) / rng.uniform(1, 4)))
+        # every other GT lesion near a blob, the rest anywhere
+        d, h, w = np.clip(centre + rng.uniform(-3, 3, 3), 0, np.array(shape) - 2).astype(int) if k % 2 \
+            else rng.integers(0, np.array(shape) - 2)
+        gt[d:d + 2, h:h + 2, w:w + 2] = 1
+    return prob.astype(np.float32), gt
+
+
+def regions(mask, prob=None):
+    props = measure.regionprops(measure.label(mask > 0, connectivity=3), intensity_image=prob)
+    return [(np.array(p.centroid), np.array(p.bbox), p.intensity_max if prob is not None else 1.0) for p in props]
+
+
+def brute_force_froc(volumes, thresholds, max_distance):
+    # re-match the components kept at every threshold, pair by pair
+    sensitivity, fp = [], []
+    for s in thresholds:
+        detected = num_gt = false_positives = 0
+        for prob, gt in volumes:
+            preds = [r for r in regions(prob > 0.5, prob) if r[2] >= s]
+            gts = regions(gt)
+
+            def match(p, g):
+                overlap = np.all(p[1][:3] < g[1][3:]) and np.all(g[1][:3] < p[1][3:])
+                return np.linalg.norm(p[0] - g[0]) <= max_distance or overlap
+
+            detected += sum(any(match(p, g) for p in preds) for g in gts)
+            false_positives += sum(not any(match(p, g) for g in gts) for p in preds)
+            num_gt += len(gts)
+        sensitivity.append(detected / num_gt)
+        fp.append(false_positives / len(volumes))
+    return np.array(sensitivity), np.array(fp)
+
+
+def test_froc_matches_brute_force():
+    rng = np.random.default_rng(0)
+    volumes = [random_volume(rng) for _ in range(3)]
+    metrics = LesionMetrics(max_distance=3.0)
+    for k, (prob, gt) in enumerate(volumes):
+        prob_t = torch.from_numpy(prob)[None, None]
+        metrics.update(f"s{k}.nii.gz", (prob_t > 0.5).long(), torch.from_numpy(gt)[None, None], prob=prob_t)
+    curve, _ = metrics.froc()
+
+    assert len(curve["thresholds"]) > 3
+    assert np.all(np.diff(curve["thresholds"]) < 0)
+    sensitivity, fp = brute_force_froc(volumes, curve["thresholds"], 3.0)
+    np.testing.assert_allclose(curve["sensitivity"], sensitivity)
+    np.testing.assert_allclose(curve["fp_per_subject"], fp)
+
+
+def test_froc_curve_ties_and_missed_lesions():
+    # two unmatched components and a GT lesion share the score 0.8, the last GT lesion is never detected
+    curve = froc_curve([0.9, 0.8, 0.8, 0.3], [True, False, False, True], [0.9, 0.8, -np.inf], num_subjects=2)
+    np.testing.assert_allclose(curve["thresholds"], [0.9, 0.8])
+    np.testing.assert_allclose(curve["sensitivity"], [1 / 3, 2 / 3])
+    np.testing.assert_allclose(curve["fp_per_subject"], [0.0, 1.0])
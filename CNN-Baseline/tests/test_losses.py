@@ -0,0 +1,63 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from losses import BinarySegmentationLoss, _FusedBinarySegmentationLoss
+
+
+def reference_losses(logits, target, weight=None, epsilon=1e-6):
+    # DiceLoss(normalization='sigmoid') + nn.BCEWithLogitsLoss() as the solvers used them,
+    # with the original (C, N * Spatial) flattening of compute_per_channel_dice
+    probs = torch.sigmoid(logits).transpose(0, 1).reshape(logits.size(1), -1)
+    flat_target = target.transpose(0, 1).reshape(target.size(1), -1)
+    intersect = (probs * flat_target).sum(-1)
+    if weight is not None:
+        intersect = weight * intersect
+    denominator = (probs * probs).sum(-1) + (flat_target * flat_target).sum(-1)
+    dice = 2 * (intersect / denominator.clamp(min=epsilon))
+    return 1. - dice.mean(), F.binary_cross_entropy_with_logits(logits, target)
+
+
+def random_case(shape, seed, empty_channel=False):
+    g = torch.Generator().manual_seed(seed)
+    logits = 3 * torch.randn(shape, generator=g, dtype=torch.float64)
+    target = (torch.rand(shape, generator=g, dtype=torch.float64) > 0.8).double()
+    if empty_channel:
+        target[:, -1] = 0
+    return logits, target
+
+
+@pytest.mark.parametrize("weight", [None, torch.tensor([0.3, 2.0], dtype=torch.float64)])
+@pytest.mark.parametrize("empty_channel", [False, True])
+def test_fused_loss_matches_dice_plus_bce(weight, empty_channel):
+    logits, target = random_case((2, 2, 6, 5, 4), 0, empty_channel)
+    fused_logits = logits.clone().requires_grad_()
+    ref_logits = logits.clone().requires_grad_()
+
+    dice, bce = _FusedBinarySegmentationLoss.apply(fused_logits, target, weight, 1e-6)
+    ref_dice, ref_bce = reference_losses(ref_logits, target, weight)
+    torch.testing.assert_close(dice, ref_dice)
+    torch.testing.assert_close(bce, ref_bce)
+
+    # unequal weights on the two terms, as in the solvers
+    (0.7 * dice + 1.3 * bce).backward()
+    (0.7 * ref_dice + 1.3 * ref_bce).backward()
+    torch.testing.assert_close(fused_logits.grad, ref_logits.grad)
+
+
+def test_fused_loss_gradcheck():
+    logits, target = random_case((2, 2, 4, 3, 3), 1)
+    weight = torch.tensor([0.5, 1.5], dtype=torch.float64)
+    logits.requires_grad_()
+    assert torch.autograd.gradcheck(lambda x: _FusedBinarySegmentationLoss.apply(x, target, weight, 1e-6), (logits,))
+    assert torch.autograd.gradcheck(lambda x: _FusedBinarySegmentationLoss.apply(x, target, None, 1e-6), (logits,))
+
+
+def test_binary_segmentation_loss_mask():
+    logits, target = random_case((1, 1, 8, 8, 8), 2)
+    loss = BinarySegmentationLoss(threshold=0.1)
+    dice, bce, pred_mask = loss(logits.float(), target)
+    ref_dice, ref_bce = reference_losses(logits.float(), target.float())
+    torch.testing.assert_close(dice, ref_dice)
+    torch.testing.assert_close(bce, ref_bce)
+    assert torch.equal(pred_mask, (torch.sigmoid(logits.float()) > 0.1).long())
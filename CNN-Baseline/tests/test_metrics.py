@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+from skimage.metrics import adapted_rand_error as skimage_adapted_rand_error
+
+from metrics import adapted_rand_error
+
+
+@pytest.mark.parametrize("alpha", [0.0, 0.2, 0.5, 0.9, 1.0])
+def test_adapted_rand_error_matches_skimage(alpha):
+    rng = np.random.default_rng(0)
+    gt = rng.integers(0, 5, (10, 12, 8))
+    seg = rng.integers(0, 7, (10, 12, 8))
+    expected = skimage_adapted_rand_error(gt, seg, alpha=alpha)[0]
+    assert adapted_rand_error(gt, seg, alpha=alpha) == pytest.approx(expected, rel=1e-12)
+
+
+def test_adapted_rand_error_weights():
+    # one gt object split in two halves: pairs within seg labels 2 * 32 * 31, within gt 64 * 63
+    gt = np.ones((4, 4, 4), dtype=np.int64)
+    seg = np.arange(64).reshape(4, 4, 4) % 2 + 1
+    same = 2 * 32 * 31
+    assert adapted_rand_error(gt, seg, alpha=0.0) == pytest.approx(0.0)
+    assert adapted_rand_error(gt, seg, alpha=1.0) == pytest.approx(1 - same / (64 * 63))
+    assert adapted_rand_error(gt, seg, alpha=0.3) == pytest.approx(1 - same / (0.3 * 64 * 63 + 0.7 * same))
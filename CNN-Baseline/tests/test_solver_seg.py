@@ -0,0 +1,83 @@
+import torch
+import torch.nn.functional as F
+
+from solver_seg import PatchContrastiveLoss, extract_window_embeddings
+
+
+def reference_window_embeddings(decoder_feats, pred_logits, coords, size=20):
+    # per-coordinate loop of the original solver, with the windows clipped to the volume
+    half = size // 2
+    embs = []
+    for b, _, d, h, w in coords.tolist():
+        window = (b, slice(None), slice(max(d - half, 0), d + half), slice(max(h - half, 0), h + half),
+                  slice(max(w - half, 0), w + half))
+        embs.append(torch.cat([decoder_feats[window].flatten(1).mean(1), pred_logits[window].flatten(1).mean(1)]))
+    return torch.stack(embs)
+
+
+def random_coords(n, shape, generator):
+    b, d, h, w = [torch.randint(0, s, (n,), generator=generator) for s in (shape[0],) + shape[2:]]
+    return torch.stack([b, torch.zeros_like(b), d, h, w], dim=1)
+
+
+def test_window_embeddings_match_loop():
+    g = torch.Generator().manual_seed(0)
+    feats = torch.randn(2, 4, 30, 26, 22, generator=g, dtype=torch.float64)
+    logits = torch.randn(2, 1, 30, 26, 22, generator=g, dtype=torch.float64)
+    # interior and border coordinates, more than one chunk
+    coords = torch.cat([random_coords(70, feats.shape, g),
+                        torch.tensor([[0, 0, 0, 0, 0], [1, 0, 29, 25, 21], [1, 0, 3, 24, 10]])])
+    expected = reference_window_embeddings(feats, logits, coords)
+    result = extract_window_embeddings(feats, logits, coords, chunk_size=32)
+    torch.testing.assert_close(result, expected)
+    # 4-column (b, d, h, w) coordinates of val/test
+    torch.testing.assert_close(extract_window_embeddings(feats, logits, coords[:, [0, 2, 3, 4]]), expected)
+
+
+def test_window_embeddings_gradient():
+    g = torch.Generator().manual_seed(1)
+    feats = torch.randn(1, 2, 24, 24, 24, generator=g, dtype=torch.float64, requires_grad=True)
+    logits = torch.randn(1, 1, 24, 24, 24, generator=g, dtype=torch.float64, requires_grad=True)
+    coords = random_coords(5, feats.shape, g)
+    weights = torch.randn(5, 3, generator=g, dtype=torch.float64)
+    (extract_window_embeddings(feats, logits, coords) * weights).sum().backward()
+    grads = [feats.grad.clone(), logits.grad.clone()]
+    feats.grad, logits.grad = None, None
+    (reference_window_embeddings(feats, logits, coords) * weights).sum().backward()
+    torch.testing.assert_close(grads, [feats.grad, logits.grad])
+
+
+def test_window_embeddings_empty():
+    feats, logits = torch.zeros(1, 16, 8, 8, 8), torch.zeros(1, 1, 8, 8, 8)
+    assert extract_window_embeddings(feats, logits, torch.zeros(0, 5, dtype=torch.long)).shape == (0, 17)
+
+
+def reference_contrastive_loss(Z, labels, tau=0.07):
+    # the original dense [M, M] supervised contrastive loss
+    sim = (Z @ Z.T) / tau
+    mask = labels.unsqueeze(1).eq(labels.unsqueeze(0)).to(Z.dtype)
+    mask.fill_diagonal_(0)
+    exp_sim = torch.exp(sim) * (1 - torch.eye(len(Z), dtype=Z.dtype))
+    log_prob = sim - torch.log(exp_sim.sum(1, keepdim=True) + 1e-12)
+    mean_log_prob_pos = (mask * log_prob).sum(1) / (mask.sum(1) + 1e-12)
+    return -mean_log_prob_pos.mean()
+
+
+def test_chunked_contrastive_loss_matches_dense():
+    g = torch.Generator().manual_seed(2)
+    Z = F.normalize(torch.randn(70, 16, generator=g, dtype=torch.float64), dim=1).requires_grad_()
+    # a single positive row has no other positive and contributes zero
+    labels = torch.zeros(70, dtype=torch.long)
+    labels[:1] = 1
+    labels = labels[torch.randperm(70, generator=g)]
+    for chunk_size in (16, 70, 256):
+        loss = PatchContrastiveLoss(chunk_size=chunk_size)(Z, labels)
+        grad, = torch.autograd.grad(loss, Z)
+        expected = reference_contrastive_loss(Z, labels)
+        expected_grad, = torch.autograd.grad(expected, Z)
+        torch.testing.assert_close(loss, expected)
+        torch.testing.assert_close(grad, expected_grad)
+
+    labels = (torch.rand(70, generator=g) > 0.6).long()
+    with torch.no_grad():
+        torch.testing.assert_close(PatchContrastiveLoss(chunk_size=16)(Z, labels), reference_contrastive_loss(Z, labels))
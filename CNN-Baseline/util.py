@@ -4,6 +4,8 @@ import torch
 import torch.nn.functional as F
 import torch.nn as nn
 import numpy as np
+import os
+import contextlib
 
 class TverskyLoss(nn.Module):
     def __init__(self, alpha=0.5, beta=0.5, smooth=1.0):
@@ -23,6 +25,78 @@ class TverskyLoss(nn.Module):
         tversky = (true_pos + self.smooth) / (true_pos + self.alpha * false_neg + self.beta * false_pos + self.smooth)
         return 1 - tversky
 
+def resolve_device(device="auto"):
+    """'auto' picks cuda when available, anything else is passed to torch.device."""
+    if device in [None, "auto"]:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    return torch.device(device)
+
+
+def batch_name(fname):
+    """Subject column of a step: the collated file names joined by commas."""
+    return fname if isinstance(fname, str) else ",".join(str(f) for f in fname)
+
+
+PRECISION_DTYPES = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def autocast_context(device, precision="fp32"):
+    """
+    Autocast region for --precision on `device`; a no-op for fp32. Convolutions and
+    linear layers run in the reduced type, outputs are cast back by the callers where
+    precision matters (losses, sigmoid probabilities, contrastive embeddings).
+    """
+    dtype = PRECISION_DTYPES[precision]
+    if dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=torch.device(device).type, dtype=dtype)
+
+
+def make_grad_scaler(device, precision="fp32"):
+    """Loss scaler for fp16 training, disabled (a pass-through) for fp32 and bf16."""
+    enabled = precision == "fp16"
+    device_type = torch.device(device).type
+    if hasattr(torch, "amp") and hasattr(torch.amp, "GradScaler"):
+        return torch.amp.GradScaler(device_type, enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled and device_type == "cuda")
+
+
+def setup_cpu_threads(args, device):
+    """
+    Apply --num_threads / --num_interop_threads (0 keeps the torch default) and, on a
+    CPU device, split the cores of the process between compute and DataLoader
+    workers: the last n_workers cores are reserved for the workers (see
+    `pin_dataloader_worker`), the main process is pinned to the others and by
+    default runs one intra-op thread per core it owns. Must run before any parallel
+    work (i.e. before building the model) for the inter-op setting to take effect.
+    """
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+    num_threads = getattr(args, "num_threads", 0)
+    args.worker_cpus = None
+    if device.type == "cpu" and hasattr(os, "sched_setaffinity"):
+        n_reserved = min(getattr(args, "n_workers", 0), len(cpus) - 1)
+        if n_reserved > 0:
+            args.worker_cpus = cpus[len(cpus) - n_reserved:]
+            cpus = cpus[:len(cpus) - n_reserved]
+            os.sched_setaffinity(0, cpus)
+        num_threads = num_threads or len(cpus)
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    if getattr(args, "num_interop_threads", 0) > 0:
+        try:
+            torch.set_num_interop_threads(args.num_interop_threads)
+        except RuntimeError as e:
+            print(f"Could not set inter-op threads: {e}")
+    print(f"Device {device}, {torch.get_num_threads()} intra-op threads on cpus {cpus}, "
+          f"dataloader workers on cpus {args.worker_cpus}")
+
+
+def pin_dataloader_worker(worker_id, cpus):
+    # DataLoader worker_init_fn: keep decoding off the compute cores, one thread per worker
+    os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(1)
+
+
 def to_img(x, name='img', resize=-1, normalize=True, n_row=None):
     if len(x.shape) < 4:
         x = x.unsqueeze(0)
@@ -118,6 +192,126 @@ def dice_coeff(mask1, mask2, smooth=1e-6, num_classes=19):
 
     return dice_bg/num_classes, dice/counter, dice_hash
 
+class MetricAccumulator(object):
+    """
+    Per-epoch bookkeeping of binary segmentation metrics and losses without host syncs.
+
+    `update` only stacks small tensors on the compute device (confusion counts and
+    detached loss values of the step); `materialize` copies everything to the host at
+    once and returns the epoch summary plus one record per step. Predictions and
+    targets are compared as flat vectors, so (N, 1, D, H, W) vs (N, D, H, W) layouts
+    give the same counts.
+
+    The per-step dice / dice_bg are those of `dice_coeff(gt, pred, num_classes=2)`.
+    """
+
+    def __init__(self, smooth=1e-6):
+        self.smooth = smooth
+        self.reset()
+
+    def reset(self):
+        self.fnames = []
+        self.counts = []
+        self.losses = []
+        self.loss_names = None
+
+    def __len__(self):
+        return len(self.counts)
+
+    def update(self, fname, pred_mask, gt_mask, **losses):
+        pred = pred_mask.reshape(-1).bool()
+        gt = gt_mask.reshape(-1).bool()
+        tp = (pred & gt).sum()
+        fp = (pred & ~gt).sum()
+        fn = (~pred & gt).sum()
+        tn = pred.numel() - tp - fp - fn
+        self.counts.append(torch.stack([tp, fp, fn, tn]))
+        if self.loss_names is None:
+            self.loss_names = list(losses.keys())
+        if self.loss_names:
+            self.losses.append(torch.stack([losses[k].detach().float().reshape(()) for k in self.loss_names]))
+        self.fnames.append(batch_name(fname))
+
+    def materialize(self):
+        """
+        Returns:
+            summary (dict): mean dice, dice_bg, TP, FP, FN and losses over the steps,
+                'loss' being the sum of the mean losses; NaN losses are left out of
+                their mean
+            records (list): one dict per step with fname, dice, dice_bg, TP, FP, FN
+        """
+        counts = torch.stack(self.counts).double().cpu()  # [S,4], single sync
+        tp, fp, fn, tn = counts.unbind(1)
+        dice = (2 * tp + self.smooth) / (2 * tp + fp + fn + self.smooth)
+        dice_back = (2 * tn + self.smooth) / (2 * tn + fp + fn + self.smooth)
+        dice_bg = (dice + dice_back) / 2
+
+        summary = {"dice": dice.mean().item(), "dice_bg": dice_bg.mean().item(),
+                   "TP": tp.mean().item(), "FP": fp.mean().item(), "FN": fn.mean().item()}
+        if self.losses:
+            losses = torch.stack(self.losses).double().cpu()  # [S,L], NaN for steps without a value
+            for k, name in enumerate(self.loss_names):
+                summary[name] = losses[:, k].nanmean().item()
+            summary["loss"] = sum(summary[name] for name in self.loss_names)
+
+        records = [{"fname": f, "dice": d, "dice_bg": b, "TP": int(t), "FP": int(p), "FN": int(n)}
+                   for f, d, b, t, p, n in zip(self.fnames, dice.tolist(), dice_bg.tolist(),
+                                               tp.tolist(), fp.tolist(), fn.tolist())]
+        return summary, records
+
+class ThresholdSweep(object):
+    """
+    Voxel confusion counts for a whole grid of probability thresholds in one pass.
+
+    `update` histograms the probabilities of every volume into `num_bins` bins,
+    separately for background and lesion voxels (a single bincount on the compute
+    device, no host sync). A voxel is predicted positive at threshold k / num_bins if
+    its probability is >= k / num_bins, so the counts at every threshold are reverse
+    cumulative sums of the two histograms.
+    """
+
+    def __init__(self, num_bins=200, smooth=1e-6):
+        self.num_bins = num_bins
+        self.smooth = smooth
+        self.reset()
+
+    def reset(self):
+        self.fnames = []
+        self.hists = []
+
+    def __len__(self):
+        return len(self.hists)
+
+    def thresholds(self):
+        return torch.arange(self.num_bins, dtype=torch.float64) / self.num_bins
+
+    def update(self, fname, prob, gt_mask):
+        bins = (prob.reshape(-1).float() * self.num_bins).long().clamp_(0, self.num_bins - 1)
+        bins += self.num_bins * gt_mask.reshape(-1).bool().long()
+        self.hists.append(torch.bincount(bins, minlength=2 * self.num_bins))
+        self.fnames.append(batch_name(fname))
+
+    def materialize(self):
+        """
+        Returns:
+            summary (dict): thresholds and, per threshold, the mean dice, TP, FP and FN
+                over the volumes, plus best_threshold / best_dice
+            dice (torch.Tensor): (S, num_bins) per-volume dice curves
+        """
+        hists = torch.stack(self.hists).double().cpu().view(-1, 2, self.num_bins)  # [S,2,T], single sync
+        above = hists.flip(-1).cumsum(-1).flip(-1)
+        fp, tp = above.unbind(1)
+        fn = hists[:, 1].sum(-1, keepdim=True) - tp
+        dice = (2 * tp + self.smooth) / (2 * tp + fp + fn + self.smooth)
+
+        mean_dice = dice.mean(0)
+        best = int(torch.argmax(mean_dice))
+        thresholds = self.thresholds()
+        summary = {"thresholds": thresholds.tolist(), "dice": mean_dice.tolist(),
+                   "TP": tp.mean(0).tolist(), "FP": fp.mean(0).tolist(), "FN": fn.mean(0).tolist(),
+                   "best_threshold": thresholds[best].item(), "best_dice": mean_dice[best].item()}
+        return summary, dice
+
 def dice_loss(mask1, mask2, smooth=1e-6, num_classes=19):
 
     loss = 0
@@ -32,6 +32,28 @@ def create_window_3D(window_size, channel):
 	window = Variable(_3D_window.expand(channel, 1, window_size, window_size, window_size).contiguous())
 	return window
 
+# separable 1D windows, keyed by (device, dtype, channel, window_size)
+_window_cache = {}
+
+def get_window_1D(window_size, channel, device, dtype):
+	"""
+	1D Gaussian window (sigma 1.5) of shape (channel, 1, window_size), built once per
+	(device, dtype, channel, window_size). Its outer product with itself along the three
+	axes is exactly the dense `create_window_3D` window.
+	"""
+	key = (torch.device(device), dtype, channel, window_size)
+	if key not in _window_cache:
+		window = gaussian(window_size, 1.5).to(device=device, dtype=dtype)
+		_window_cache[key] = window.view(1, 1, window_size).expand(channel, 1, window_size).contiguous()
+	return _window_cache[key]
+
+def _separable_conv3d(x, window, window_size, channel):
+	# three 1D passes along D, H and W instead of one window_size^3 pass, same zero padding
+	pad = window_size//2
+	x = F.conv3d(x, window.view(channel, 1, window_size, 1, 1), padding = (pad, 0, 0), groups = channel)
+	x = F.conv3d(x, window.view(channel, 1, 1, window_size, 1), padding = (0, pad, 0), groups = channel)
+	return F.conv3d(x, window.view(channel, 1, 1, 1, window_size), padding = (0, 0, pad), groups = channel)
+
 def _ssim(img1, img2, window, window_size, channel, size_average = True):
 	mu1 = F.conv2d(img1, window, padding = window_size//2, groups = channel)
 	mu2 = F.conv2d(img2, window, padding = window_size//2, groups = channel)
@@ -55,17 +77,20 @@ def _ssim(img1, img2, window, window_size, channel, size_average = True):
 		return ssim_map.mean(1).mean(1).mean(1)
 	
 def _ssim_3D(img1, img2, window, window_size, channel, size_average = True):
-	mu1 = F.conv3d(img1, window, padding = window_size//2, groups = channel)
-	mu2 = F.conv3d(img2, window, padding = window_size//2, groups = channel)
+	# the five local moments go through a single separable pass, stacked along channels
+	stacked = torch.cat([img1, img2, img1*img1, img2*img2, img1*img2], dim = 1)
+	moments = _separable_conv3d(stacked, window.repeat(5, 1, 1), window_size, 5*channel)
+	mu1, mu2, e11, e22, e12 = moments.split(channel, dim = 1)
+	del stacked, moments
 
 	mu1_sq = mu1.pow(2)
 	mu2_sq = mu2.pow(2)
 
 	mu1_mu2 = mu1*mu2
 
-	sigma1_sq = F.conv3d(img1*img1, window, padding = window_size//2, groups = channel) - mu1_sq
-	sigma2_sq = F.conv3d(img2*img2, window, padding = window_size//2, groups = channel) - mu2_sq
-	sigma12 = F.conv3d(img1*img2, window, padding = window_size//2, groups = channel) - mu1_mu2
+	sigma1_sq = e11 - mu1_sq
+	sigma2_sq = e22 - mu2_sq
+	sigma12 = e12 - mu1_mu2
 
 	C1 = 0.01**2
 	C2 = 0.03**2
@@ -75,7 +100,8 @@ def _ssim_3D(img1, img2, window, window_size, channel, size_average = True):
 	if size_average:
 		return ssim_map.mean()
 	else:
-		return ssim_map.mean(1).mean(1).mean(1)
+		# one value per volume
+		return ssim_map.flatten(1).mean(1)
 	
 
 
@@ -111,47 +137,13 @@ class SSIM3D(torch.nn.Module):
 		super(SSIM3D, self).__init__()
 		self.window_size = window_size
 		self.size_average = size_average
-		self.channel = 1
-		self.window = create_window_3D(window_size, self.channel)
 
 	def ssim_3D(self, img1, img2, window, window_size, channel, size_average = True):
-		mu1 = F.conv3d(img1, window, padding = window_size//2, groups = channel)
-		mu2 = F.conv3d(img2, window, padding = window_size//2, groups = channel)
-
-		mu1_sq = mu1.pow(2)
-		mu2_sq = mu2.pow(2)
-
-		mu1_mu2 = mu1*mu2
-
-		sigma1_sq = F.conv3d(img1*img1, window, padding = window_size//2, groups = channel) - mu1_sq
-		sigma2_sq = F.conv3d(img2*img2, window, padding = window_size//2, groups = channel) - mu2_sq
-		sigma12 = F.conv3d(img1*img2, window, padding = window_size//2, groups = channel) - mu1_mu2
-
-		C1 = 0.01**2
-		C2 = 0.03**2
-
-		ssim_map = ((2*mu1_mu2 + C1)*(2*sigma12 + C2))/((mu1_sq + mu2_sq + C1)*(sigma1_sq + sigma2_sq + C2))
+		return _ssim_3D(img1, img2, window, window_size, channel, size_average)
 
-		if size_average:
-			return ssim_map.mean()
-		else:
-			return ssim_map.mean(1).mean(1).mean(1)
-	
 	def forward(self, img1, img2):
 		(_, channel, _, _, _) = img1.size()
-
-		if channel == self.channel and self.window.data.type() == img1.data.type():
-			window = self.window
-		else:
-			window = create_window_3D(self.window_size, channel)
-			
-			if img1.is_cuda:
-				window = window.cuda(img1.get_device())
-			window = window.type_as(img1)
-			
-			self.window = window
-			self.channel = channel
-
+		window = get_window_1D(self.window_size, channel, img1.device, img1.dtype)
 
 		return self.ssim_3D(img1, img2, window, self.window_size, channel, self.size_average)
 
@@ -168,14 +160,35 @@ def ssim(img1, img2, window_size = 11, size_average = True):
 
 def ssim3D(img1, img2, window_size = 11, size_average = True):
 	(_, channel, _, _, _) = img1.size()
-	window = create_window_3D(window_size, channel)
-	
-	if img1.is_cuda:
-		window = window.cuda(img1.get_device())
-	window = window.type_as(img1)
-	
+	window = get_window_1D(window_size, channel, img1.device, img1.dtype)
+
 	return _ssim_3D(img1, img2, window, window_size, channel, size_average)
 
+def batch_ssim_psnr(img1, img2, data_range = 1.0, window_size = 11, chunk_size = 0):
+	"""
+	SSIM and PSNR of many volume pairs at once.
+
+	Args:
+		img1, img2 (torch.Tensor): (N, C, D, H, W) volumes, or lists of (C, D, H, W) volumes of equal shape
+		data_range (float): value range of the images, used by PSNR
+		window_size (int): SSIM Gaussian window size
+		chunk_size (int): pairs per pass to bound memory, 0 for all at once
+
+	Returns:
+		ssim (N,) and psnr (N,) tensors
+	"""
+	if isinstance(img1, (list, tuple)):
+		img1, img2 = torch.stack(list(img1)), torch.stack(list(img2))
+	chunk_size = chunk_size or img1.size(0)
+	ssim_values, psnr_values = [], []
+	with torch.no_grad():
+		for start in range(0, img1.size(0), chunk_size):
+			a, b = img1[start:start + chunk_size], img2[start:start + chunk_size]
+			ssim_values.append(ssim3D(a, b, window_size, size_average = False))
+			mse = (a - b).pow(2).flatten(1).mean(1)
+			psnr_values.append(10*torch.log10((data_range*data_range) / mse))
+	return torch.cat(ssim_values), torch.cat(psnr_values)
+
 if __name__ == "__main__":
 	# pdb.set_trace()
 	origin_img = torch.rand((256,256,256))
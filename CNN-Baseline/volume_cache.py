@@ -0,0 +1,123 @@
+import os
+import hashlib
+import tempfile
+import numpy as np
+import nibabel as nib
+import torch
+
+
+def load_nifti_image(path):
+    """
+    Decode a NIfTI image and rescale it to the [0, 1] range.
+
+    Args:
+        path (str): path to the .nii / .nii.gz file
+
+    Returns:
+        np.ndarray of the same spatial shape, float64
+    """
+    image = nib.load(path).get_fdata()
+    img_max, img_min = image.max(), image.min()
+    # normaliza image to 0-1 range
+    return (image - img_min)/(img_max - img_min)
+
+
+def load_nifti_mask(path):
+    """
+    Decode a NIfTI mask.
+
+    Args:
+        path (str): path to the .nii / .nii.gz file
+
+    Returns:
+        np.ndarray of the same spatial shape, float64
+    """
+    return nib.load(path).get_fdata()
+
+
+def source_key(path, extra=""):
+    """
+    Build a cache key from the absolute source path and its mtime/size, so that
+    rewriting the source file invalidates every entry derived from it.
+
+    Args:
+        path (str): source file path
+        extra (str): anything else the cached content depends on (e.g. dtype)
+
+    Returns:
+        hex digest string
+    """
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    token = f"{path}|{st.st_mtime_ns}|{st.st_size}|{extra}"
+    return hashlib.sha1(token.encode("utf-8")).hexdigest()
+
+
+def atomic_save_npy(path, array):
+    """
+    Write `array` to `path` in .npy format through a temp file + rename, so that
+    concurrent DataLoader workers never observe a partially written entry.
+    """
+    dirname = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class VolumeCache(object):
+    """
+    On-disk cache of decoded volumes.
+
+    Images are stored already normalized to [0, 1] as float32 (or float16) and
+    masks as uint8, one .npy file per source file. Entries are memory-mapped on
+    read and wrapped with `torch.from_numpy`, so a cache hit costs no decode and
+    no copy. The file name is derived from the source path plus its mtime/size,
+    hence a modified source is simply rebuilt on next access.
+
+    Args:
+        cache_dir (str): directory holding the .npy files (created if missing)
+        image_dtype (str): 'float32' or 'float16' storage type for the images
+    """
+
+    def __init__(self, cache_dir, image_dtype="float32"):
+        assert image_dtype in ["float32", "float16"], f"Unsupported cache dtype: {image_dtype}"
+        self.cache_dir = cache_dir
+        self.image_dtype = np.dtype(image_dtype)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _entry_path(self, path, kind, dtype):
+        return os.path.join(self.cache_dir, f"{kind}_{source_key(path, dtype.name)}.npy")
+
+    def _load(self, path, kind, dtype, decode):
+        entry = self._entry_path(path, kind, dtype)
+        if not os.path.exists(entry):
+            atomic_save_npy(entry, decode(path).astype(dtype))
+        # copy-on-write mapping: pages are shared with the page cache and the
+        # resulting tensor is writable, so torch does not need to copy it
+        return np.load(entry, mmap_mode="c")
+
+    def load_image(self, path):
+        """Returns the normalized image of `path` as a memory-mapped ndarray."""
+        return self._load(path, "img", self.image_dtype, load_nifti_image)
+
+    def load_mask(self, path):
+        """Returns the mask of `path` as a memory-mapped uint8 ndarray."""
+        return self._load(path, "mask", np.dtype("uint8"), load_nifti_mask)
+
+    def load_pair(self, img_path, mask_path, region=None):
+        """
+        Returns (image, mask) as float32 tensors of shape (D, H, W), or of the shape
+        of `region` (tuple of slices). The mappings are sliced before the conversion,
+        so only the pages of the region are read and only the region is copied; a
+        float32 image is a zero-copy view of the cache file.
+        """
+        image, mask = self.load_image(img_path), self.load_mask(mask_path)
+        if region is not None:
+            image, mask = image[region], mask[region]
+        return torch.from_numpy(image).float(), torch.from_numpy(mask).float()